@@ -0,0 +1,108 @@
+"""Reports the cold-start import cost of each extract lambda module.
+
+Every module is imported in a fresh interpreter with ``python -X importtime``,
+so nothing is already cached in sys.modules, and the cumulative import time
+CloudWatch would see on a cold start is reported along with the heaviest
+dependencies it pulled in. Run from the repo root:
+
+    python benchmarks/import_time.py [--repeat 5] [--top 5] [module ...]
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+
+MODULES = [
+    "src.extract_lambda.connection",
+    "src.extract_lambda.credentials_manager",
+    "src.extract_lambda.catalogue",
+    "src.extract_lambda.run_state",
+    "src.extract_lambda.manifest",
+    "src.extract_lambda.metrics",
+    "src.extract_lambda.utils",
+    "src.extract_lambda.handler",
+    "src.extract_lambda.backfill",
+]
+
+
+def get_import_times(module: str = None) -> dict:
+    """Imports a module in a new interpreter and parses the -X importtime
+    report
+
+    Args:
+        module: dotted name of the module to import, or None to report only
+        what the interpreter imports at startup
+
+    Returns:
+        A dictionary of every module imported to its cumulative import time
+        in microseconds
+    """
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-X",
+            "importtime",
+            "-c",
+            f"import {module}" if module else "pass",
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def benchmark_module(
+    module: str, repeat: int, top: int, startup: set = frozenset()
+) -> tuple:
+    """Imports a module repeat times and works out its median cold-start
+    cost
+
+    Args:
+        module: dotted name of the module to import
+        repeat: number of fresh interpreters to import it in
+        top: number of heaviest third party dependencies to report
+        startup: names of the modules the interpreter imports before the
+        module, left out of the dependencies
+
+    Returns:
+        A (median milliseconds, heaviest dependencies) tuple, where the
+        dependencies are (name, milliseconds) tuples from the last run
+    """
+    runs = [get_import_times(module) for _ in range(repeat)]
+    median = statistics.median(run[module] for run in runs) / 1000
+    dependencies = [
+        (name, cumulative / 1000)
+        for name, cumulative in runs[-1].items()
+        if "." not in name and name != "src" and name not in startup
+    ]
+    dependencies.sort(key=lambda dependency: dependency[1], reverse=True)
+    return median, dependencies[:top]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("modules", nargs="*", default=MODULES)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=5)
+    args = parser.parse_args()
+
+    startup = set(get_import_times())
+    print(f"{'module':<42}{'median ms':>10}  heaviest dependencies (ms)")
+    for module in args.modules:
+        median, dependencies = benchmark_module(
+            module, args.repeat, args.top, startup
+        )
+        heaviest = ", ".join(f"{name} {ms:.0f}" for name, ms in dependencies)
+        print(f"{module:<42}{median:>10.1f}  {heaviest}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""Times the dimension lookup join used by convert_counterparty and
+convert_staff.
+
+A synthetic counterparty table is joined to a synthetic address table with
+join_dimension, and with the row by row dictionary lookup the converters used
+before, on the same data. The address ids are dense for the row by row lookup,
+which only works when ids equal row position + 1, and are then shuffled and
+made sparse to check join_dimension gives the same result. Run from the repo
+root:
+
+    python benchmarks/join_benchmark.py [--rows 1000000] [--lookup-rows 1000]
+"""
+
+import argparse
+import statistics
+import time
+
+import numpy as np
+import pandas as pd
+
+from src.transform_lambda.utils import join_dimension
+
+ADDRESS_COLUMNS = {
+    "address_line_1": "counterparty_legal_address_line_1",
+    "address_line_2": "counterparty_legal_address_line_2",
+    "district": "counterparty_legal_district",
+    "city": "counterparty_legal_city",
+    "postal_code": "counterparty_legal_postal_code",
+    "country": "counterparty_legal_country",
+    "phone": "counterparty_legal_phone_number",
+}
+
+
+def get_tables(rows: int, lookup_rows: int, seed: int = 0) -> tuple:
+    """Builds a counterparty and an address table with dense address ids
+
+    Args:
+        rows: number of counterparty rows
+        lookup_rows: number of address rows
+        seed: seed of the random address ids given to the counterparties
+
+    Returns:
+        A (counterparty, address) tuple of dataframes
+    """
+    rng = np.random.default_rng(seed)
+    address = pd.DataFrame({"address_id": np.arange(1, lookup_rows + 1)})
+    for column in ADDRESS_COLUMNS:
+        address[column] = [f"{column} {i}" for i in range(lookup_rows)]
+    counterparty = pd.DataFrame(
+        {
+            "counterparty_id": np.arange(1, rows + 1),
+            "legal_address_id": rng.integers(1, lookup_rows + 1, rows),
+        }
+    )
+    return counterparty, address
+
+
+def join_row_by_row(counterparty: pd.DataFrame, address: pd.DataFrame):
+    """The lookup convert_counterparty made before join_dimension, taking
+    each address by its row position (id - 1)"""
+    dict_counter = counterparty.to_dict()
+    dict_address = address.to_dict()
+    location_ids = dict_counter["legal_address_id"]
+    for column, name in ADDRESS_COLUMNS.items():
+        dict_counter[name] = {}
+        for key in location_ids:
+            ids = location_ids[key]
+            dict_counter[name][key] = dict_address[column][ids - 1]
+    return pd.DataFrame(dict_counter)
+
+
+def make_sparse(
+    counterparty: pd.DataFrame, address: pd.DataFrame, seed: int = 0
+) -> tuple:
+    """Spreads the address ids out and shuffles the address rows, keeping
+    which address each counterparty points at"""
+    rng = np.random.default_rng(seed)
+    counterparty = counterparty.assign(
+        legal_address_id=counterparty["legal_address_id"] * 7 + 3
+    )
+    address = address.assign(address_id=address["address_id"] * 7 + 3)
+    address = address.iloc[rng.permutation(len(address))]
+    return counterparty, address
+
+
+def time_join(join, repeat: int, *args) -> tuple:
+    """Runs a join repeat times
+
+    Returns:
+        A (median seconds, result of the last run) tuple
+    """
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = join(*args)
+        seconds.append(time.perf_counter() - start)
+    return statistics.median(seconds), result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--lookup-rows", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    counterparty, address = get_tables(args.rows, args.lookup_rows)
+    row_seconds, expected = time_join(
+        join_row_by_row, args.repeat, counterparty, address
+    )
+    join_seconds, result = time_join(
+        join_dimension,
+        args.repeat,
+        counterparty,
+        address,
+        "legal_address_id",
+        "address_id",
+        ADDRESS_COLUMNS,
+    )
+    sparse_seconds, sparse = time_join(
+        join_dimension,
+        args.repeat,
+        *make_sparse(counterparty, address),
+        "legal_address_id",
+        "address_id",
+        ADDRESS_COLUMNS,
+    )
+    columns = list(ADDRESS_COLUMNS.values())
+    assert result[columns].equals(expected[columns])
+    assert sparse[columns].equals(expected[columns])
+
+    print(f"{args.rows} rows joined to {args.lookup_rows} lookup rows")
+    print(f"{'join':<30}{'median s':>10}{'rows/s':>14}")
+    for name, seconds in [
+        ("row by row (dense ids)", row_seconds),
+        ("join_dimension (dense ids)", join_seconds),
+        ("join_dimension (sparse ids)", sparse_seconds),
+    ]:
+        print(f"{name:<30}{seconds:>10.3f}{args.rows / seconds:>14,.0f}")
+
+
+if __name__ == "__main__":
+    main()
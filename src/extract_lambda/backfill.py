@@ -0,0 +1,479 @@
+from src.extract_lambda.utils import (
+    extract_slice_to_s3,
+    get_ingestion_key,
+    get_last_updated_range,
+    get_table_query,
+    sql_security,
+)
+from src.extract_lambda.catalogue import get_catalogue
+from src.extract_lambda.connection import get_connection
+from src.extract_lambda.manifest import (
+    new_manifest,
+    record_table_manifest,
+    write_manifest,
+)
+from src.extract_lambda.run_state import (
+    read_run_state,
+    new_run_state,
+    get_table_watermark,
+    record_table_result,
+    write_run_state,
+    ORIGINAL_DATA_DUMP,
+)
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from pg8000.native import Connection
+import boto3
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+CHECKPOINT_KEY = "backfill_checkpoint.json"
+DEFAULT_CHUNK_DAYS = 30
+TIME_MARGIN_SECONDS = 60
+
+
+def get_backfill_chunks(
+    start: datetime, end: datetime, chunk_size: timedelta
+) -> list:
+    """Splits the time range of a backfill into consecutive windows of
+    last_updated values. Each window is a (watermark, upper bound) tuple
+    for get_table_query, so a row falls in the window if it was updated
+    after its start and no later than its end, and no row falls in two.
+
+    Args:
+        start: datetime the backfill starts after
+        end: datetime the backfill ends at (inclusive)
+        chunk_size: timedelta covered by each window, the last window may
+        be shorter
+
+    Returns:
+        A list of (start, end) tuples in time order
+    """
+    chunks = []
+    lower = start
+    while lower < end:
+        upper = min(lower + chunk_size, end)
+        chunks.append((lower, upper))
+        lower = upper
+    return chunks
+
+
+def get_earliest_last_updated(tables: list, conn: Connection) -> datetime:
+    """Finds the earliest last_updated value across the tables, where a
+    backfill with no start date starts from
+
+    Args:
+        tables: list of table names
+        conn: an open pg8000 connection to run the queries on
+
+    Returns:
+        The earliest datetime, or None if every table is empty
+    """
+    earliest = []
+    for table in tables:
+        table = sql_security(table, conn)
+        query, params = get_table_query(table, columns="min(last_updated)")
+        earliest.append(conn.run(query, **params)[0][0])
+    return get_last_updated_range(earliest)[0]
+
+
+def new_checkpoint(
+    start: datetime,
+    end: datetime,
+    chunk_size: timedelta,
+    tables: list,
+    folder: str,
+    file_format: str = "csv",
+    compression: str = None,
+) -> dict:
+    """Starts the checkpoint of a backfill, with no chunks done yet
+
+    Args:
+        start: datetime the backfill starts after
+        end: datetime the backfill ends at (inclusive)
+        chunk_size: timedelta covered by each chunk
+        tables: list of table names to backfill
+        folder: ingestion zone folder the chunks are written to
+        file_format: format the chunks are written in, "csv" or "parquet"
+        compression: compression codec of the files, or None
+
+    Returns:
+        The checkpoint as a dictionary
+    """
+    return {
+        "start": str(start),
+        "end": str(end),
+        "chunk_seconds": chunk_size.total_seconds(),
+        "tables": list(tables),
+        "folder": str(folder),
+        "format": file_format,
+        "compression": compression,
+        "complete": False,
+        "chunks": {table: {} for table in tables},
+    }
+
+
+def read_checkpoint(session: boto3.session.Session, bucket: str) -> dict:
+    """Reads the checkpoint of the latest backfill from the ingestion bucket
+
+    Args:
+        session: Boto3 session (optional, a default client is used if None)
+        bucket: ingestion bucket name as a string
+
+    Returns:
+        The checkpoint as a dictionary, or None if there isn't one
+    """
+    client = session.client("s3") if session else boto3.client("s3")
+    try:
+        response = client.get_object(Bucket=bucket, Key=CHECKPOINT_KEY)
+        return json.loads(response["Body"].read())
+    except ClientError:
+        return None
+
+
+def write_checkpoint(
+    session: boto3.session.Session, bucket: str, checkpoint: dict
+) -> dict:
+    """Writes the checkpoint of a backfill to the ingestion bucket as JSON
+
+    Args:
+        session: Boto3 session (optional, a default client is used if None)
+        bucket: ingestion bucket name as a string
+        checkpoint: checkpoint as a dictionary
+
+    Returns:
+        A dictionary containing the following:
+            success: shows whether the function ran successfully
+            message: success message or error message
+    """
+    client = session.client("s3") if session else boto3.client("s3")
+    try:
+        client.put_object(
+            Bucket=bucket,
+            Key=CHECKPOINT_KEY,
+            Body=json.dumps(checkpoint, indent=2).encode("utf-8"),
+            ContentType="application/json",
+        )
+        return {"success": True, "message": "checkpoint written"}
+    except ClientError as c:
+        logger.error(f"Boto3 ClientError: {str(c)}")
+        return {"success": False, "message": c.response["Error"]["Message"]}
+
+
+def record_chunk_result(
+    checkpoint: dict, table: str, chunk: int, response: dict
+) -> None:
+    """Records a finished chunk in the checkpoint, so it isn't extracted
+    again when the backfill resumes. Failed chunks aren't recorded.
+
+    Args:
+        checkpoint: checkpoint of the backfill, updated in place
+        table: table name as a string
+        chunk: number of the chunk
+        response: dictionary returned by extract_slice_to_s3
+    """
+    if not response["success"] and response["message"] != "no new data":
+        return
+    min_last_updated = response.get("min_last_updated")
+    max_last_updated = response.get("max_last_updated")
+    checkpoint["chunks"][table][str(chunk)] = {
+        "status": "success" if response["success"] else "no new data",
+        "rows": response.get("rows", 0),
+        "files": response.get("files", []),
+        "min_last_updated": (
+            str(min_last_updated) if min_last_updated is not None else None
+        ),
+        "max_last_updated": (
+            str(max_last_updated) if max_last_updated is not None else None
+        ),
+    }
+
+
+def get_table_response(checkpoint: dict, table: str) -> dict:
+    """Combines the chunks of a table in a finished backfill into one
+    response, in the form returned by update_data_in_bucket
+
+    Args:
+        checkpoint: checkpoint of the backfill
+        table: table name as a string
+
+    Returns:
+        A dictionary containing the following:
+            success: True if any rows were written
+            message: "written to bucket" or "no new data"
+            rows, files, min_last_updated, max_last_updated: totals of the
+            table's chunks
+    """
+    chunks = [
+        checkpoint["chunks"][table][chunk]
+        for chunk in sorted(checkpoint["chunks"][table], key=int)
+    ]
+    rows = sum(chunk["rows"] for chunk in chunks)
+    last_updated = get_last_updated_range(
+        datetime.fromisoformat(value)
+        for chunk in chunks
+        for value in (chunk["min_last_updated"], chunk["max_last_updated"])
+        if value is not None
+    )
+    return {
+        "success": rows > 0,
+        "message": "written to bucket" if rows else "no new data",
+        "rows": rows,
+        "files": [file for chunk in chunks for file in chunk["files"]],
+        "min_last_updated": last_updated[0],
+        "max_last_updated": last_updated[1],
+    }
+
+
+def finish_backfill(
+    session: boto3.session.Session,
+    bucket: str,
+    checkpoint: dict,
+    conn: Connection = None,
+) -> dict:
+    """Writes the manifest and run state of a finished backfill, so the
+    transform lambda reads the chunks of each table as one table (the same
+    way as the part files of a partitioned extract) and the next extract
+    run carries on from the end of the backfill
+
+    Nothing stops the scheduled extract running while a backfill is in
+    progress, so the run state is merged rather than replaced: a table
+    keeps its watermark if it is already past the end of the backfill, and
+    if an extract has run since the end of the backfill the run state keeps
+    pointing at that run's folder. The run state is only written if the
+    backfill changes it, as writing it triggers the transform lambda.
+
+    Args:
+        session: Boto3 session
+        bucket: ingestion bucket name as a string
+        checkpoint: checkpoint of the finished backfill
+        conn: optional, an open pg8000 connection used if the catalogue
+        needs loading
+
+    Returns:
+        The response of write_run_state, or a failure response if the run
+        state couldn't be read
+    """
+    end = datetime.fromisoformat(checkpoint["end"])
+    folder = checkpoint["folder"]
+    manifest = new_manifest(
+        end, folder, checkpoint["format"], checkpoint["compression"]
+    )
+    try:
+        previous_state = read_run_state(session, bucket)
+    except ClientError as ce:
+        return {"success": False, "message": ce.response["Error"]["Message"]}
+    newer_run = previous_state is not None and (
+        datetime.fromisoformat(previous_state["last_ran_at"]) > end
+    )
+    if newer_run:
+        logger.warning(
+            f"An extract has run since {end}, so the run state keeps its "
+            f"folder and {folder} isn't picked up by the transform lambda"
+        )
+        state = dict(previous_state, tables=dict(previous_state["tables"]))
+    else:
+        state = new_run_state(end, folder, previous_state)
+    catalogue = get_catalogue(conn)
+    for table in checkpoint["tables"]:
+        response = get_table_response(checkpoint, table)
+        column_types = {}
+        if catalogue.has_table(table):
+            column_types = catalogue.column_types(table)
+        record_table_manifest(manifest, table, response, column_types)
+        watermark = get_table_watermark(previous_state, table)
+        if watermark is None or watermark < end:
+            record_table_result(state, table, response, end)
+    manifest_response = write_manifest(session, bucket, manifest)
+    if not manifest_response["success"]:
+        return manifest_response
+    if state == previous_state:
+        logger.info("Run state is already past the backfill, not written")
+        return {"success": True, "message": "run state unchanged"}
+    return write_run_state(session, bucket, state)
+
+
+def backfill_handler(event, context, session: boto3.session = None) -> dict:
+    """Lambda handler function to backfill the ingestion zone with the
+    history of the Totesys tables in time-sliced chunks. Each table is split
+    into windows of chunk_days of last_updated values, and the chunks are
+    extracted concurrently into part files (e.g. sales_order.part-0003.csv)
+    in one folder, original_data_dump by default.
+
+    Finished chunks are recorded in a checkpoint (backfill_checkpoint.json)
+    in the ingestion bucket, written as each chunk finishes, and a chunk
+    that raises is recorded as failed without stopping the others. Before
+    taking each chunk the handler checks that the longest chunk so far
+    would still finish a minute before the Lambda time limit. Otherwise it
+    stops and returns with complete set to False, and invoking it again
+    resumes from the checkpoint. Once every chunk is done
+    the manifest and run state are written, which triggers the transform
+    lambda, and the next extract run carries on from the end of the range.
+
+    Args:
+        event: dictionary, all optional:
+            start: ISO datetime the backfill starts after (defaults to just
+            before the earliest last_updated in the tables)
+            end: ISO datetime the backfill ends at (defaults to now)
+            chunk_days: number of days in each chunk (30 by default)
+            tables: list of tables (defaults to the extractable tables)
+            folder: folder to write to (original_data_dump by default)
+            max_workers: number of chunks extracted concurrently
+            restart: if True the checkpoint is ignored and the backfill
+            starts again
+        context: Lambda context, used for the remaining time
+        session: a Boto3 session (optional argument)
+
+    Returns:
+        A dictionary containing the following:
+            success: "true" unless a chunk failed
+            message: progress or error message
+            complete: whether every chunk has been extracted
+    """
+    bucket = "blackwater-ingestion-zone"
+    event = event if isinstance(event, dict) else {}
+    max_workers = int(
+        event.get("max_workers", os.environ.get("EXTRACT_MAX_WORKERS", 1))
+    )
+    deadline = None
+    if hasattr(context, "get_remaining_time_in_millis"):
+        deadline = (
+            time.monotonic()
+            + context.get_remaining_time_in_millis() / 1000
+            - TIME_MARGIN_SECONDS
+        )
+
+    conn = get_connection()
+    checkpoint = read_checkpoint(session, bucket)
+    if (
+        checkpoint is None
+        or checkpoint["complete"]
+        or event.get("restart", False)
+    ):
+        tables = (
+            event.get("tables") or get_catalogue(conn).extractable_tables()
+        )
+        if "start" in event:
+            start = datetime.fromisoformat(event["start"])
+        else:
+            start = get_earliest_last_updated(tables, conn)
+            if start is None:
+                return {
+                    "success": "false",
+                    "message": "no new data",
+                    "complete": True,
+                }
+            start -= timedelta(microseconds=1)
+        end = datetime.fromisoformat(event.get("end", str(datetime.now())))
+        checkpoint = new_checkpoint(
+            start,
+            end,
+            timedelta(days=float(event.get("chunk_days", DEFAULT_CHUNK_DAYS))),
+            tables,
+            event.get("folder", ORIGINAL_DATA_DUMP),
+            os.environ.get("INGESTION_FORMAT", "csv"),
+            os.environ.get("INGESTION_COMPRESSION") or None,
+        )
+        logger.info(
+            f"Starting backfill of {', '.join(tables)} from {start} to {end}"
+        )
+    else:
+        logger.info(f"Resuming backfill from {CHECKPOINT_KEY}")
+
+    chunks = get_backfill_chunks(
+        datetime.fromisoformat(checkpoint["start"]),
+        datetime.fromisoformat(checkpoint["end"]),
+        timedelta(seconds=checkpoint["chunk_seconds"]),
+    )
+    pending = [
+        (table, number, chunk)
+        for table in checkpoint["tables"]
+        for number, chunk in enumerate(chunks)
+        if str(number) not in checkpoint["chunks"][table]
+    ]
+
+    chunk_seconds = []
+
+    def extract_chunk(table: str, number: int, chunk: tuple) -> dict:
+        longest = max(chunk_seconds, default=0.0)
+        if deadline is not None and time.monotonic() + longest > deadline:
+            return None
+        key = get_ingestion_key(
+            checkpoint["folder"],
+            table,
+            checkpoint["format"],
+            checkpoint["compression"],
+            number,
+        )
+        start = time.monotonic()
+        try:
+            return extract_slice_to_s3(
+                session,
+                table,
+                bucket,
+                key,
+                watermark=chunk[0],
+                upper_bound=chunk[1],
+                file_format=checkpoint["format"],
+                compression=checkpoint["compression"],
+            )
+        finally:
+            chunk_seconds.append(time.monotonic() - start)
+
+    failures = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(extract_chunk, table, number, chunk): (
+                table,
+                number,
+            )
+            for table, number, chunk in pending
+        }
+        for future in as_completed(futures):
+            table, number = futures[future]
+            try:
+                response = future.result()
+            except Exception as error:
+                logger.error(f"{table} chunk {number} failed: {error}")
+                response = {"success": False, "message": str(error)}
+            if response is None:
+                continue
+            record_chunk_result(checkpoint, table, number, response)
+            if response["success"] or response["message"] == "no new data":
+                write_checkpoint(session, bucket, checkpoint)
+            else:
+                failures.append(
+                    f"{table} chunk {number}: {response['message']}"
+                )
+
+    remaining = sum(
+        str(number) not in checkpoint["chunks"][table]
+        for table in checkpoint["tables"]
+        for number in range(len(chunks))
+    )
+    if remaining == 0:
+        finish_response = finish_backfill(session, bucket, checkpoint, conn)
+        if not finish_response["success"]:
+            return {
+                "success": "false",
+                "message": finish_response["message"],
+                "complete": False,
+            }
+        checkpoint["complete"] = True
+    write_checkpoint(session, bucket, checkpoint)
+
+    if failures:
+        logger.info(f"Chunks not extracted: {'; '.join(failures)}")
+        return {"success": "false", "message": failures[0], "complete": False}
+    if remaining:
+        message = f"{remaining} chunks left, invoke again to resume"
+    else:
+        message = "backfill complete"
+    logger.info(message)
+    return {"success": "true", "message": message, "complete": remaining == 0}
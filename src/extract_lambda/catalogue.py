@@ -0,0 +1,162 @@
+from src.extract_lambda.connection import connect_to_db
+from pg8000.native import Connection
+from fnmatch import fnmatchcase
+import logging
+import os
+import re
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+CATALOGUE_TTL_SECONDS = int(
+    os.environ.get("EXTRACT_CATALOGUE_TTL_SECONDS", 3600)
+)
+SYSTEM_TABLE_REGEX = re.compile("(^pg_)|(^sql_)|(^_)")
+CATALOGUE_QUERY = """SELECT c.TABLE_NAME, c.COLUMN_NAME, c.DATA_TYPE,
+k.COLUMN_NAME IS NOT NULL AS IS_PRIMARY_KEY
+FROM INFORMATION_SCHEMA.COLUMNS c
+JOIN INFORMATION_SCHEMA.TABLES t
+ON t.TABLE_SCHEMA = c.TABLE_SCHEMA AND t.TABLE_NAME = c.TABLE_NAME
+LEFT JOIN INFORMATION_SCHEMA.TABLE_CONSTRAINTS tc
+ON tc.TABLE_SCHEMA = c.TABLE_SCHEMA AND tc.TABLE_NAME = c.TABLE_NAME
+AND tc.CONSTRAINT_TYPE = 'PRIMARY KEY'
+LEFT JOIN INFORMATION_SCHEMA.KEY_COLUMN_USAGE k
+ON k.CONSTRAINT_SCHEMA = tc.CONSTRAINT_SCHEMA
+AND k.CONSTRAINT_NAME = tc.CONSTRAINT_NAME
+AND k.COLUMN_NAME = c.COLUMN_NAME
+WHERE t.TABLE_TYPE = 'BASE TABLE'
+ORDER BY c.TABLE_NAME, c.ORDINAL_POSITION;"""
+
+cached_catalogue = None
+catalogue_lock = threading.Lock()
+
+
+class SchemaCatalogue:
+    """Table and column metadata for the Totesys database, read with a
+    single INFORMATION_SCHEMA query. System tables (names starting with pg_,
+    sql_ or _) are left out, so the catalogue doubles as the whitelist of
+    table names that may be used in a query.
+
+    Args:
+        rows: list of (table name, column name, data type, is primary key)
+        rows in column order, as returned by CATALOGUE_QUERY
+        ttl: number of seconds the catalogue is considered fresh for
+    """
+
+    def __init__(self, rows: list, ttl: int = CATALOGUE_TTL_SECONDS):
+        self.ttl = ttl
+        self.loaded_at = time.monotonic()
+        self.table_columns = {}
+        self.primary_keys = {}
+        for table, column, data_type, is_primary_key in rows:
+            if SYSTEM_TABLE_REGEX.search(table):
+                continue
+            self.table_columns.setdefault(table, {})[column] = data_type
+            if is_primary_key:
+                self.primary_keys.setdefault(table, []).append(column)
+
+    @classmethod
+    def load(
+        cls, conn: Connection, ttl: int = CATALOGUE_TTL_SECONDS
+    ) -> "SchemaCatalogue":
+        """Reads the catalogue from the database using the given connection"""
+        rows = conn.run(CATALOGUE_QUERY)
+        logger.info("Totesys schema catalogue loaded")
+        return cls(rows, ttl)
+
+    @property
+    def tables(self) -> list:
+        """Sorted list of table names in the catalogue"""
+        return sorted(self.table_columns)
+
+    def has_table(self, table: str) -> bool:
+        return table in self.table_columns
+
+    def columns(self, table: str) -> list:
+        """Column names of a table in the order they are defined
+
+        Raises:
+            KeyError: if the table is not in the catalogue
+        """
+        return list(self.table_columns[table])
+
+    def column_types(self, table: str) -> dict:
+        """Dictionary of column name to Postgres data type for a table
+
+        Raises:
+            KeyError: if the table is not in the catalogue
+        """
+        return dict(self.table_columns[table])
+
+    def primary_key(self, table: str) -> list:
+        """Names of the primary key columns of a table, empty if it has none"""
+        return list(self.primary_keys.get(table, []))
+
+    def extractable_tables(
+        self, include: list = None, exclude: list = None
+    ) -> list:
+        """Sorted list of the tables the extract lambda can read, those with
+        a last_updated column, filtered by include and exclude rules. A rule
+        is a table name or a shell-style pattern such as payment*. A table
+        is kept if it matches an include rule (every table matches if there
+        are none) and doesn't match any exclude rule.
+
+        Args:
+            include: optional, list of rules a table must match one of
+            exclude: optional, list of rules a table must not match
+
+        Returns:
+            A sorted list of table names
+        """
+        return [
+            table
+            for table in self.tables
+            if "last_updated" in self.table_columns[table]
+            and (
+                not include
+                or any(fnmatchcase(table, rule) for rule in include)
+            )
+            and not any(fnmatchcase(table, rule) for rule in exclude or [])
+        ]
+
+    def is_stale(self) -> bool:
+        return time.monotonic() - self.loaded_at > self.ttl
+
+
+def get_catalogue(
+    conn: Connection = None, ttl: int = CATALOGUE_TTL_SECONDS
+) -> SchemaCatalogue:
+    """Returns the schema catalogue cached by this Lambda container, loading
+    it if there is none yet or the cached one is older than its TTL. The
+    database is only queried when the catalogue needs loading.
+
+    Args:
+        conn: optional, an open pg8000 connection used if the catalogue needs
+        loading. If not given a new connection is opened and closed again
+        ttl: number of seconds a newly loaded catalogue stays fresh for
+
+    Returns:
+        A SchemaCatalogue for the Totesys database
+    """
+    global cached_catalogue
+    with catalogue_lock:
+        if cached_catalogue is None or cached_catalogue.is_stale():
+            if conn is None:
+                new_conn = connect_to_db()
+                try:
+                    cached_catalogue = SchemaCatalogue.load(new_conn, ttl)
+                finally:
+                    new_conn.close()
+            else:
+                cached_catalogue = SchemaCatalogue.load(conn, ttl)
+        return cached_catalogue
+
+
+def invalidate_catalogue() -> None:
+    """Forgets the cached catalogue so the next get_catalogue call reloads
+    it, e.g. after a table has been added to the database"""
+    global cached_catalogue
+    with catalogue_lock:
+        cached_catalogue = None
@@ -0,0 +1,342 @@
+from src.extract_lambda.catalogue import get_catalogue
+from src.extract_lambda.utils import (
+    write_csv_to_s3,
+    get_ingestion_key,
+    get_last_updated_range,
+)
+from pg8000.exceptions import DatabaseError
+from pg8000.native import Connection
+import boto3
+import logging
+import re
+import time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+CDC_SLOT = "blackwater_cdc"
+CDC_PLUGIN = "test_decoding"
+CDC_MAX_CHANGES = 100000
+OPERATION_COLUMN = "cdc_operation"
+LSN_COLUMN = "cdc_lsn"
+CHANGE_REGEX = re.compile(
+    r"^table (?P<table>\S+): (?P<operation>INSERT|UPDATE|DELETE): "
+    r"(?P<columns>.*)$",
+    re.DOTALL,
+)
+COLUMN_REGEX = re.compile(
+    r"(?P<name>[^\s\[]+)\[(?P<type>[^\]]+)\]:(?P<value>'(?:[^']|'')*'|\S+)"
+)
+UNCHANGED_TOAST = "unchanged-toast-datum"
+
+
+def ensure_replication_slot(conn: Connection, slot: str = CDC_SLOT) -> bool:
+    """Creates the logical replication slot the CDC source reads from, if it
+    doesn't exist yet. Postgres keeps every change made after the slot is
+    created until it is consumed, so the slot is created before the original
+    data dump is read.
+
+    Args:
+        conn: an open pg8000 connection, to a database with wal_level set to
+        logical and a user with the REPLICATION attribute
+        slot: optional, name of the replication slot
+
+    Returns:
+        True if the slot was created, False if it already existed
+    """
+    exists = conn.run(
+        "SELECT 1 FROM pg_replication_slots WHERE slot_name = :slot;",
+        slot=slot,
+    )
+    if exists:
+        return False
+    conn.run(
+        "SELECT pg_create_logical_replication_slot(:slot, :plugin);",
+        slot=slot,
+        plugin=CDC_PLUGIN,
+    )
+    logger.info(f"Created logical replication slot {slot}")
+    return True
+
+
+def read_slot_changes(
+    conn: Connection, slot: str = CDC_SLOT, max_changes: int = CDC_MAX_CHANGES
+) -> list:
+    """Reads the pending changes from the replication slot without consuming
+    them, so nothing is lost if writing them to S3 fails. Postgres finishes
+    the transaction the last change belongs to, so a transaction is never
+    split across runs.
+
+    Args:
+        conn: an open pg8000 connection
+        slot: optional, name of the replication slot
+        max_changes: optional, rough limit on the number of changes read
+
+    Returns:
+        A list of (lsn, data) tuples, data being the test_decoding output
+    """
+    rows = conn.run(
+        "SELECT lsn::text, data FROM "
+        "pg_logical_slot_peek_changes(:slot, NULL, :max_changes);",
+        slot=slot,
+        max_changes=max_changes,
+    )
+    return [tuple(row) for row in rows]
+
+
+def advance_slot(conn: Connection, lsn: str, slot: str = CDC_SLOT) -> None:
+    """Consumes the changes in the replication slot up to and including an
+    LSN, once they have been written to S3"""
+    conn.run(
+        "SELECT pg_replication_slot_advance(:slot, CAST(:lsn AS pg_lsn));",
+        slot=slot,
+        lsn=lsn,
+    )
+
+
+def get_lsn_value(lsn: str) -> int:
+    """Converts an LSN in its text form (e.g. 16/B374D848) to an integer,
+    so LSNs can be compared"""
+    high, _, low = lsn.partition("/")
+    return (int(high, 16) << 32) + int(low, 16)
+
+
+def parse_value(value: str, data_type: str):
+    """Converts a value from the test_decoding output to what the polling
+    extract writes to CSV: quoted text is unquoted, null is None and
+    booleans are True or False. Other values are left as Postgres text,
+    which is how they appear in the CSV files anyway.
+    """
+    if value.startswith("'"):
+        return value[1:-1].replace("''", "'")
+    if value == "null":
+        return None
+    if data_type == "boolean":
+        return value == "true"
+    return value
+
+
+def parse_columns(text: str) -> dict:
+    """Parses the name[type]:value list of a test_decoding change into a
+    dictionary of column name to value. Unchanged TOAST values are left out,
+    as their value isn't in the change."""
+    columns = {}
+    for match in COLUMN_REGEX.finditer(text):
+        if match["value"] == UNCHANGED_TOAST:
+            continue
+        name = match["name"].strip('"')
+        columns[name] = parse_value(match["value"], match["type"])
+    return columns
+
+
+def parse_change(data: str) -> dict:
+    """Parses one line of test_decoding output, e.g.
+    table public.staff: UPDATE: staff_id[integer]:1 first_name[text]:'Jo'
+
+    Args:
+        data: the data column of pg_logical_slot_peek_changes
+
+    Returns:
+        A dictionary containing table (without the schema), operation
+        (INSERT, UPDATE or DELETE), columns (column name to value) and
+        old_key (the previous key columns of an UPDATE that changed the
+        key, otherwise None), or None for BEGIN, COMMIT and other messages
+    """
+    match = CHANGE_REGEX.match(data)
+    if match is None:
+        return None
+    table = match["table"].split(".")[-1].strip('"')
+    text = match["columns"]
+    old_key = None
+    if text.startswith("old-key: "):
+        old_text, _, text = text[len("old-key: ") :].partition(" new-tuple: ")
+        old_key = parse_columns(old_text)
+    return {
+        "table": table,
+        "operation": match["operation"],
+        "columns": parse_columns(text),
+        "old_key": old_key,
+    }
+
+
+def get_change_rows(changes: list, primary_keys: dict = None) -> dict:
+    """Turns the changes read from the slot into rows for the ingestion
+    files. Each row holds the table's columns plus cdc_operation and
+    cdc_lsn. A DELETE becomes a delete marker holding only the key columns.
+    Where a table's primary key is known only the last change of each row is
+    kept, so a row updated several times between runs is written once, as
+    the polling extract would.
+
+    Args:
+        changes: list of (lsn, data) tuples from read_slot_changes
+        primary_keys: optional, dictionary of table name to its primary key
+        columns
+
+    Returns:
+        A dictionary of table name to a list of row dictionaries
+    """
+    primary_keys = primary_keys or {}
+    tables = {}
+    for position, (lsn, data) in enumerate(changes):
+        change = parse_change(data)
+        if change is None:
+            continue
+        rows = tables.setdefault(change["table"], {})
+        key_columns = primary_keys.get(change["table"])
+        if change["old_key"] is not None:
+            marker = dict(change["old_key"])
+            marker.update({OPERATION_COLUMN: "DELETE", LSN_COLUMN: lsn})
+            add_change_row(rows, marker, key_columns, position)
+        row = dict(change["columns"])
+        row.update({OPERATION_COLUMN: change["operation"], LSN_COLUMN: lsn})
+        add_change_row(rows, row, key_columns, position)
+    return {table: list(rows.values()) for table, rows in tables.items()}
+
+
+def add_change_row(
+    rows: dict, row: dict, key_columns: list, position: int
+) -> None:
+    """Adds a change row to a table's rows, replacing the earlier change of
+    the same primary key (moving it to the end, in change order). Rows
+    without a known key are identified by their position in the slot, so
+    every change is kept."""
+    if key_columns and all(column in row for column in key_columns):
+        row_id = tuple(row[column] for column in key_columns)
+    else:
+        row_id = ("position", position, row[OPERATION_COLUMN])
+    rows.pop(row_id, None)
+    rows[row_id] = row
+
+
+def get_row_columns(rows: list, columns: list = None) -> list:
+    """Returns the column order of a table's change rows: the columns from
+    the schema catalogue if known, then any others in the order they were
+    seen, then cdc_operation and cdc_lsn"""
+    ordered = list(columns or [])
+    for row in rows:
+        for column in row:
+            if column not in ordered and column not in (
+                OPERATION_COLUMN,
+                LSN_COLUMN,
+            ):
+                ordered.append(column)
+    return ordered + [OPERATION_COLUMN, LSN_COLUMN]
+
+
+def extract_changes_to_s3(
+    session: boto3.session.Session,
+    bucket: str,
+    folder: str,
+    table_list: list,
+    conn: Connection,
+    slot: str = CDC_SLOT,
+    max_changes: int = CDC_MAX_CHANGES,
+    compression: str = None,
+    table_lsns: dict = None,
+) -> dict:
+    """Extracts the changes in the logical replication slot to the same
+    per-table CSV files the polling extract writes, with cdc_operation and
+    cdc_lsn columns added and deletes written as delete markers.
+
+    Each table's response carries the LSN its changes have been written up
+    to (cdc_lsn), which the handler keeps in the run state. Changes at or
+    before a table's LSN in table_lsns are not written again, and the slot
+    is only advanced as far as every table has got. So if one table fails,
+    the next run reads the slot from the same place but only writes the
+    failed table's changes again.
+
+    Args:
+        session: Boto3 session
+        bucket: ingestion bucket name as a string
+        folder: ingestion zone folder to write to
+        table_list: tables to write; changes to other tables are consumed
+        but not written
+        conn: an open pg8000 connection
+        slot: optional, name of the replication slot
+        max_changes: optional, rough limit on the number of changes read
+        compression: optional, compression codec passed to write_csv_to_s3
+        table_lsns: optional, dictionary of table name to the LSN its
+        changes were written up to by earlier runs (None if not known)
+
+    Returns:
+        A dictionary keyed by table name, each value the response of
+        write_csv_to_s3 with the number of rows written, their last_updated
+        range and cdc_lsn added, or a "no new data" or error response with
+        cdc_lsn added
+    """
+    table_lsns = table_lsns or {}
+    start = time.perf_counter()
+    try:
+        changes = read_slot_changes(conn, slot, max_changes)
+    except DatabaseError as de:
+        logger.error(f"Reading replication slot {slot} failed: {de}")
+        message = f"replication slot {slot} could not be read"
+        return {
+            table: {
+                "success": False,
+                "message": message,
+                "cdc_lsn": table_lsns.get(table),
+            }
+            for table in table_list
+        }
+    query_seconds = time.perf_counter() - start
+    catalogue = get_catalogue(conn)
+    primary_keys = {
+        table: catalogue.primary_key(table)
+        for table in table_list
+        if catalogue.has_table(table)
+    }
+    table_rows = get_change_rows(changes, primary_keys)
+    ignored = set(table_rows) - set(table_list)
+    if ignored:
+        logger.info(f"Changes not extracted: {', '.join(sorted(ignored))}")
+    last_lsn = changes[-1][0] if changes else None
+
+    results = {}
+    for table in table_list:
+        written_lsn = table_lsns.get(table)
+        rows = [
+            row
+            for row in table_rows.get(table, [])
+            if written_lsn is None
+            or get_lsn_value(row[LSN_COLUMN]) > get_lsn_value(written_lsn)
+        ]
+        if not rows:
+            results[table] = {
+                "success": False,
+                "message": "no new data",
+                "rows_fetched": 0,
+                "timings": {"query": query_seconds},
+                "cdc_lsn": last_lsn or written_lsn,
+            }
+            continue
+        columns = get_row_columns(
+            rows,
+            catalogue.columns(table) if catalogue.has_table(table) else None,
+        )
+        data = [
+            {column: row.get(column) for column in columns} for row in rows
+        ]
+        key = get_ingestion_key(folder, table, "csv", compression)
+        response = write_csv_to_s3(
+            session, data, bucket, key, compression=compression
+        )
+        response["rows_fetched"] = len(rows)
+        if response["success"]:
+            response["rows"] = len(rows)
+            response["min_last_updated"], response["max_last_updated"] = (
+                get_last_updated_range(row.get("last_updated") for row in rows)
+            )
+            response["timings"]["query"] = query_seconds
+            response["cdc_lsn"] = last_lsn
+        else:
+            response["cdc_lsn"] = written_lsn
+        results[table] = response
+
+    reached = [response["cdc_lsn"] for response in results.values()]
+    if changes and None not in reached:
+        lsn = min(reached, key=get_lsn_value)
+        if get_lsn_value(lsn) >= get_lsn_value(changes[0][0]):
+            advance_slot(conn, lsn, slot)
+            logger.info(f"Changes up to {lsn} consumed from {slot}")
+    return results
@@ -1,19 +1,159 @@
-from pg8000.native import Connection
-from src.extract_lambda.credentials_manager import get_secret
+from pg8000.native import Connection, DatabaseError, InterfaceError
+from src.extract_lambda.credentials_manager import get_credentials
+import logging
+import os
+import threading
+import time
 
-creds = get_secret()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
 
-user = creds["username"]
-password = creds["password"]
-database = creds["dbname"]
-host = creds["host"]
-port = creds["port"]
+AUTH_FAILURE_CODES = {"28000", "28P01"}
+
+MAX_CONNECTIONS = int(os.environ.get("EXTRACT_MAX_CONNECTIONS", 8))
+MAX_IDLE_CONNECTIONS = 4
+
+cached_connection = None
+connection_pool = []
+pool_lock = threading.Lock()
+connection_slots = threading.BoundedSemaphore(MAX_CONNECTIONS)
 
 
 def connect_to_db() -> Connection:
     """Returns a pg8000 database connection using credentials for the Totesys
-    database obtained from AWS SecretsManager via the get_secret function"""
+    database obtained from AWS SecretsManager via get_credentials. The
+    credentials are fetched on first use and cached, so importing this module
+    doesn't call SecretsManager. If the database rejects the cached
+    credentials they are fetched again and the connection retried once, in
+    case the password has been rotated."""
+
+    try:
+        return connect_with(get_credentials())
+    except DatabaseError as de:
+        if not is_auth_failure(de):
+            raise
+        logger.info("Totesys database rejected credentials, refreshing")
+        return connect_with(get_credentials(force_refresh=True))
 
+
+def connect_with(creds: dict) -> Connection:
+    """Opens a pg8000 connection using a dictionary of credentials"""
     return Connection(
-        user=user, password=password, database=database, port=port, host=host
+        user=creds["username"],
+        password=creds["password"],
+        database=creds["dbname"],
+        port=creds["port"],
+        host=creds["host"],
     )
+
+
+def is_auth_failure(error: DatabaseError) -> bool:
+    """Checks whether a DatabaseError is Postgres rejecting the login"""
+    details = error.args[0] if error.args else None
+    return isinstance(details, dict) and details.get("C") in AUTH_FAILURE_CODES
+
+
+def is_alive(conn: Connection) -> bool:
+    """Checks a connection is still usable by running a cheap query"""
+    try:
+        conn.run("SELECT 1;")
+        return True
+    except (DatabaseError, InterfaceError):
+        return False
+
+
+def open_connection() -> Connection:
+    """Opens a new connection with connect_to_db and logs how long the
+    connection took to set up"""
+    start = time.perf_counter()
+    conn = connect_to_db()
+    setup_time = time.perf_counter() - start
+    logger.info(f"Totesys database connection set up in {setup_time:.3f}s")
+    return conn
+
+
+def quietly_close(conn: Connection) -> None:
+    """Closes a connection, ignoring errors from one that has dropped"""
+    try:
+        conn.close()
+    except (DatabaseError, InterfaceError):
+        pass
+
+
+def get_connection() -> Connection:
+    """Returns the connection held by this Lambda container, so a warm
+    invocation reuses the connection opened by a previous one. The cached
+    connection is checked with a cheap query first and replaced with a new
+    one if it has been dropped. The time taken to set up a new connection is
+    logged.
+
+    Returns:
+        A live pg8000 connection to the Totesys database
+    """
+    global cached_connection
+    if cached_connection is not None:
+        if is_alive(cached_connection):
+            logger.info("Reusing existing Totesys database connection")
+            return cached_connection
+        logger.info("Totesys database connection lost, reconnecting")
+        close_connection()
+
+    cached_connection = open_connection()
+    return cached_connection
+
+
+def close_connection() -> None:
+    """Closes the cached connection, if there is one, and forgets it"""
+    global cached_connection
+    if cached_connection is not None:
+        quietly_close(cached_connection)
+        cached_connection = None
+
+
+def acquire_connection(blocking: bool = True) -> Connection:
+    """Takes a connection from the pool held by this Lambda container, for
+    use by a single worker thread. pg8000 connections can't be shared
+    between threads, so each concurrent worker needs its own. At most
+    MAX_CONNECTIONS pooled connections are in use at once, across every
+    worker of the run (the connection from get_connection isn't counted).
+    Dropped connections are discarded and a new one is opened if the pool
+    is empty. Connections should be handed back with release_connection.
+
+    Args:
+        blocking: optional, if False None is returned straight away when
+        MAX_CONNECTIONS connections are already in use, instead of waiting
+        for one to be released. Used by nested workers, which could
+        otherwise wait on connections held by their own callers
+
+    Returns:
+        A live pg8000 connection to the Totesys database, or None
+    """
+    if not connection_slots.acquire(blocking=blocking):
+        return None
+    try:
+        while True:
+            with pool_lock:
+                if not connection_pool:
+                    break
+                conn = connection_pool.pop()
+            if is_alive(conn):
+                return conn
+            logger.info("Pooled Totesys database connection lost, discarding")
+            quietly_close(conn)
+        return open_connection()
+    except BaseException:
+        connection_slots.release()
+        raise
+
+
+def release_connection(conn: Connection) -> None:
+    """Hands a connection taken with acquire_connection back to the pool so
+    later workers and warm invocations can reuse it. At most
+    MAX_IDLE_CONNECTIONS are kept, and any others are closed."""
+    with pool_lock:
+        keep = len(connection_pool) < MAX_IDLE_CONNECTIONS
+        if keep:
+            connection_pool.append(conn)
+    if not keep:
+        quietly_close(conn)
+    connection_slots.release()
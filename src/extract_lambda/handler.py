@@ -1,11 +1,50 @@
 from src.extract_lambda.utils import (
-    write_csv_to_s3,
     update_data_in_bucket,
+    update_tables_in_parallel,
+    get_ingestion_key,
+    probe_table_changes,
+    begin_snapshot,
+    end_snapshot,
+    run_in_savepoint,
+    update_tables_in_snapshot,
 )
+from src.extract_lambda.connection import get_connection
+from src.extract_lambda.catalogue import get_catalogue
+from src.extract_lambda.metrics import put_table_metrics, put_run_metrics
+from src.extract_lambda.manifest import (
+    new_manifest,
+    record_table_manifest,
+    write_manifest,
+)
+from src.extract_lambda.cdc import (
+    ensure_replication_slot,
+    extract_changes_to_s3,
+    CDC_SLOT,
+)
+from src.extract_lambda.schedule import (
+    record_table_schedule,
+    is_table_due,
+    get_next_suggested_run,
+    SCHEDULE_TOLERANCE,
+)
+from src.extract_lambda.run_state import (
+    read_run_state,
+    new_run_state,
+    get_table_watermark,
+    get_table_lsn,
+    record_table_result,
+    failed_tables,
+    write_run_state,
+    ORIGINAL_DATA_DUMP,
+    FULL_EXTRACT_RUNTIME,
+)
+from botocore.exceptions import ClientError
 import boto3
 import logging
-from datetime import datetime
-from botocore.exceptions import ClientError
+import os
+import time
+from itertools import chain
+from datetime import datetime, timedelta
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -13,69 +52,308 @@ logger.setLevel(logging.INFO)
 session = boto3.session.Session(region_name="eu-west-2")
 
 
-def lambda_handler(event, context, session: boto3.session = None) -> dict:
+def lambda_handler(
+    event, context, session: boto3.session = None, max_workers: int = None
+) -> dict:
     """Lambda handler function to extract data from Totesys and write
-    to S3 ingestion zone
+    to S3 ingestion zone. Tables named in the comma separated
+    EXTRACT_STREAM_TABLES environment variable are streamed to S3 in batches
+    rather than loaded into memory. The file format (csv or parquet) and
+    compression are read from the INGESTION_FORMAT and INGESTION_COMPRESSION
+    environment variables.
+
+    The tables to extract are discovered from the cached schema catalogue:
+    every table with a last_updated column, filtered by the comma separated
+    rules (names or patterns such as payment*) in EXTRACT_INCLUDE_TABLES and
+    EXTRACT_EXCLUDE_TABLES. A new Totesys table is picked up without a
+    redeploy. On incremental runs a single change probe is run
+    first and tables with no rows updated since the last run are skipped.
+
+    Each table has its own watermark in the run state (run_state.json), which
+    only moves forward when the table is extracted successfully. A failed
+    table doesn't stop the others, and the next run re-reads only the rows
+    that table missed.
+
+    A manifest (manifest.json) is written to the run folder listing, for
+    each table, the files written with their sizes and checksums, the row
+    count, the columns and their types and the range of last_updated values,
+    so the transform and load lambdas can plan their work without listing
+    the bucket.
+
+    If EXTRACT_ADAPTIVE_SCHEDULE is "true", each table's change rate is
+    recorded in the run state along with when it should next be checked:
+    busy tables on every scheduled run, quiet ones less often but always
+    inside the EXTRACT_FRESHNESS_MINUTES target (30 by default). Only tables
+    that are due are probed, the run state holds the next suggested run, and
+    when no table is due the handler returns without connecting to the
+    database or writing anything.
+
+    If EXTRACT_SOURCE is "cdc", incremental runs read the changes from a
+    logical replication slot (EXTRACT_CDC_SLOT) instead of polling each
+    table on last_updated, so deletes are extracted as delete markers. The
+    slot is created before the original data dump is read. When an existing
+    deployment switches to CDC, the run that creates the slot still polls
+    from the stored watermarks, so changes made before the slot existed
+    aren't lost (a change made while it is created may be written twice).
+    Each table's position in the slot is kept in the run state, so after a
+    failed table only that table's changes are written again. CDC files are
+    always CSV, and the adaptive schedule isn't used with CDC because the
+    slot is read for every table at once.
+
+    CloudWatch Embedded Metric Format records are written for each table
+    (query latency, rows fetched and kept, serialisation and upload time and
+    bytes uploaded) and for the run as a whole, under Blackwater/Extract.
+
+    If the EXTRACT_SNAPSHOT environment variable is "true", every table is
+    read on one connection inside a single REPEATABLE READ, READ ONLY
+    transaction, so the tables in a run are consistent with each other. The
+    upper watermark of the run is then taken from the database clock.
+
+    Outside snapshot mode, tables named in EXTRACT_PARTITION_TABLES are split
+    into EXTRACT_PARTITIONS key ranges when they are read in full (the
+    original data dump or a new table), and the ranges are extracted
+    concurrently into part files.
 
     Args:
         Lambda function expects event and context, but are unused
         session: a Boto3 session (optional argument)
+        max_workers: optional, number of tables extracted concurrently. If
+        not given it is read from the EXTRACT_MAX_WORKERS environment
+        variable, defaulting to 1 (one table at a time)
 
     Returns:
         Dictionary containing a sucess message and details of what has been
         written to ingestion bucket.
     """
 
-    runtime_key = "last_ran_at.csv"
+    run_start = time.perf_counter()
     bucket = "blackwater-ingestion-zone"
-    table_list = [
-        "counterparty",
-        "currency",
-        "department",
-        "design",
-        "staff",
-        "sales_order",
-        "address",
-        "payment",
-        "purchase_order",
-        "payment_type",
-        "transaction",
-    ]
-
-    time_of_day = datetime.now()
+
+    if max_workers is None:
+        max_workers = int(os.environ.get("EXTRACT_MAX_WORKERS", 1))
+    stream_tables = os.environ.get("EXTRACT_STREAM_TABLES", "").split(",")
+    file_format = os.environ.get("INGESTION_FORMAT", "csv")
+    compression = os.environ.get("INGESTION_COMPRESSION") or None
+    snapshot = os.environ.get("EXTRACT_SNAPSHOT", "").lower() == "true"
+    partition_tables = os.environ.get("EXTRACT_PARTITION_TABLES", "")
+    partition_tables = partition_tables.split(",")
+    partitions = int(os.environ.get("EXTRACT_PARTITIONS", 1))
+    include_tables = os.environ.get("EXTRACT_INCLUDE_TABLES", "").split(",")
+    exclude_tables = os.environ.get("EXTRACT_EXCLUDE_TABLES", "").split(",")
+    source = os.environ.get("EXTRACT_SOURCE", "poll")
+    slot = os.environ.get("EXTRACT_CDC_SLOT", CDC_SLOT)
+    adaptive = os.environ.get("EXTRACT_ADAPTIVE_SCHEDULE", "") == "true"
+    adaptive = adaptive and source != "cdc"
+    freshness_target = timedelta(
+        minutes=int(os.environ.get("EXTRACT_FRESHNESS_MINUTES", 30))
+    )
 
     try:
-        get_previous_runtime = boto3.resource("s3").Object(bucket, runtime_key)
-        previous_lambda_runtime_uncut = (
-            get_previous_runtime.get()["Body"].read().decode("utf-8")
+        previous_state = read_run_state(session, bucket)
+    except ClientError as ce:
+        message = ce.response["Error"]["Message"]
+        logger.error(f"Run state could not be read: {message}")
+        return {"success": "false", "message": message}
+    next_run = get_next_suggested_run(previous_state) if adaptive else None
+    if next_run is not None and next_run > datetime.now() + (
+        SCHEDULE_TOLERANCE
+    ):
+        message = {
+            "success": "true",
+            "message": "no tables due",
+            "next_suggested_run": str(next_run),
+        }
+        logger.info(message)
+        return message
+
+    conn = get_connection()
+    slot_created = False
+    if source == "cdc":
+        slot_created = ensure_replication_slot(conn, slot)
+    cdc = source == "cdc" and previous_state is not None and not slot_created
+    if slot_created and previous_state is not None:
+        logger.info(
+            f"Replication slot {slot} is new, polling once more so changes "
+            "made before it was created aren't missed"
         )
-        previous_lambda_runtime = datetime.strptime(
-            previous_lambda_runtime_uncut[12:-2], "%Y-%m-%d %H:%M:%S.%f"
+    if cdc:
+        file_format = "csv"
+        snapshot = False
+
+    if snapshot:
+        time_of_day = begin_snapshot(conn)
+        logger.info(f"Extracting in one snapshot as of {time_of_day}")
+    else:
+        time_of_day = datetime.now()
+
+    table_list = get_catalogue(conn).extractable_tables(
+        include=[rule for rule in include_tables if rule],
+        exclude=[rule for rule in exclude_tables if rule],
+    )
+    if adaptive:
+        table_list = [
+            table
+            for table in table_list
+            if is_table_due(previous_state, table, time_of_day)
+        ]
+    logger.info(
+        f"Extracting {len(table_list)} tables: {', '.join(table_list)}"
+    )
+    if not table_list:
+        if snapshot:
+            end_snapshot(conn)
+        message = {"success": "true", "message": "no tables to extract"}
+        logger.info(message)
+        return message
+
+    folder = time_of_day if previous_state is not None else ORIGINAL_DATA_DUMP
+    state = new_run_state(time_of_day, folder, previous_state)
+    manifest = new_manifest(time_of_day, folder, file_format, compression)
+    watermarks = {
+        table: get_table_watermark(previous_state, table)
+        for table in table_list
+    }
+    runtimes = {
+        table: watermark or FULL_EXTRACT_RUNTIME
+        for table, watermark in watermarks.items()
+    }
+
+    changed_tables = table_list
+    probe_watermarks = {
+        table: watermark
+        for table, watermark in watermarks.items()
+        if watermark is not None and not cdc
+    }
+    changes = None
+    if probe_watermarks and snapshot:
+        changes = run_in_savepoint(
+            conn, probe_table_changes, probe_watermarks, time_of_day, conn
         )
-        if str(previous_lambda_runtime)[:4] == "1999":
-            previous_lambda_runtime = time_of_day
-    except ClientError:
-        previous_lambda_runtime = datetime(1999, 12, 31, 23, 59, 59, 99999)
-
-    for table in table_list:
-        key = f"{table}.csv"
-        response = update_data_in_bucket(
-            table, bucket, session, time_of_day, previous_lambda_runtime
+    elif probe_watermarks:
+        changes = probe_table_changes(probe_watermarks, time_of_day, conn=conn)
+    if changes is not None:
+        changed_tables = [
+            table
+            for table in table_list
+            if table not in changes or changes[table]["changed_rows"]
+        ]
+
+    skipped = (
+        (table, {"success": False, "message": "no new data"})
+        for table in table_list
+        if table not in changed_tables
+    )
+
+    if cdc:
+        results = extract_changes_to_s3(
+            session,
+            bucket,
+            folder,
+            table_list,
+            conn,
+            slot=slot,
+            compression=compression,
+            table_lsns={
+                table: get_table_lsn(previous_state, table)
+                for table in table_list
+            },
+        ).items()
+    elif snapshot:
+        results = update_tables_in_snapshot(
+            changed_tables,
+            bucket,
+            session,
+            time_of_day,
+            runtimes,
+            conn,
+            stream_tables=stream_tables,
+            file_format=file_format,
+            compression=compression,
+            folder=folder,
+        ).items()
+    elif max_workers > 1:
+        results = update_tables_in_parallel(
+            changed_tables,
+            bucket,
+            session,
+            time_of_day,
+            runtimes,
+            max_workers,
+            stream_tables=stream_tables,
+            file_format=file_format,
+            compression=compression,
+            folder=folder,
+            partition_tables=partition_tables,
+            partitions=partitions,
+        ).items()
+    else:
+        results = (
+            (
+                table,
+                update_data_in_bucket(
+                    table,
+                    bucket,
+                    session,
+                    time_of_day,
+                    runtimes[table],
+                    conn=conn,
+                    stream=table in stream_tables,
+                    file_format=file_format,
+                    compression=compression,
+                    folder=folder,
+                    partitions=(
+                        partitions if table in partition_tables else 1
+                    ),
+                ),
+            )
+            for table in changed_tables
         )
+    results = chain(skipped, results)
+
+    table_metrics = {}
+    for table, response in results:
+        key = get_ingestion_key(folder, table, file_format, compression)
         if response["success"]:
             logger.info(f"Extracting to S3 bucket: table: {table}, key: {key}")
         elif response["message"] == "no new data":
             logger.info("no new data to add " + table)
         else:
             logger.info(response["message"])
-            return {"success": "false", "message": response["message"]}
+        record_table_result(state, table, response, time_of_day)
+        if adaptive:
+            record_table_schedule(
+                state,
+                previous_state,
+                table,
+                watermarks[table],
+                time_of_day,
+                freshness_target,
+            )
+        table_metrics[table] = put_table_metrics(table, response)
+        column_types = {}
+        if response["success"]:
+            catalogue = get_catalogue(conn)
+            if catalogue.has_table(table):
+                column_types = catalogue.column_types(table)
+        record_table_manifest(manifest, table, response, column_types)
 
-    current_runtime = [{"last_ran_at": time_of_day}]
-    if previous_lambda_runtime < datetime(2000, 1, 1):
-        current_runtime = [{"last_ran_at": previous_lambda_runtime}]
-    write_csv_to_s3(
-        session=session, data=current_runtime, bucket=bucket, key=runtime_key
-    )
+    if adaptive:
+        next_run = get_next_suggested_run(state)
+        state["next_suggested_run"] = str(next_run) if next_run else None
+        logger.info(f"Next suggested run: {next_run}")
+
+    manifest_response = write_manifest(session, bucket, manifest)
+    if not manifest_response["success"]:
+        logger.info(manifest_response["message"])
+    write_response = write_run_state(session, bucket, state)
+    put_run_metrics(table_metrics, time.perf_counter() - run_start)
+    failures = failed_tables(state)
+    if failures:
+        message = state["tables"][failures[0]]["message"]
+        logger.info(f"Tables not extracted: {', '.join(failures)}")
+        return {"success": "false", "message": message}
+    if not write_response["success"]:
+        return {"success": "false", "message": write_response["message"]}
     message = {"success": "true", "message": response["message"]}
     logger.info(message)
     return message
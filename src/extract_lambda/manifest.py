@@ -0,0 +1,117 @@
+from botocore.exceptions import ClientError
+from datetime import datetime
+import boto3
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+MANIFEST_NAME = "manifest.json"
+
+
+def get_manifest_key(folder: str) -> str:
+    """Returns the S3 key of the manifest of a run, written alongside the
+    run's data in the ingestion zone
+
+    Args:
+        folder: the run folder, either a timestamp or original_data_dump
+
+    Returns:
+        The key as a string
+    """
+    return f"ingested_data/{folder}/{MANIFEST_NAME}"
+
+
+def new_manifest(
+    time_of_day: datetime,
+    folder: str,
+    file_format: str = "csv",
+    compression: str = None,
+) -> dict:
+    """Starts the manifest of the current run, with no tables in it yet
+
+    Args:
+        time_of_day: datetime of the current run
+        folder: ingestion zone folder the current run writes to
+        file_format: format the tables are written in, "csv" or "parquet"
+        compression: compression codec of the files, or None
+
+    Returns:
+        The manifest as a dictionary
+    """
+    return {
+        "extracted_at": str(time_of_day),
+        "folder": str(folder),
+        "format": file_format,
+        "compression": compression,
+        "tables": {},
+    }
+
+
+def record_table_manifest(
+    manifest: dict, table: str, response: dict, column_types: dict
+) -> None:
+    """Adds a table to the manifest of the current run: the files it was
+    written to (key, size in bytes and SHA-256 checksum of each), its row
+    count, its columns and their Postgres types and the range of
+    last_updated values written. Tables that had no new data or failed are
+    listed with no files and 0 rows, so downstream stages can skip them.
+
+    Args:
+        manifest: manifest of the current run, updated in place
+        table: table name as a string
+        response: dictionary returned by update_data_in_bucket
+        column_types: dictionary of column name to Postgres data type, in
+        column order, from the schema catalogue
+    """
+    if response["success"]:
+        status = "success"
+    elif response["message"] == "no new data":
+        status = "no new data"
+    else:
+        status = "failure"
+    min_last_updated = response.get("min_last_updated")
+    max_last_updated = response.get("max_last_updated")
+    manifest["tables"][table] = {
+        "status": status,
+        "rows": response.get("rows", 0) if response["success"] else 0,
+        "files": response.get("files", []) if response["success"] else [],
+        "columns": list(column_types),
+        "dtypes": dict(column_types),
+        "min_last_updated": (
+            str(min_last_updated) if min_last_updated is not None else None
+        ),
+        "max_last_updated": (
+            str(max_last_updated) if max_last_updated is not None else None
+        ),
+    }
+
+
+def write_manifest(
+    session: boto3.session.Session, bucket: str, manifest: dict
+) -> dict:
+    """Writes the manifest of a run to its folder in the ingestion bucket
+
+    Args:
+        session: Boto3 session (optional, a default client is used if None)
+        bucket: ingestion bucket name as a string
+        manifest: manifest as a dictionary
+
+    Returns:
+        A dictionary containing the following:
+            success: shows whether the function ran successfully
+            message: success message or error message
+    """
+    client = session.client("s3") if session else boto3.client("s3")
+    try:
+        client.put_object(
+            Bucket=bucket,
+            Key=get_manifest_key(manifest["folder"]),
+            Body=json.dumps(manifest, indent=2).encode("utf-8"),
+            ContentType="application/json",
+        )
+        return {"success": True, "message": "manifest written"}
+    except ClientError as c:
+        logger.error(f"Boto3 ClientError: {str(c)}")
+        return {"success": False, "message": c.response["Error"]["Message"]}
@@ -0,0 +1,142 @@
+import json
+import time
+
+NAMESPACE = "Blackwater/Extract"
+
+
+def get_emf_record(metrics: list, dimensions: dict) -> dict:
+    """Builds a CloudWatch Embedded Metric Format record. When the record is
+    written to the Lambda's log as a line of JSON, CloudWatch turns its
+    values into metrics without any log parsing.
+
+    Args:
+        metrics: list of (name, value, unit) tuples, e.g.
+        ("RowsKept", 120, "Count")
+        dimensions: dictionary of dimension name to value the metrics are
+        recorded against, e.g. {"Table": "staff"}
+
+    Returns:
+        The record as a dictionary
+    """
+    record = {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [
+                {
+                    "Namespace": NAMESPACE,
+                    "Dimensions": [list(dimensions)],
+                    "Metrics": [
+                        {"Name": name, "Unit": unit}
+                        for name, value, unit in metrics
+                    ],
+                }
+            ],
+        },
+    }
+    record.update(dimensions)
+    record.update({name: value for name, value, unit in metrics})
+    return record
+
+
+def put_metrics(metrics: list, dimensions: dict) -> None:
+    """Writes an EMF record to stdout. The logging module prefixes each line
+    with the level and request id, which CloudWatch can't parse as EMF, so
+    the record is printed instead.
+
+    Args:
+        metrics: list of (name, value, unit) tuples
+        dimensions: dictionary of dimension name to value
+    """
+    print(json.dumps(get_emf_record(metrics, dimensions)), flush=True)
+
+
+def get_table_metrics(response: dict) -> list:
+    """Works out the metrics of one table from its update_data_in_bucket
+    response: the query latency, the rows fetched from the database and the
+    rows kept (written to S3), the time spent serialising and uploading, the
+    bytes uploaded and whether the table failed. The watermark filter runs
+    in the database, so rows fetched and kept only differ when a table was
+    read but couldn't be written.
+
+    Args:
+        response: dictionary returned by update_data_in_bucket
+
+    Returns:
+        A list of (name, value, unit) tuples
+    """
+    timings = response.get("timings", {})
+    failed = not response["success"] and response["message"] != "no new data"
+    return [
+        ("QueryLatency", timings.get("query", 0.0) * 1000, "Milliseconds"),
+        ("RowsFetched", response.get("rows_fetched", 0), "Count"),
+        ("RowsKept", response.get("rows", 0), "Count"),
+        (
+            "SerialisationTime",
+            timings.get("serialise", 0.0) * 1000,
+            "Milliseconds",
+        ),
+        ("UploadTime", timings.get("upload", 0.0) * 1000, "Milliseconds"),
+        (
+            "UploadBytes",
+            sum(file["bytes"] for file in response.get("files", [])),
+            "Bytes",
+        ),
+        ("ExtractFailures", int(failed), "Count"),
+    ]
+
+
+def put_table_metrics(table: str, response: dict) -> list:
+    """Writes the metrics of one table as an EMF record with a Table
+    dimension
+
+    Args:
+        table: table name as a string
+        response: dictionary returned by update_data_in_bucket
+
+    Returns:
+        The metrics written, as a list of (name, value, unit) tuples
+    """
+    metrics = get_table_metrics(response)
+    put_metrics(metrics, {"Table": table})
+    return metrics
+
+
+def put_run_metrics(table_metrics: dict, run_seconds: float) -> None:
+    """Writes the metrics of a whole extract run as an EMF record with a
+    Stage dimension: the run duration, the number of tables extracted,
+    skipped (no new data) and failed, and the totals of the table metrics
+
+    Args:
+        table_metrics: dictionary of table name to the metrics returned by
+        put_table_metrics
+        run_seconds: time the run took in seconds
+    """
+    totals = {}
+    units = {}
+    for metrics in table_metrics.values():
+        for name, value, unit in metrics:
+            totals[name] = totals.get(name, 0) + value
+            units[name] = unit
+    values = [
+        {name: value for name, value, unit in metrics}
+        for metrics in table_metrics.values()
+    ]
+    metrics = [
+        ("RunDuration", run_seconds * 1000, "Milliseconds"),
+        (
+            "TablesExtracted",
+            sum(1 for value in values if value["RowsKept"]),
+            "Count",
+        ),
+        (
+            "TablesSkipped",
+            sum(
+                1
+                for value in values
+                if not value["RowsKept"] and not value["ExtractFailures"]
+            ),
+            "Count",
+        ),
+    ]
+    metrics += [(name, totals[name], units[name]) for name in totals]
+    put_metrics(metrics, {"Stage": "extract"})
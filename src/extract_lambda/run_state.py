@@ -0,0 +1,202 @@
+from botocore.exceptions import ClientError
+from datetime import datetime
+import boto3
+import csv
+import io
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+RUN_STATE_KEY = "run_state.json"
+LEGACY_RUNTIME_KEY = "last_ran_at.csv"
+ORIGINAL_DATA_DUMP = "original_data_dump"
+FULL_EXTRACT_RUNTIME = datetime(1999, 12, 31, 23, 59, 59, 99999)
+
+
+def read_run_state(session: boto3.session.Session, bucket: str) -> dict:
+    """Reads the run state written by the previous extract run. Buckets
+    written before the run state existed only hold last_ran_at.csv, so if
+    there is no run state the legacy runtime is converted into one.
+
+    Args:
+        session: Boto3 session (optional, a default client is used if None)
+        bucket: ingestion bucket name as a string
+
+    Returns:
+        The run state as a dictionary, or None if there has been no previous
+        run (so the original data dump is needed)
+
+    Raises:
+        ClientError if either file can't be read for any reason other than
+        not existing (access denied, throttling, S3 errors), so a failed
+        read never restarts the original data dump. Without s3:ListBucket
+        S3 reports a missing key as AccessDenied, so the extract role needs
+        it for the first run
+    """
+    client = session.client("s3") if session else boto3.client("s3")
+    try:
+        response = client.get_object(Bucket=bucket, Key=RUN_STATE_KEY)
+        return json.loads(response["Body"].read())
+    except ClientError as ce:
+        if ce.response["Error"]["Code"] != "NoSuchKey":
+            raise
+    try:
+        response = client.get_object(Bucket=bucket, Key=LEGACY_RUNTIME_KEY)
+    except ClientError as ce:
+        if ce.response["Error"]["Code"] != "NoSuchKey":
+            raise
+        return None
+    logger.info(f"No {RUN_STATE_KEY} found, converting {LEGACY_RUNTIME_KEY}")
+    return legacy_run_state(response["Body"].read().decode("utf-8"))
+
+
+def legacy_run_state(runtime_csv: str) -> dict:
+    """Builds a run state from the contents of last_ran_at.csv, with the
+    runtime used as the watermark of every table. A runtime from 1999 marks
+    the original data dump, which is treated as having no previous run.
+
+    Args:
+        runtime_csv: contents of last_ran_at.csv as a string
+
+    Returns:
+        The run state as a dictionary, or None if the file marks the
+        original data dump
+    """
+    rows = list(csv.DictReader(io.StringIO(runtime_csv)))
+    last_ran_at = datetime.fromisoformat(rows[0]["last_ran_at"])
+    if last_ran_at.year < 2000:
+        return None
+    return {
+        "last_ran_at": str(last_ran_at),
+        "folder": str(last_ran_at),
+        "default_watermark": str(last_ran_at),
+        "tables": {},
+    }
+
+
+def new_run_state(time_of_day: datetime, folder: str, state: dict) -> dict:
+    """Starts the run state of the current run, carrying over the table
+    entries of the previous one so tables that aren't extracted keep their
+    watermarks
+
+    Args:
+        time_of_day: datetime of the current run
+        folder: ingestion zone folder the current run writes to
+        state: run state of the previous run, or None
+
+    Returns:
+        The run state of the current run as a dictionary
+    """
+    new_state = {
+        "last_ran_at": str(time_of_day),
+        "folder": str(folder),
+        "tables": {},
+    }
+    if state is not None:
+        new_state["tables"] = dict(state["tables"])
+        if "default_watermark" in state:
+            new_state["default_watermark"] = state["default_watermark"]
+    return new_state
+
+
+def get_table_watermark(state: dict, table: str) -> datetime:
+    """Returns the high-water mark of a table, the upper bound of its last
+    successful extract
+
+    Args:
+        state: run state as a dictionary, or None
+        table: table name as a string
+
+    Returns:
+        The watermark as a datetime, or None if the table has never been
+        extracted (so the whole table is needed)
+    """
+    if state is None:
+        return None
+    table_state = state["tables"].get(table, {})
+    watermark = table_state.get("watermark", state.get("default_watermark"))
+    return datetime.fromisoformat(watermark) if watermark else None
+
+
+def get_table_lsn(state: dict, table: str) -> str:
+    """Returns the LSN a table's changes have been written up to by the CDC
+    source, or None if the table hasn't been extracted from the slot"""
+    if state is None:
+        return None
+    return state["tables"].get(table, {}).get("cdc_lsn")
+
+
+def record_table_result(
+    state: dict,
+    table: str,
+    response: dict,
+    upper_bound: datetime,
+) -> None:
+    """Records the result of extracting a table in the run state. The table's
+    watermark moves up to the upper bound of the run if it was extracted (or
+    had no new data), and is left where it was if the extract failed, so the
+    next run reads the missed rows again. A response from the CDC source
+    also carries the LSN the table has been written up to, which is kept
+    as cdc_lsn.
+
+    Args:
+        state: run state of the current run, updated in place
+        table: table name as a string
+        response: dictionary returned by update_data_in_bucket
+        upper_bound: datetime upper bound of the current run
+    """
+    previous = state["tables"].get(table, {})
+    if response["success"] or response["message"] == "no new data":
+        watermark = str(upper_bound)
+        status = "success" if response["success"] else "no new data"
+    else:
+        watermark = previous.get("watermark", state.get("default_watermark"))
+        status = "failure"
+    state["tables"][table] = {
+        "watermark": watermark,
+        "rows": response.get("rows", 0),
+        "status": status,
+        "message": response["message"],
+    }
+    if response.get("cdc_lsn") is not None:
+        state["tables"][table]["cdc_lsn"] = response["cdc_lsn"]
+
+
+def failed_tables(state: dict) -> list:
+    """Returns the names of the tables whose last extract failed"""
+    return [
+        table
+        for table, table_state in state["tables"].items()
+        if table_state["status"] == "failure"
+    ]
+
+
+def write_run_state(
+    session: boto3.session.Session, bucket: str, state: dict
+) -> dict:
+    """Writes the run state to the ingestion bucket as JSON
+
+    Args:
+        session: Boto3 session (optional, a default client is used if None)
+        bucket: ingestion bucket name as a string
+        state: run state as a dictionary
+
+    Returns:
+        A dictionary containing the following:
+            success: shows whether the function ran successfully
+            message: success message or error message
+    """
+    client = session.client("s3") if session else boto3.client("s3")
+    try:
+        client.put_object(
+            Bucket=bucket,
+            Key=RUN_STATE_KEY,
+            Body=json.dumps(state, indent=2).encode("utf-8"),
+            ContentType="application/json",
+        )
+        return {"success": True, "message": "run state written"}
+    except ClientError as c:
+        logger.error(f"Boto3 ClientError: {str(c)}")
+        return {"success": False, "message": c.response["Error"]["Message"]}
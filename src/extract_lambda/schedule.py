@@ -0,0 +1,127 @@
+from datetime import datetime, timedelta
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+SCHEDULE_INTERVAL = timedelta(minutes=5)
+FRESHNESS_TARGET = timedelta(minutes=30)
+SCHEDULE_TOLERANCE = timedelta(minutes=1)
+CHANGE_RATE_WEIGHT = 0.5
+
+
+def get_check_interval(
+    change_rate: float, freshness_target: timedelta = FRESHNESS_TARGET
+) -> timedelta:
+    """Works out how long to wait before a table is probed again, roughly
+    the time expected before its next change. Busy tables are checked on
+    every scheduled run and quiet ones as rarely as the freshness target
+    allows: a table is only looked at when the schedule fires, so a change
+    can wait up to one schedule interval longer than the check interval.
+
+    Args:
+        change_rate: changed rows per minute seen in the table
+        freshness_target: longest a change may wait before it is extracted
+
+    Returns:
+        The interval as a timedelta, between the schedule interval and the
+        freshness target less one schedule interval
+    """
+    longest = max(freshness_target - SCHEDULE_INTERVAL, SCHEDULE_INTERVAL)
+    if change_rate <= 0:
+        return longest
+    interval = timedelta(minutes=1 / change_rate)
+    return min(max(interval, SCHEDULE_INTERVAL), longest)
+
+
+def record_table_schedule(
+    state: dict,
+    previous_state: dict,
+    table: str,
+    watermark: datetime,
+    upper_bound: datetime,
+    freshness_target: timedelta = FRESHNESS_TARGET,
+) -> None:
+    """Records the change rate of a table and when it should next be checked
+    in its run state entry. The rate is the rows written per minute since
+    the table's previous watermark, smoothed with the rate from earlier runs
+    so a single busy or quiet run doesn't swing the schedule. Tables that
+    failed, or were read in full so have no rate yet, are checked again on
+    the next scheduled run.
+
+    Args:
+        state: run state of the current run, updated in place (the table
+        must already have been recorded with record_table_result)
+        previous_state: run state of the previous run, or None
+        table: table name as a string
+        watermark: lower bound the table was extracted from, or None if it
+        was read in full
+        upper_bound: datetime upper bound of the current run
+        freshness_target: longest a change may wait before it is extracted
+    """
+    table_state = state["tables"][table]
+    previous = (previous_state or {}).get("tables", {}).get(table, {})
+    change_rate = previous.get("change_rate")
+    next_check = upper_bound
+    if table_state["status"] != "failure" and watermark is not None:
+        minutes = (upper_bound - watermark).total_seconds() / 60
+        if minutes > 0:
+            rate = table_state["rows"] / minutes
+            if change_rate is not None:
+                rate = (
+                    CHANGE_RATE_WEIGHT * rate
+                    + (1 - CHANGE_RATE_WEIGHT) * change_rate
+                )
+            change_rate = rate
+            next_check = upper_bound + get_check_interval(
+                change_rate, freshness_target
+            )
+    table_state["change_rate"] = change_rate
+    table_state["next_check"] = str(next_check)
+
+
+def is_table_due(state: dict, table: str, time_of_day: datetime) -> bool:
+    """Checks whether a table should be probed on the current run. The
+    schedule doesn't fire at exactly the same second each time, so a check
+    due within SCHEDULE_TOLERANCE of the run is made now rather than a whole
+    schedule interval later.
+
+    Args:
+        state: run state of the previous run, or None
+        table: table name as a string
+        time_of_day: datetime of the current run
+
+    Returns:
+        False if the table's next check is still in the future, otherwise
+        True (including tables with no schedule yet)
+    """
+    if state is None:
+        return True
+    next_check = state["tables"].get(table, {}).get("next_check")
+    if next_check is None:
+        return True
+    return datetime.fromisoformat(next_check) <= time_of_day + (
+        SCHEDULE_TOLERANCE
+    )
+
+
+def get_next_suggested_run(state: dict) -> datetime:
+    """Returns when the extract next needs to run: the earliest next check
+    of the tables in the run state
+
+    Args:
+        state: run state as a dictionary, or None
+
+    Returns:
+        The next suggested run as a datetime, or None if some table has no
+        schedule yet (so the next scheduled run should go ahead)
+    """
+    if not state or not state["tables"]:
+        return None
+    next_checks = [
+        table_state.get("next_check")
+        for table_state in state["tables"].values()
+    ]
+    if None in next_checks:
+        return None
+    return min(datetime.fromisoformat(check) for check in next_checks)
@@ -1,50 +1,223 @@
-from src.extract_lambda.connection import connect_to_db
+from src.extract_lambda.connection import (
+    connect_to_db,
+    acquire_connection,
+    release_connection,
+)
+from src.extract_lambda.catalogue import get_catalogue, invalidate_catalogue
 from botocore.exceptions import ClientError
 from pg8000.exceptions import DatabaseError
+from pg8000.native import Connection
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from decimal import Decimal
+from typing import TYPE_CHECKING
 
 import boto3
+import csv
+import hashlib
+import io
 import logging
-import pandas as pd
 import re
-import awswrangler as wr
+import time
+import zlib
+
+if TYPE_CHECKING:
+    import pandas as pd
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+STREAM_BATCH_SIZE = 10000
+STREAM_PART_SIZE = 8 * 1024 * 1024
+CSV_COMPRESSION_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+PARTITION_INTEGER_TYPES = {"smallint", "integer", "bigint"}
+COPY_TIMESTAMP_FORMAT = "YYYY-MM-DD HH24:MI:SS.MS"
+
 
-def convert_table_to_dict(table: str) -> dict:
-    """Queries the Totesys database given a table name.
+def convert_table_to_dict(
+    table: str,
+    watermark: datetime = None,
+    upper_bound: datetime = None,
+    conn: Connection = None,
+    partition: tuple = None,
+) -> dict:
+    """Queries the Totesys database given a table name. If a watermark is
+    passed only rows updated since the watermark are returned, so the
+    filtering happens in the database rather than in the Lambda.
 
     Args:
         table: table name as a string
+        watermark: optional, only rows with a last_updated later than this
+        datetime are returned (full table is returned if not given)
+        upper_bound: optional, only rows with a last_updated no later than
+        this datetime are returned (ignored unless watermark is given)
+        conn: optional, an open pg8000 connection to run the query on. If not
+        given a new connection is opened and closed again afterwards
+        partition: optional, key range to read, passed to get_table_query
 
     Returns:
         A dictionary containing the following:
             List of dictionaries containing data for each row (if successful)
             status and error message in case of a database error
     """
-    table = sql_security(table)
+    close_after = conn is None
+    if close_after:
+        conn = connect_to_db()
     try:
+        table = sql_security(table, conn)
+        try:
+            query, params = get_table_query(
+                table, watermark, upper_bound, partition
+            )
+            query_result = conn.run(query, **params)
+            columns = [col["name"] for col in conn.columns]
+            totesys_data = [dict(zip(columns, row)) for row in query_result]
+            logging.info(
+                f"Data extracted from {table} table in Totesys database"
+            )
+            return totesys_data
+        except DatabaseError:
+            error_message = f'relation "{table}" does not exist'
+            logging.error(error_message)
+            return {"status": "failure", "message": error_message}
+    finally:
+        if close_after:
+            conn.close()
+
+
+def get_table_query(
+    table: str,
+    watermark: datetime = None,
+    upper_bound: datetime = None,
+    partition: tuple = None,
+    columns: str = "*",
+) -> tuple:
+    """Builds the SELECT statement used to extract a table, with the
+    watermark values passed as query parameters rather than formatted in
+
+    Args:
+        table: table name as a string, already checked by sql_security
+        watermark: optional, lower (exclusive) bound for last_updated
+        upper_bound: optional, upper (inclusive) bound for last_updated
+        partition: optional, a (column, start, end, inclusive end) tuple
+        from get_partition_ranges, limiting the query to one key range
+        columns: optional, the select list (all columns by default)
+
+    Returns:
+        A tuple containing the query string and a dictionary of parameters
+    """
+    conditions = []
+    params = {}
+    if watermark is not None:
+        conditions.append("last_updated > :watermark")
+        params["watermark"] = watermark
+        if upper_bound is not None:
+            conditions.append("last_updated <= :upper_bound")
+            params["upper_bound"] = upper_bound
+    if partition is not None:
+        column, start, end, inclusive_end = partition
+        conditions.append(f"{column} >= :range_start")
+        conditions.append(
+            f"{column} {'<=' if inclusive_end else '<'} :range_end"
+        )
+        params["range_start"] = start
+        params["range_end"] = end
+    query = f"SELECT {columns} FROM {table}"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    return f"{query};", params
+
+
+def get_change_probe_query(watermarks: dict, upper_bound: datetime) -> tuple:
+    """Builds a single query returning the latest last_updated and the
+    number of changed rows for every table, joined with UNION ALL so all the
+    tables are probed in one round trip
+
+    Args:
+        watermarks: dictionary of table name (already checked by
+        sql_security) to the lower (exclusive) bound for its last_updated
+        upper_bound: upper (inclusive) bound for last_updated
+
+    Returns:
+        A tuple containing the query string and a dictionary of parameters
+    """
+    selects = []
+    params = {"upper_bound": upper_bound}
+    for i, (table, watermark) in enumerate(watermarks.items()):
+        selects.append(
+            f"SELECT '{table}' AS table_name, "
+            "max(last_updated) AS max_last_updated, "
+            "count(*) AS changed_rows "
+            f"FROM {table} "
+            f"WHERE last_updated > :watermark_{i} "
+            "AND last_updated <= :upper_bound"
+        )
+        params[f"watermark_{i}"] = watermark
+    return " UNION ALL ".join(selects) + ";", params
+
+
+def probe_table_changes(
+    watermarks: dict,
+    upper_bound: datetime,
+    conn: Connection = None,
+) -> dict:
+    """Checks which tables have rows updated since the watermark with one
+    combined query, so tables without changes can be skipped rather than
+    read in full. The number of changed rows and latest change of each
+    table are logged.
+
+    Args:
+        watermarks: dictionary of table name to the lower (exclusive) bound
+        for its last_updated
+        upper_bound: upper (inclusive) bound for last_updated
+        conn: optional, an open pg8000 connection to run the query on. If not
+        given a new connection is opened and closed again afterwards
+
+    Returns:
+        A dictionary keyed by table name, each value a dictionary containing
+        changed_rows and max_last_updated, or None if the probe failed (in
+        which case every table should be extracted)
+    """
+    close_after = conn is None
+    if close_after:
         conn = connect_to_db()
-        query_result = conn.run(f"SELECT * FROM {table};")
-        columns = [col["name"] for col in conn.columns]
-        totesys_data = [dict(zip(columns, row)) for row in query_result]
-        logging.info(f"Data extracted from {table} table in Totesys database")
-        return totesys_data
-    except DatabaseError:
-        error_message = f'relation "{table}" does not exist'
-        logging.error(error_message)
-        return {"status": "failure", "message": error_message}
+    try:
+        watermarks = {
+            sql_security(table, conn): watermark
+            for table, watermark in watermarks.items()
+        }
+        query, params = get_change_probe_query(watermarks, upper_bound)
+        query_result = conn.run(query, **params)
+    except DatabaseError as de:
+        logging.error(f"Change probe failed: {de}")
+        return None
     finally:
-        conn.close()
+        if close_after:
+            conn.close()
+
+    changes = {}
+    for table, max_last_updated, changed_rows in query_result:
+        changes[table] = {
+            "changed_rows": changed_rows,
+            "max_last_updated": max_last_updated,
+        }
+        logging.info(
+            f"Change probe: table: {table}, changed rows: {changed_rows}, "
+            f"latest change: {max_last_updated}"
+        )
+    return changes
 
 
-def sql_security(table: str) -> str:
-    """Checks if the table passed exists in the totesys database
+def sql_security(table: str, conn: Connection = None) -> str:
+    """Checks if the table passed exists in the totesys database, using the
+    cached schema catalogue so the database is only queried when the
+    catalogue needs loading. A table missing from the catalogue causes one
+    reload, in case it was created after the catalogue was cached
 
     Args:
         table: table name as a string
+        conn: optional, an open pg8000 connection used if the catalogue needs
+        loading
 
     Returns:
         table: table name as a string, if it exists in the totesys database
@@ -52,15 +225,11 @@ def sql_security(table: str) -> str:
     Raises:
         DatabaseError: if passed table name is not in the totesys database
     """
-    conn = connect_to_db()
-    table_names_unfiltered = conn.run(
-        "SELECT TABLE_NAME FROM totesys.INFORMATION_SCHEMA.TABLES WHERE TABLE_TYPE='BASE TABLE'"
-    )
-    regex = re.compile("(^pg_)|(^sql_)|(^_)")
-    table_names_filtered = [
-        item[0] for item in table_names_unfiltered if not regex.search(item[0])
-    ]
-    if table in table_names_filtered:
+    catalogue = get_catalogue(conn)
+    if not catalogue.has_table(table):
+        invalidate_catalogue()
+        catalogue = get_catalogue(conn)
+    if catalogue.has_table(table):
         return table
     else:
         logging.error("Table not found")
@@ -70,30 +239,66 @@ def sql_security(table: str) -> str:
 
 
 def write_csv_to_s3(
-    session: boto3.session, data: list, bucket: str, key: str
+    session: boto3.session,
+    data: list,
+    bucket: str,
+    key: str,
+    file_format: str = "csv",
+    compression: str = None,
 ) -> dict:
-    """Converts data from Totesys database into CSV and writes to S3 bucket
+    """Converts data from Totesys database into CSV (or Parquet) and writes
+    to S3 bucket with S3MultipartUpload, so the size and checksum of the
+    file can be listed in the run manifest. Compressed CSV is written with
+    its ContentEncoding set. CSV is written with the csv module; pandas is
+    only imported when Parquet is asked for, so it stays out of the extract
+    lambda's cold start
 
     Args:
         session: Boto3 session
         data: list of dictionaries containing result of Totesys database query
         bucket: name of ingestion bucket as a string
         key: name of file to be written to S3
+        file_format: optional, "csv" (default) or "parquet"
+        compression: optional, for CSV "gzip" or "zstd" (the file is
+        uncompressed if not given), for Parquet "snappy" (default) or "zstd"
 
     Returns:
         A dictionary containing the following:
             success: shows whether the function ran successfully
             message: success message or error message
+            files: the key, size and checksum of the file (if successful)
+            timings: seconds spent serialising and uploading (if successful)
     """
+    client = session.client("s3") if session else boto3.client("s3")
+    start = time.perf_counter()
     try:
-        response = wr.s3.to_csv(
-            df=pd.DataFrame(data),
-            path=f"s3://{bucket}/{key}",
-            boto3_session=session,
-            index=False,
-        )
+        if file_format == "parquet":
+            import pandas as pd
+
+            buffer = io.BytesIO()
+            convert_decimal_columns(pd.DataFrame(data)).to_parquet(
+                buffer, index=False, compression=compression or "snappy"
+            )
+            upload = S3MultipartUpload(
+                client,
+                bucket,
+                key,
+                content_type="application/vnd.apache.parquet",
+            )
+            upload.write(buffer.getvalue())
+        else:
+            upload = S3MultipartUpload(
+                client, bucket, key, compression=compression
+            )
+            upload.write(convert_rows_to_csv(data))
+        upload.close()
         message = {"success": True, "message": "written to bucket"}
         logging.info(message)
+        message["files"] = [upload.file_entry()]
+        message["timings"] = {
+            "serialise": time.perf_counter() - start - upload.upload_seconds,
+            "upload": upload.upload_seconds,
+        }
         return message
     except ClientError as c:
         logger.error(f"Boto3 ClientError: {str(c)}")
@@ -104,45 +309,1424 @@ def write_csv_to_s3(
         return response
 
 
+def convert_rows_to_csv(data: list) -> bytes:
+    """Serialises rows from the Totesys database as CSV with the csv module,
+    in the same layout stream_table_to_s3 writes: a header row of the
+    column names, then one line per row with values formatted by
+    format_csv_value
+
+    Args:
+        data: list of dictionaries containing result of Totesys database query
+
+    Returns:
+        The CSV as UTF-8 encoded bytes
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    if data:
+        writer.writerow(data[0])
+    for row in data:
+        writer.writerow([format_csv_value(value) for value in row.values()])
+    return buffer.getvalue().encode("utf-8")
+
+
+def convert_decimal_columns(df: "pd.DataFrame") -> "pd.DataFrame":
+    """Converts columns holding Decimal values (Postgres numeric columns) to
+    floats, so they are stored in Parquet with the same dtype pandas gives
+    them when reading the CSV files
+
+    Args:
+        df: a pandas dataframe built from a Totesys database query
+
+    Returns:
+        The dataframe with its Decimal columns converted to float64
+    """
+    for column in df.columns:
+        values = df[column].dropna()
+        if len(values) and isinstance(values.iloc[0], Decimal):
+            df[column] = df[column].astype("float64")
+    return df
+
+
+def get_ingestion_key(
+    folder: str,
+    table: str,
+    file_format: str = "csv",
+    compression: str = None,
+    part: int = None,
+) -> str:
+    """Returns the S3 key a table is written to in the ingestion zone
+
+    Args:
+        folder: the run folder, either a timestamp or original_data_dump
+        table: table name as a string
+        file_format: optional, "csv" (default) or "parquet"
+        compression: optional, compression codec. Compressed CSV files get a
+        .gz or .zst suffix, Parquet files are compressed internally
+        part: optional, number of the part file for a table extracted in
+        partitions, e.g. sales_order.part-0001.csv
+
+    Returns:
+        The key as a string
+    """
+    extension = file_format
+    if file_format == "csv" and compression:
+        extension += CSV_COMPRESSION_SUFFIXES[compression]
+    if part is not None:
+        extension = f"part-{part:04d}.{extension}"
+    return f"ingested_data/{folder}/{table}.{extension}"
+
+
 def update_data_in_bucket(
     table: str,
     bucket: str,
     session: boto3.session,
     time_of_day: datetime,
     previous_lambda_runtime: datetime,
+    conn: Connection = None,
+    stream: bool = False,
+    file_format: str = "csv",
+    compression: str = None,
+    folder: str = None,
+    in_transaction: bool = False,
+    partitions: int = 1,
 ):
-    """Writes data to S3 bucket and checks last run time to create folder name
+    """Writes data to S3 bucket and checks last run time to create folder name.
+    The original data dump is written with copy_table_to_s3.
 
     Args:
         table: database table name as a string
         bucket: ingestion bucket name as a string
         session: Boto3 session
-        time_of_day: datetime timestamp, used as the folder path for S3
+        time_of_day: datetime timestamp, used as the folder path for S3 and
+        as the upper bound of the incremental query
+        previous_lambda_runtime: datetime of the previous run, used as the
+        watermark of the incremental query
+        conn: optional, an open pg8000 connection shared by every table in
+        the run
+        stream: optional, if True an incremental extract is written with
+        stream_table_to_s3 so memory use stays flat for large tables
+        file_format: optional, "csv" (default) or "parquet". COPY and
+        streaming only write CSV, so Parquet is always written from memory
+        compression: optional, compression codec passed to write_csv_to_s3
+        folder: optional, ingestion zone folder to write to, overriding the
+        one worked out from previous_lambda_runtime. Used when a table that
+        has never been extracted is read in full during an incremental run
+        in_transaction: optional, passed to stream_table_to_s3 and
+        copy_table_to_s3 when the connection is inside a snapshot
+        transaction
+        partitions: optional, if more than 1 a full extract of the table is
+        split into this many key ranges and written as part files by
+        extract_table_in_partitions
 
     Returns:
         A dictionary containing the following:
             success: shows whether the function ran successfully
             message: success message or error message
+            rows: number of rows written (if successful)
+            files: the key, size and checksum of each file written (if
+            successful)
+            min_last_updated, max_last_updated: range of last_updated
+            values written (if successful)
     """
-    table_info = convert_table_to_dict(table)
-
-    new_items = []
-
-    for item in table_info:
-        item_latest_update = item["last_updated"]
-        if item_latest_update > previous_lambda_runtime:
-            new_items.append(item)
-
-    data = new_items
     if previous_lambda_runtime < datetime(2000, 1, 1, 1, 1):
-        key = f"ingested_data/original_data_dump/{table}.csv"
+        folder = folder or "original_data_dump"
+        watermark, upper_bound = None, None
     else:
-        key = f"ingested_data/{time_of_day}/{table}.csv"
-    if new_items:
-        response = write_csv_to_s3(
-            session=session, data=data, bucket=bucket, key=key
+        folder = folder or time_of_day
+        watermark, upper_bound = previous_lambda_runtime, time_of_day
+    key = get_ingestion_key(folder, table, file_format, compression)
+
+    if partitions > 1 and watermark is None:
+        response = extract_table_in_partitions(
+            session,
+            table,
+            bucket,
+            folder,
+            partitions,
+            conn=conn,
+            file_format=file_format,
+            compression=compression,
         )
-    else:
-        response = {"success": False, "message": "no new data"}
+        logging.info(response)
+        return response
+
+    if file_format == "csv":
+        if watermark is None:
+            response = copy_table_to_s3(
+                session,
+                table,
+                bucket,
+                key,
+                conn=conn,
+                compression=compression,
+                in_transaction=in_transaction,
+            )
+            logging.info(response)
+            return response
+        if stream:
+            response = stream_table_to_s3(
+                session,
+                table,
+                bucket,
+                key,
+                watermark=watermark,
+                upper_bound=upper_bound,
+                conn=conn,
+                compression=compression,
+                in_transaction=in_transaction,
+            )
+            logging.info(response)
+            return response
+
+    response = extract_rows_to_s3(
+        session,
+        table,
+        bucket,
+        key,
+        watermark=watermark,
+        upper_bound=upper_bound,
+        conn=conn,
+        file_format=file_format,
+        compression=compression,
+    )
     logging.info(response)
     return response
+
+
+def extract_rows_to_s3(
+    session: boto3.session,
+    table: str,
+    bucket: str,
+    key: str,
+    watermark: datetime = None,
+    upper_bound: datetime = None,
+    conn: Connection = None,
+    partition: tuple = None,
+    file_format: str = "csv",
+    compression: str = None,
+) -> dict:
+    """Reads a table (or a slice of it) into memory with
+    convert_table_to_dict and writes it with write_csv_to_s3. Used for
+    Parquet, and for CSV tables that are neither copied nor streamed.
+
+    Args:
+        session: Boto3 session
+        table: table name as a string
+        bucket: ingestion bucket name as a string
+        key: name of file to be written to S3
+        watermark: optional, lower (exclusive) bound for last_updated
+        upper_bound: optional, upper (inclusive) bound for last_updated
+        conn: optional, an open pg8000 connection to run the query on
+        partition: optional, key range to read, passed to get_table_query
+        file_format: optional, "csv" (default) or "parquet"
+        compression: optional, compression codec passed to write_csv_to_s3
+
+    Returns:
+        The response of write_csv_to_s3 with the number of rows written
+        and their last_updated range added, or a "no new data" or error
+        response. The number of rows fetched and the query time are added
+        to every response that got as far as running the query.
+    """
+    start = time.perf_counter()
+    data = convert_table_to_dict(
+        table, watermark, upper_bound, conn, partition
+    )
+    query_seconds = time.perf_counter() - start
+    if isinstance(data, dict):
+        return {"success": False, "message": data["message"]}
+    if not data:
+        return {
+            "success": False,
+            "message": "no new data",
+            "rows_fetched": 0,
+            "timings": {"query": query_seconds},
+        }
+    response = write_csv_to_s3(
+        session, data, bucket, key, file_format, compression
+    )
+    response["rows_fetched"] = len(data)
+    if response["success"]:
+        response["rows"] = len(data)
+        response["min_last_updated"], response["max_last_updated"] = (
+            get_last_updated_range(row.get("last_updated") for row in data)
+        )
+        response["timings"]["query"] = query_seconds
+    return response
+
+
+def format_csv_value(value):
+    """Formats a value from the database for a CSV row. Timestamps are
+    always written to millisecond precision (the precision of the Totesys
+    timestamps), so every value in a column has the same layout and matches
+    the timestamps get_copy_query writes. None is written by the csv module
+    as an empty field.
+    """
+    if isinstance(value, datetime):
+        return value.isoformat(sep=" ", timespec="milliseconds")
+    return value
+
+
+def get_last_updated_range(values, current: tuple = (None, None)) -> tuple:
+    """Returns the earliest and latest of a set of last_updated values, as
+    listed for each table in the run manifest. None values are skipped.
+
+    Args:
+        values: iterable of last_updated values
+        current: optional, a (min, max) tuple the range is widened from, so
+        the range can be built up a batch of rows at a time
+
+    Returns:
+        A (min, max) tuple, (None, None) if there were no values
+    """
+    values = [value for value in (*current, *values) if value is not None]
+    if not values:
+        return None, None
+    return min(values), max(values)
+
+
+def get_compressor(compression: str):
+    """Returns a streaming compressor with compress and flush methods
+
+    Args:
+        compression: "gzip" or "zstd"
+
+    Raises:
+        ValueError: if the compression is not supported
+    """
+    if compression == "gzip":
+        return zlib.compressobj(wbits=31)
+    if compression == "zstd":
+        import zstandard
+
+        return zstandard.ZstdCompressor().compressobj()
+    raise ValueError(f"Unsupported compression: {compression}")
+
+
+class S3MultipartUpload:
+    """Writable file-like object that uploads what is written to it as an S3
+    multipart upload, holding at most one part in memory at a time. If
+    everything written fits in one part it is sent with a single put_object
+    instead. Errors from S3 are kept rather than raised from write, so the
+    object can be handed to pg8000 as a COPY stream without breaking the
+    connection part way through a response, and are raised by close instead.
+
+    Args:
+        client: S3 Boto3 client
+        bucket: name of the bucket as a string
+        key: name of the file to be written to S3
+        part_size: optional, size in bytes at which the buffer is uploaded
+        as a part (S3 requires at least 5 MiB for every part but the last)
+        compression: optional, "gzip" or "zstd" to compress the data as it
+        is written. The object's ContentEncoding is set to match
+        content_type: optional, ContentType of the object (text/csv default)
+
+    The time spent in S3 calls is kept in upload_seconds, for the extract
+    metrics.
+    """
+
+    def __init__(
+        self,
+        client: boto3.client,
+        bucket: str,
+        key: str,
+        part_size: int = STREAM_PART_SIZE,
+        compression: str = None,
+        content_type: str = "text/csv",
+    ):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.bytes_written = 0
+        self.bytes_uploaded = 0
+        self.sha256 = hashlib.sha256()
+        self.upload_seconds = 0.0
+        self.error = None
+        self.object_args = {"ContentType": content_type}
+        self.compressor = None
+        if compression:
+            self.compressor = get_compressor(compression)
+            self.object_args["ContentEncoding"] = compression
+
+    def write(self, data: bytes) -> int:
+        """Adds data to the buffer, compressing it first if the upload is
+        compressed, and uploads a part once the buffer is full
+
+        Returns:
+            The number of bytes of data taken, as for any writable file
+            object (the uncompressed size)
+        """
+        size = len(data)
+        self.bytes_written += size
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        self.sha256.update(data)
+        self.buffer += data
+        if len(self.buffer) >= self.part_size:
+            self.upload_part()
+        return size
+
+    def upload_part(self) -> None:
+        if self.error is not None:
+            self.buffer.clear()
+            return
+        start = time.perf_counter()
+        try:
+            if self.upload_id is None:
+                self.upload_id = self.client.create_multipart_upload(
+                    Bucket=self.bucket, Key=self.key, **self.object_args
+                )["UploadId"]
+            part_number = len(self.parts) + 1
+            response = self.client.upload_part(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                PartNumber=part_number,
+                Body=bytes(self.buffer),
+            )
+            self.parts.append(
+                {"ETag": response["ETag"], "PartNumber": part_number}
+            )
+            self.bytes_uploaded += len(self.buffer)
+        except ClientError as c:
+            self.error = c
+        self.upload_seconds += time.perf_counter() - start
+        self.buffer.clear()
+
+    def close(self) -> None:
+        """Uploads whatever is left in the buffer and completes the upload
+
+        Raises:
+            ClientError: if any part could not be uploaded
+        """
+        if self.compressor is not None:
+            data = self.compressor.flush()
+            self.sha256.update(data)
+            self.buffer += data
+        if self.upload_id is None and self.error is None:
+            self.bytes_uploaded = len(self.buffer)
+            start = time.perf_counter()
+            self.client.put_object(
+                Bucket=self.bucket,
+                Key=self.key,
+                Body=bytes(self.buffer),
+                **self.object_args,
+            )
+            self.upload_seconds += time.perf_counter() - start
+            self.buffer.clear()
+            return
+        self.upload_part()
+        if self.error is not None:
+            self.abort()
+            raise self.error
+        start = time.perf_counter()
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            MultipartUpload={"Parts": self.parts},
+        )
+        self.upload_seconds += time.perf_counter() - start
+
+    def abort(self) -> None:
+        """Abandons the upload so no object is created"""
+        self.buffer.clear()
+        if self.upload_id is not None:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id
+            )
+            self.upload_id = None
+
+    def file_entry(self) -> dict:
+        """Returns the key, size in bytes and SHA-256 checksum of the object
+        written, as listed in the run manifest"""
+        return {
+            "key": self.key,
+            "bytes": self.bytes_uploaded,
+            "sha256": self.sha256.hexdigest(),
+        }
+
+
+def stream_table_to_s3(
+    session: boto3.session,
+    table: str,
+    bucket: str,
+    key: str,
+    watermark: datetime = None,
+    upper_bound: datetime = None,
+    conn: Connection = None,
+    batch_size: int = STREAM_BATCH_SIZE,
+    part_size: int = STREAM_PART_SIZE,
+    compression: str = None,
+    in_transaction: bool = False,
+    partition: tuple = None,
+) -> dict:
+    """Extracts a table and writes it to S3 as CSV without holding the whole
+    table in memory. Rows are read from a server-side cursor batch_size rows
+    at a time, written as CSV with the csv module and uploaded with
+    S3MultipartUpload whenever part_size bytes have built up.
+
+    Args:
+        session: Boto3 session
+        table: table name as a string
+        bucket: name of ingestion bucket as a string
+        key: name of file to be written to S3
+        watermark: optional, only rows with a later last_updated are written
+        upper_bound: optional, only rows with a last_updated no later than
+        this are written (ignored unless watermark is given)
+        conn: optional, an open pg8000 connection to run the query on. If not
+        given a new connection is opened and closed again afterwards
+        batch_size: optional, number of rows fetched from the cursor at once
+        part_size: optional, minimum size in bytes of each uploaded part
+        compression: optional, "gzip" or "zstd" to compress the CSV
+        in_transaction: optional, if True the connection is already inside a
+        transaction (a snapshot), so the cursor is declared in it and no
+        transaction is started or ended
+        partition: optional, key range to read, passed to get_table_query
+
+    Returns:
+        A dictionary containing the following:
+            success: shows whether the function ran successfully
+            message: success message, "no new data" or error message
+            rows: number of rows written (if successful)
+            files: the key, size and checksum of the file (if successful)
+            min_last_updated, max_last_updated: range of last_updated
+            values written (if successful)
+            rows_fetched, timings: rows read from the database and seconds
+            spent querying, serialising and uploading, for the metrics
+
+    Raises:
+        DatabaseError: if passed table name is not in the totesys database
+    """
+    client = session.client("s3") if session else boto3.client("s3")
+    upload = S3MultipartUpload(client, bucket, key, part_size, compression)
+    close_after = conn is None
+    if close_after:
+        conn = connect_to_db()
+    try:
+        table = sql_security(table, conn)
+        query, params = get_table_query(
+            table, watermark, upper_bound, partition
+        )
+        if not in_transaction:
+            conn.run("START TRANSACTION READ ONLY;")
+        try:
+            start = time.perf_counter()
+            conn.run(
+                f"DECLARE extract_cursor NO SCROLL CURSOR FOR {query}",
+                **params,
+            )
+            query_seconds = time.perf_counter() - start
+            serialise_seconds = 0.0
+            buffer = io.StringIO()
+            writer = csv.writer(buffer, lineterminator="\n")
+            row_count = 0
+            last_updated = (None, None)
+            while True:
+                start = time.perf_counter()
+                rows = conn.run(
+                    f"FETCH FORWARD {int(batch_size)} FROM extract_cursor;"
+                )
+                query_seconds += time.perf_counter() - start
+                if not rows:
+                    break
+                start = time.perf_counter()
+                if row_count == 0:
+                    columns = [col["name"] for col in conn.columns]
+                    writer.writerow(columns)
+                for row in rows:
+                    writer.writerow([format_csv_value(value) for value in row])
+                if "last_updated" in columns:
+                    index = columns.index("last_updated")
+                    last_updated = get_last_updated_range(
+                        (row[index] for row in rows), last_updated
+                    )
+                row_count += len(rows)
+                upload.write(buffer.getvalue().encode("utf-8"))
+                buffer.seek(0)
+                buffer.truncate()
+                serialise_seconds += time.perf_counter() - start
+            serialise_seconds -= upload.upload_seconds
+            conn.run("CLOSE extract_cursor;")
+            if not in_transaction:
+                conn.run("COMMIT;")
+        except DatabaseError:
+            if not in_transaction:
+                conn.run("ROLLBACK;")
+            upload.abort()
+            error_message = f'relation "{table}" does not exist'
+            logging.error(error_message)
+            return {"success": False, "message": error_message}
+
+        if row_count == 0:
+            upload.abort()
+            return {
+                "success": False,
+                "message": "no new data",
+                "rows_fetched": 0,
+                "timings": {"query": query_seconds},
+            }
+        upload.close()
+        logging.info(
+            f"{row_count} rows streamed from {table} in "
+            f"{len(upload.parts)} parts"
+        )
+        return {
+            "success": True,
+            "message": "written to bucket",
+            "rows": row_count,
+            "rows_fetched": row_count,
+            "files": [upload.file_entry()],
+            "min_last_updated": last_updated[0],
+            "max_last_updated": last_updated[1],
+            "timings": {
+                "query": query_seconds,
+                "serialise": serialise_seconds,
+                "upload": upload.upload_seconds,
+            },
+        }
+    except ClientError as c:
+        logger.error(f"Boto3 ClientError: {str(c)}")
+        return {"success": False, "message": c.response["Error"]["Message"]}
+    finally:
+        if close_after:
+            conn.close()
+
+
+def get_copy_query(
+    table: str,
+    column_types: dict,
+    watermark: datetime = None,
+    upper_bound: datetime = None,
+    partition: tuple = None,
+) -> str:
+    """Builds a COPY ... TO STDOUT statement that writes a table as CSV with
+    a header row. Columns are listed explicitly from the schema catalogue,
+    booleans are written as True/False and timestamps to millisecond
+    precision, so the output reads the same as the CSV files written by
+    write_csv_to_s3 (COPY on its own drops trailing zeros from the
+    fraction). COPY does not accept query parameters, so the watermarks and
+    the key range are written into the statement from the datetime and
+    integer values.
+
+    Args:
+        table: table name as a string, already checked by sql_security
+        column_types: dictionary of column name to Postgres data type, in
+        column order, from the schema catalogue
+        watermark: optional, lower (exclusive) bound for last_updated
+        upper_bound: optional, upper (inclusive) bound for last_updated
+        partition: optional, a (column, start, end, inclusive end) tuple
+        from get_partition_ranges, limiting the COPY to one key range
+
+    Returns:
+        The COPY statement as a string
+    """
+    select_list = []
+    for column, data_type in column_types.items():
+        name = '"' + column.replace('"', '""') + '"'
+        if data_type == "boolean":
+            select_list.append(
+                f"CASE WHEN {name} THEN 'True' "
+                f"WHEN NOT {name} THEN 'False' END AS {name}"
+            )
+        elif data_type == "timestamp without time zone":
+            select_list.append(
+                f"to_char({name}, '{COPY_TIMESTAMP_FORMAT}') AS {name}"
+            )
+        else:
+            select_list.append(name)
+    conditions = []
+    if watermark is not None:
+        conditions.append(f"last_updated > {get_copy_literal(watermark)}")
+        if upper_bound is not None:
+            conditions.append(
+                f"last_updated <= {get_copy_literal(upper_bound)}"
+            )
+    if partition is not None:
+        column, start, end, inclusive_end = partition
+        conditions.append(f"{column} >= {get_copy_literal(start)}")
+        conditions.append(
+            f"{column} {'<=' if inclusive_end else '<'} "
+            f"{get_copy_literal(end)}"
+        )
+    query = f"SELECT {', '.join(select_list)} FROM {table}"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    return f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER true);"
+
+
+def get_copy_literal(value) -> str:
+    """Writes a watermark or range boundary into a COPY statement: integers
+    as numbers and datetimes as quoted timestamps. Nothing else is accepted,
+    so no text reaches the statement.
+
+    Raises:
+        TypeError: if the value is not an integer or a datetime
+    """
+    if isinstance(value, datetime):
+        return f"'{value.isoformat(sep=' ')}'"
+    if isinstance(value, int) and not isinstance(value, bool):
+        return str(int(value))
+    raise TypeError(f"{value!r} can't be written into a COPY statement")
+
+
+def copy_table_to_s3(
+    session: boto3.session,
+    table: str,
+    bucket: str,
+    key: str,
+    watermark: datetime = None,
+    upper_bound: datetime = None,
+    conn: Connection = None,
+    part_size: int = STREAM_PART_SIZE,
+    compression: str = None,
+    in_transaction: bool = False,
+    partition: tuple = None,
+) -> dict:
+    """Extracts a table with Postgres COPY and pipes the CSV bytes straight
+    into an S3 multipart upload, without creating any Python objects per
+    row. Used for full dumps, backfills and the part files of a partitioned
+    extract. The range of last_updated values
+    for the manifest is read in the same REPEATABLE READ transaction as the
+    COPY, so it covers exactly the rows written.
+
+    Args:
+        session: Boto3 session
+        table: table name as a string
+        bucket: name of ingestion bucket as a string
+        key: name of file to be written to S3
+        watermark: optional, only rows with a later last_updated are written
+        upper_bound: optional, only rows with a last_updated no later than
+        this are written (ignored unless watermark is given)
+        conn: optional, an open pg8000 connection to run the query on. If not
+        given a new connection is opened and closed again afterwards
+        part_size: optional, minimum size in bytes of each uploaded part
+        compression: optional, "gzip" or "zstd" to compress the CSV
+        in_transaction: optional, if True the connection is already inside a
+        transaction (a snapshot), so no transaction is started or ended
+        partition: optional, key range to copy, from get_partition_ranges
+
+    Returns:
+        A dictionary containing the following:
+            success: shows whether the function ran successfully
+            message: success message, "no new data" or error message
+            rows: number of rows written (if successful)
+            files: the key, size and checksum of the file (if successful)
+            min_last_updated, max_last_updated: range of last_updated
+            values written (if successful)
+            rows_fetched, timings: rows read from the database and seconds
+            spent querying, serialising and uploading, for the metrics
+
+    Raises:
+        DatabaseError: if passed table name is not in the totesys database
+    """
+    client = session.client("s3") if session else boto3.client("s3")
+    upload = S3MultipartUpload(client, bucket, key, part_size, compression)
+    close_after = conn is None
+    if close_after:
+        conn = connect_to_db()
+    try:
+        table = sql_security(table, conn)
+        column_types = get_catalogue(conn).column_types(table)
+        query = get_copy_query(
+            table, column_types, watermark, upper_bound, partition
+        )
+        if not in_transaction:
+            conn.run(
+                "START TRANSACTION ISOLATION LEVEL REPEATABLE READ, "
+                "READ ONLY;"
+            )
+        try:
+            start = time.perf_counter()
+            conn.run(query, stream=upload)
+            query_seconds = time.perf_counter() - start - upload.upload_seconds
+            row_count = conn.row_count
+            last_updated = (None, None)
+            if row_count and "last_updated" in column_types:
+                query, params = get_table_query(
+                    table,
+                    watermark,
+                    upper_bound,
+                    partition,
+                    columns="min(last_updated), max(last_updated)",
+                )
+                last_updated = tuple(conn.run(query, **params)[0])
+            if not in_transaction:
+                conn.run("COMMIT;")
+        except DatabaseError:
+            if not in_transaction:
+                conn.run("ROLLBACK;")
+            upload.abort()
+            error_message = f'relation "{table}" does not exist'
+            logging.error(error_message)
+            return {"success": False, "message": error_message}
+        except ClientError:
+            if not in_transaction:
+                conn.run("ROLLBACK;")
+            raise
+
+        if row_count == 0:
+            upload.abort()
+            return {
+                "success": False,
+                "message": "no new data",
+                "rows_fetched": 0,
+                "timings": {"query": query_seconds},
+            }
+        upload.close()
+        logging.info(
+            f"{row_count} rows copied from {table} "
+            f"({upload.bytes_written} bytes)"
+        )
+        return {
+            "success": True,
+            "message": "written to bucket",
+            "rows": row_count,
+            "rows_fetched": row_count,
+            "files": [upload.file_entry()],
+            "min_last_updated": last_updated[0],
+            "max_last_updated": last_updated[1],
+            "timings": {
+                "query": query_seconds,
+                "serialise": 0.0,
+                "upload": upload.upload_seconds,
+            },
+        }
+    except ClientError as c:
+        logger.error(f"Boto3 ClientError: {str(c)}")
+        return {"success": False, "message": c.response["Error"]["Message"]}
+    finally:
+        if close_after:
+            conn.close()
+
+
+def get_partition_column(table: str, conn: Connection = None) -> str:
+    """Picks the column a table is split into key ranges on: its primary key
+    if that is a single integer column, otherwise last_updated (so the table
+    is split into time slices)
+
+    Args:
+        table: table name as a string, already checked by sql_security
+        conn: optional, an open pg8000 connection used if the catalogue needs
+        loading
+
+    Returns:
+        The column name as a string
+    """
+    catalogue = get_catalogue(conn)
+    primary_key = catalogue.primary_key(table)
+    column_types = catalogue.column_types(table)
+    if (
+        len(primary_key) == 1
+        and column_types[primary_key[0]] in PARTITION_INTEGER_TYPES
+    ):
+        return primary_key[0]
+    return "last_updated"
+
+
+def get_partition_ranges(
+    table: str,
+    column: str,
+    partitions: int,
+    watermark: datetime = None,
+    upper_bound: datetime = None,
+    conn: Connection = None,
+) -> list:
+    """Splits a table into contiguous ranges of a column, using the column's
+    min and max values. Each range is a (column, start, end, inclusive end)
+    tuple for get_table_query. Every range but the last excludes its end, so
+    no row falls in two ranges.
+
+    Args:
+        table: table name as a string, already checked by sql_security
+        column: integer or timestamp column to split on
+        partitions: number of ranges to split the table into
+        watermark: optional, lower (exclusive) bound for last_updated
+        upper_bound: optional, upper (inclusive) bound for last_updated
+        conn: an open pg8000 connection to run the query on
+
+    Returns:
+        A list of ranges, empty if there are no rows to extract
+    """
+    query, params = get_table_query(
+        table, watermark, upper_bound, columns=f"min({column}), max({column})"
+    )
+    low, high = conn.run(query, **params)[0]
+    if low is None:
+        return []
+    if isinstance(low, int):
+        edges = [
+            low + (high - low) * i // partitions for i in range(partitions)
+        ]
+    else:
+        edges = [
+            low + (high - low) * i / partitions for i in range(partitions)
+        ]
+    edges = sorted(set(edges))
+    ends = edges[1:] + [high]
+    return [
+        (column, start, end, i == len(edges) - 1)
+        for i, (start, end) in enumerate(zip(edges, ends))
+    ]
+
+
+def extract_slice_to_s3(
+    session: boto3.session,
+    table: str,
+    bucket: str,
+    key: str,
+    watermark: datetime = None,
+    upper_bound: datetime = None,
+    partition: tuple = None,
+    file_format: str = "csv",
+    compression: str = None,
+    conn: Connection = None,
+    snapshot: str = None,
+    in_transaction: bool = False,
+) -> dict:
+    """Extracts one slice of a table, a key range or a window of
+    last_updated values, and writes it to its own file. Used on worker
+    threads for the part files of a partitioned extract and the chunks of a
+    backfill, so the session is copied and, unless a connection is given,
+    the slice is read on its own pooled connection. CSV slices are written
+    with COPY (copy_table_to_s3).
+
+    If a snapshot is given the slice is read in a transaction that imports
+    it (import_snapshot), so slices read on different connections all see
+    the database as it was when the snapshot was exported.
+
+    Args:
+        session: Boto3 session
+        table: table name as a string
+        bucket: ingestion bucket name as a string
+        key: name of file to be written to S3
+        watermark: optional, lower (exclusive) bound for last_updated
+        upper_bound: optional, upper (inclusive) bound for last_updated
+        partition: optional, key range to read, passed to get_table_query
+        file_format: optional, "csv" (default, copied) or "parquet"
+        compression: optional, compression codec of the file
+        conn: optional, an open pg8000 connection owned by the calling
+        thread. If not given one is taken with acquire_connection
+        snapshot: optional, id of an exported snapshot to read the slice in
+        in_transaction: optional, if True the connection is already inside
+        the transaction that exported the snapshot, so none is started
+
+    Returns:
+        The response of copy_table_to_s3 or extract_rows_to_s3
+    """
+    slice_session = copy_session(session)
+    slice_conn = conn or acquire_connection()
+    imported = snapshot is not None and not in_transaction
+    try:
+        if imported:
+            import_snapshot(slice_conn, snapshot)
+        if file_format == "csv":
+            return copy_table_to_s3(
+                slice_session,
+                table,
+                bucket,
+                key,
+                watermark=watermark,
+                upper_bound=upper_bound,
+                conn=slice_conn,
+                compression=compression,
+                in_transaction=in_transaction or imported,
+                partition=partition,
+            )
+        return extract_rows_to_s3(
+            slice_session,
+            table,
+            bucket,
+            key,
+            watermark,
+            upper_bound,
+            slice_conn,
+            partition,
+            file_format,
+            compression,
+        )
+    finally:
+        if imported:
+            end_snapshot(slice_conn)
+        if conn is None:
+            release_connection(slice_conn)
+
+
+def extract_partitions(
+    session: boto3.session,
+    table: str,
+    bucket: str,
+    folder: str,
+    ranges: list,
+    watermark: datetime,
+    upper_bound: datetime,
+    conn: Connection,
+    file_format: str,
+    compression: str,
+    snapshot: str,
+) -> list:
+    """Extracts the key ranges of a partitioned table to their part files.
+    The ranges are dealt out in turn to the table's own connection and to
+    the extra pooled connections that are free, each connection working
+    through its ranges on its own thread. The table's own connection is
+    inside the transaction that exported the snapshot, and the extra
+    connections import it for each range they read.
+
+    Returns:
+        A list of (key, response of extract_slice_to_s3) tuples, in range
+        order
+    """
+    connections = [conn]
+    while len(connections) < len(ranges):
+        extra = acquire_connection(blocking=False)
+        if extra is None:
+            break
+        connections.append(extra)
+
+    def extract_parts(worker: int) -> list:
+        results = []
+        for part in range(worker, len(ranges), len(connections)):
+            key = get_ingestion_key(
+                folder, table, file_format, compression, part
+            )
+            results.append(
+                (
+                    part,
+                    key,
+                    extract_slice_to_s3(
+                        session,
+                        table,
+                        bucket,
+                        key,
+                        watermark,
+                        upper_bound,
+                        ranges[part],
+                        file_format,
+                        compression,
+                        connections[worker],
+                        snapshot,
+                        in_transaction=worker == 0,
+                    ),
+                )
+            )
+        return results
+
+    try:
+        with ThreadPoolExecutor(max_workers=len(connections)) as executor:
+            futures = [
+                executor.submit(extract_parts, worker)
+                for worker in range(len(connections))
+            ]
+        results = [result for future in futures for result in future.result()]
+    finally:
+        for extra in connections[1:]:
+            release_connection(extra)
+    return [(key, response) for part, key, response in sorted(results)]
+
+
+def delete_written_parts(
+    session: boto3.session, bucket: str, keys: list
+) -> None:
+    """Deletes the part files of a table that failed part way through. A
+    failure to delete them is logged rather than raised, so the error that
+    failed the table is the one reported."""
+    client = session.client("s3") if session else boto3.client("s3")
+    try:
+        response = client.delete_objects(
+            Bucket=bucket,
+            Delete={"Objects": [{"Key": key} for key in keys]},
+        )
+    except ClientError as ce:
+        logger.error(f"Part files {keys} could not be deleted: {ce}")
+        return
+    for error in response.get("Errors", []):
+        logger.error(
+            f"Part file {error['Key']} could not be deleted: "
+            f"{error['Message']}"
+        )
+
+
+def extract_table_in_partitions(
+    session: boto3.session,
+    table: str,
+    bucket: str,
+    folder: str,
+    partitions: int,
+    watermark: datetime = None,
+    upper_bound: datetime = None,
+    conn: Connection = None,
+    file_format: str = "csv",
+    compression: str = None,
+) -> dict:
+    """Extracts a large table as several part files, pulled concurrently so
+    a full extract isn't limited by a single SELECT. The table is split into
+    key ranges with get_partition_ranges and each range is written to its
+    own part file (e.g. sales_order.part-0001.csv) under the run folder. The
+    transform lambda reads all the parts of a table as one. If any part
+    fails the parts already written are deleted, so a folder never holds
+    half a table.
+
+    The ranges are planned in a REPEATABLE READ transaction whose snapshot
+    is exported (export_snapshot) and imported by every connection reading
+    a part, so the parts are consistent with each other and with the
+    ranges, as if the table had been read by one query.
+
+    The ranges are shared out between the table's own connection and as
+    many extra pooled connections as are free (without waiting, see
+    acquire_connection), and each connection reads its ranges one after
+    another. Partitioned tables extracted in parallel therefore stay within
+    the pool's MAX_CONNECTIONS, however many tables and partitions there
+    are.
+
+    Args:
+        session: Boto3 session
+        table: table name as a string
+        bucket: ingestion bucket name as a string
+        folder: ingestion zone folder to write the parts to
+        partitions: number of key ranges to split the table into
+        watermark: optional, lower (exclusive) bound for last_updated
+        upper_bound: optional, upper (inclusive) bound for last_updated
+        conn: optional, an open pg8000 connection used to plan the ranges,
+        not inside a transaction
+        file_format: optional, "csv" (default, copied) or "parquet"
+        compression: optional, compression codec of the part files
+
+    Returns:
+        A dictionary containing the following:
+            success: shows whether the function ran successfully
+            message: success message, "no new data" or error message
+            rows: total number of rows written (if successful)
+            parts: number of part files written (if successful)
+            files: the key, size and checksum of each part (if successful)
+            min_last_updated, max_last_updated: range of last_updated
+            values written (if successful)
+            rows_fetched, timings: totals over the parts, which run
+            concurrently, so the timings can add up to more than the time
+            the table took (if successful)
+    """
+    close_after = conn is None
+    if close_after:
+        conn = connect_to_db()
+    try:
+        snapshot = export_snapshot(conn)
+        try:
+            table = sql_security(table, conn)
+            column = get_partition_column(table, conn)
+            ranges = get_partition_ranges(
+                table, column, partitions, watermark, upper_bound, conn
+            )
+        except DatabaseError:
+            error_message = f'relation "{table}" does not exist'
+            logging.error(error_message)
+            return {"success": False, "message": error_message}
+        if not ranges:
+            return {"success": False, "message": "no new data"}
+        results = extract_partitions(
+            session,
+            table,
+            bucket,
+            folder,
+            ranges,
+            watermark,
+            upper_bound,
+            conn,
+            file_format,
+            compression,
+            snapshot,
+        )
+    finally:
+        end_snapshot(conn)
+        if close_after:
+            conn.close()
+
+    written = [key for key, response in results if response["success"]]
+    failures = [
+        response
+        for key, response in results
+        if not response["success"] and response["message"] != "no new data"
+    ]
+    if failures:
+        if written:
+            delete_written_parts(session, bucket, written)
+        return failures[0]
+    if not written:
+        return {"success": False, "message": "no new data"}
+    succeeded = [response for key, response in results if response["success"]]
+    rows = sum(response["rows"] for response in succeeded)
+    logging.info(f"{rows} rows extracted from {table} in {len(written)} parts")
+    last_updated = get_last_updated_range(
+        value
+        for response in succeeded
+        for value in (
+            response["min_last_updated"],
+            response["max_last_updated"],
+        )
+    )
+    return {
+        "success": True,
+        "message": "written to bucket",
+        "rows": rows,
+        "parts": len(written),
+        "files": [
+            entry for response in succeeded for entry in response["files"]
+        ],
+        "min_last_updated": last_updated[0],
+        "max_last_updated": last_updated[1],
+        "rows_fetched": sum(
+            response.get("rows_fetched", 0) for key, response in results
+        ),
+        "timings": {
+            step: sum(
+                response.get("timings", {}).get(step, 0.0)
+                for key, response in results
+            )
+            for step in ["query", "serialise", "upload"]
+        },
+    }
+
+
+def copy_session(session: boto3.session.Session) -> boto3.session.Session:
+    """Returns a new Boto3 session with the same credentials and region as
+    the one passed. Boto3 sessions are not thread safe, so each worker thread
+    is given its own.
+
+    Args:
+        session: Boto3 session (optional, a default session is used if None)
+
+    Returns:
+        A new Boto3 session
+    """
+    if session is None:
+        return boto3.session.Session()
+    credentials = session.get_credentials().get_frozen_credentials()
+    return boto3.session.Session(
+        aws_access_key_id=credentials.access_key,
+        aws_secret_access_key=credentials.secret_key,
+        aws_session_token=credentials.token,
+        region_name=session.region_name,
+    )
+
+
+def update_tables_in_parallel(
+    table_list: list,
+    bucket: str,
+    session: boto3.session,
+    time_of_day: datetime,
+    previous_lambda_runtime: datetime | dict,
+    max_workers: int,
+    stream_tables: list = (),
+    file_format: str = "csv",
+    compression: str = None,
+    folder: str = None,
+    partition_tables: list = (),
+    partitions: int = 1,
+) -> dict:
+    """Runs update_data_in_bucket for each table concurrently on a bounded
+    thread pool. Each worker uses its own database connection from the
+    connection pool and its own Boto3 session.
+
+    Args:
+        table_list: list of database table names
+        bucket: ingestion bucket name as a string
+        session: Boto3 session
+        time_of_day: datetime timestamp of the current run
+        previous_lambda_runtime: datetime of the previous run, or a
+        dictionary of table name to the previous runtime of each table
+        max_workers: maximum number of tables extracted at the same time
+        stream_tables: optional, names of tables to be written with
+        stream_table_to_s3
+        file_format: optional, ingestion file format passed to
+        update_data_in_bucket
+        compression: optional, compression codec passed to
+        update_data_in_bucket
+        folder: optional, ingestion zone folder passed to
+        update_data_in_bucket
+        partition_tables: optional, names of tables extracted in partitions
+        when read in full
+        partitions: optional, number of partitions for those tables
+
+    Returns:
+        A dictionary of table name to the response from update_data_in_bucket,
+        in the same order as table_list
+    """
+
+    def update_table(table: str) -> dict:
+        runtime = previous_lambda_runtime
+        if isinstance(runtime, dict):
+            runtime = runtime[table]
+        conn = acquire_connection()
+        try:
+            return update_data_in_bucket(
+                table,
+                bucket,
+                copy_session(session),
+                time_of_day,
+                runtime,
+                conn=conn,
+                stream=table in stream_tables,
+                file_format=file_format,
+                compression=compression,
+                folder=folder,
+                partitions=partitions if table in partition_tables else 1,
+            )
+        finally:
+            release_connection(conn)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            table: executor.submit(update_table, table) for table in table_list
+        }
+    return {table: future.result() for table, future in futures.items()}
+
+
+def begin_snapshot(conn: Connection) -> datetime:
+    """Starts a REPEATABLE READ, READ ONLY transaction, so every query run on
+    the connection until end_snapshot sees the database as it was at the
+    same moment. Any transaction left open by a failed run is rolled back
+    first.
+
+    Args:
+        conn: an open pg8000 connection
+
+    Returns:
+        The database clock (LOCALTIMESTAMP) at the start of the snapshot,
+        used as the upper watermark of the run
+    """
+    conn.run("ROLLBACK;")
+    conn.run("START TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY;")
+    return conn.run("SELECT LOCALTIMESTAMP;")[0][0]
+
+
+def end_snapshot(conn: Connection) -> None:
+    """Ends the transaction started by begin_snapshot, export_snapshot or
+    import_snapshot"""
+    conn.run("COMMIT;")
+
+
+def export_snapshot(conn: Connection) -> str:
+    """Starts a REPEATABLE READ, READ ONLY transaction and exports its
+    snapshot, so other connections can read the database as this one sees
+    it with import_snapshot. The snapshot can be imported until the
+    transaction is ended with end_snapshot.
+
+    Args:
+        conn: an open pg8000 connection, not inside a transaction
+
+    Returns:
+        The snapshot id as a string
+    """
+    conn.run("START TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY;")
+    return conn.run("SELECT pg_export_snapshot();")[0][0]
+
+
+def import_snapshot(conn: Connection, snapshot: str) -> None:
+    """Starts a REPEATABLE READ, READ ONLY transaction reading the snapshot
+    exported by export_snapshot. SET TRANSACTION SNAPSHOT does not accept
+    query parameters, so the id is checked before it is written into the
+    statement.
+
+    Args:
+        conn: an open pg8000 connection, not inside a transaction
+        snapshot: snapshot id returned by export_snapshot
+
+    Raises:
+        ValueError: if the snapshot id is not in the form Postgres exports
+    """
+    if not re.fullmatch(r"[0-9A-Fa-f]+(-[0-9A-Fa-f]+)+", snapshot):
+        raise ValueError(f"{snapshot!r} is not a snapshot id")
+    conn.run("START TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY;")
+    conn.run(f"SET TRANSACTION SNAPSHOT '{snapshot}';")
+
+
+def run_in_savepoint(conn: Connection, step, /, *args, **kwargs):
+    """Runs one step of a snapshot extract inside a savepoint. A database
+    error aborts the whole transaction in Postgres, so if the step failed the
+    transaction is rolled back to the savepoint and the snapshot can carry
+    on with the next step.
+
+    Args:
+        conn: a pg8000 connection inside a snapshot transaction
+        step: function to run
+        *args, **kwargs: arguments passed to the function
+
+    Returns:
+        The return value of the function
+    """
+    conn.run("SAVEPOINT snapshot_step;")
+    try:
+        return step(*args, **kwargs)
+    finally:
+        try:
+            conn.run("RELEASE SAVEPOINT snapshot_step;")
+        except DatabaseError:
+            conn.run("ROLLBACK TO SAVEPOINT snapshot_step;")
+            conn.run("RELEASE SAVEPOINT snapshot_step;")
+
+
+def update_tables_in_snapshot(
+    table_list: list,
+    bucket: str,
+    session: boto3.session,
+    time_of_day: datetime,
+    previous_lambda_runtime: datetime | dict,
+    conn: Connection,
+    stream_tables: list = (),
+    file_format: str = "csv",
+    compression: str = None,
+    folder: str = None,
+) -> dict:
+    """Runs update_data_in_bucket for each table on one connection inside the
+    snapshot started by begin_snapshot, so the tables are consistent with
+    each other (a sales_order never refers to a counterparty that is missing
+    from the same run). Each table runs in its own savepoint and the snapshot
+    is ended once every table has been extracted.
+
+    Args:
+        table_list: list of database table names
+        bucket: ingestion bucket name as a string
+        session: Boto3 session
+        time_of_day: datetime returned by begin_snapshot
+        previous_lambda_runtime: datetime of the previous run, or a
+        dictionary of table name to the previous runtime of each table
+        conn: the pg8000 connection the snapshot was started on
+        stream_tables: optional, names of tables to be written with
+        stream_table_to_s3
+        file_format: optional, ingestion file format passed to
+        update_data_in_bucket
+        compression: optional, compression codec passed to
+        update_data_in_bucket
+        folder: optional, ingestion zone folder passed to
+        update_data_in_bucket
+
+    Returns:
+        A dictionary of table name to the response from update_data_in_bucket,
+        in the same order as table_list
+    """
+    results = {}
+    try:
+        for table in table_list:
+            runtime = previous_lambda_runtime
+            if isinstance(runtime, dict):
+                runtime = runtime[table]
+            results[table] = run_in_savepoint(
+                conn,
+                update_data_in_bucket,
+                table,
+                bucket,
+                session,
+                time_of_day,
+                runtime,
+                conn=conn,
+                stream=table in stream_tables,
+                file_format=file_format,
+                compression=compression,
+                folder=folder,
+                in_transaction=True,
+            )
+    finally:
+        end_snapshot(conn)
+    return results
@@ -1,20 +1,36 @@
-from pg8000.native import Connection
-from src.load_lambda.credentials_manager import get_secret
+from pg8000.native import Connection, DatabaseError
+from src.load_lambda.credentials_manager import get_credentials
 
-creds = get_secret()
-
-user = creds["username"]
-password = creds["password"]
-database = creds["dbname"]
-host = creds["host"]
-port = creds["port"]
-schema = creds["schema"]
+AUTH_FAILURE_CODES = {"28000", "28P01"}
 
 
 def connect_to_db() -> Connection:
     """Returns a pg8000 database connection using credentials for the Data
-    Warehouse obtained from AWS SecretsManager via the get_secret function"""
+    Warehouse obtained from AWS SecretsManager via get_credentials. The
+    credentials are fetched on first use and cached, so importing this module
+    doesn't call SecretsManager. If the database rejects the cached
+    credentials they are fetched again and the connection retried once."""
+
+    try:
+        return connect_with(get_credentials())
+    except DatabaseError as de:
+        if not is_auth_failure(de):
+            raise
+        return connect_with(get_credentials(force_refresh=True))
+
 
+def connect_with(creds: dict) -> Connection:
+    """Opens a pg8000 connection using a dictionary of credentials"""
     return Connection(
-        user=user, password=password, database=database, port=port, host=host
+        user=creds["username"],
+        password=creds["password"],
+        database=creds["dbname"],
+        port=creds["port"],
+        host=creds["host"],
     )
+
+
+def is_auth_failure(error: DatabaseError) -> bool:
+    """Checks whether a DatabaseError is Postgres rejecting the login"""
+    details = error.args[0] if error.args else None
+    return isinstance(details, dict) and details.get("C") in AUTH_FAILURE_CODES
@@ -1,6 +1,14 @@
 import boto3
 from botocore.exceptions import ClientError
-import ast
+import json
+import threading
+import time
+
+SECRET_TTL_SECONDS = 900
+
+cached_credentials = None
+cached_at = 0.0
+credentials_lock = threading.Lock()
 
 
 def get_secret() -> dict:
@@ -29,4 +37,33 @@ def get_secret() -> dict:
         raise e
 
     secret = get_secret_value_response["SecretString"]
-    return ast.literal_eval(secret)
+    return json.loads(secret)
+
+
+def get_credentials(force_refresh: bool = False) -> dict:
+    """Returns the Data Warehouse credentials cached by this Lambda container,
+    fetching them from AWS SecretsManager with get_secret on first use or
+    once the cache is older than SECRET_TTL_SECONDS
+
+    Args:
+        force_refresh: fetch the secret again even if the cached copy is
+            still fresh, e.g. after the password has been rotated
+
+    Returns:
+        Dictionary containing secret keys/values"""
+    global cached_credentials, cached_at
+    with credentials_lock:
+        expired = time.monotonic() - cached_at > SECRET_TTL_SECONDS
+        if force_refresh or cached_credentials is None or expired:
+            cached_credentials = get_secret()
+            cached_at = time.monotonic()
+        return cached_credentials
+
+
+def clear_credentials() -> None:
+    """Forgets the cached credentials so the next call to get_credentials
+    fetches them again"""
+    global cached_credentials, cached_at
+    with credentials_lock:
+        cached_credentials = None
+        cached_at = 0.0
@@ -1,10 +1,15 @@
 from src.load_lambda.connection import connect_to_db
+from src.load_lambda.catalogue import get_catalogue, invalidate_catalogue
 from botocore.exceptions import ClientError
 from pg8000.exceptions import DatabaseError
+from pg8000.native import Connection
+from datetime import datetime
 import boto3
+import csv
+import io
+import json
 import logging
 import pandas as pd
-import re
 import awswrangler as wr
 
 
@@ -12,11 +17,16 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
-def sql_security(table: str) -> str:
-    """Checks if the table passed exists in the Data Warehouse
+def sql_security(table: str, conn: Connection = None) -> str:
+    """Checks if the table passed exists in the Data Warehouse, using the
+    cached schema catalogue so the database is only queried when the
+    catalogue needs loading. A table missing from the catalogue causes one
+    reload, in case it was created after the catalogue was cached
 
     Args:
         table: table name as a string
+        conn: optional, an open pg8000 connection used if the catalogue needs
+        loading
 
     Returns:
         table: table name as a string, if it exists in the totesys database
@@ -25,15 +35,11 @@ def sql_security(table: str) -> str:
         DatabaseError: if passed table name is not in the totesys database
     """
 
-    conn = connect_to_db()
-    table_names_unfiltered = conn.run(
-        "SELECT TABLE_NAME FROM postgres.INFORMATION_SCHEMA.TABLES WHERE TABLE_TYPE='BASE TABLE'"
-    )
-    regex = re.compile("(^pg_)|(^sql_)|(^_)")
-    table_names_filtered = [
-        item[0] for item in table_names_unfiltered if not regex.search(item[0])
-    ]
-    if table in table_names_filtered:
+    catalogue = get_catalogue(conn)
+    if not catalogue.has_table(table):
+        invalidate_catalogue()
+        catalogue = get_catalogue(conn)
+    if catalogue.has_table(table):
         return table
     else:
         raise DatabaseError(
@@ -41,14 +47,101 @@ def sql_security(table: str) -> str:
         )
 
 
+def read_run_folder(client: boto3.client) -> str:
+    """Reads the folder written by the latest extract run from the run state
+    (run_state.json) in the ingestion zone. Buckets written before the run
+    state existed only hold last_ran_at.csv, which is used instead if there
+    is no run state.
+
+    Args:
+        client: S3 Boto3 client
+
+    Returns:
+        The folder name: the timestamp of the latest run, or
+        original_data_dump for the first run
+
+    Raises:
+        ClientError if neither file can be read
+    """
+    bucket = "blackwater-ingestion-zone"
+    try:
+        response = client.get_object(Bucket=bucket, Key="run_state.json")
+        return json.loads(response["Body"].read())["folder"]
+    except ClientError as ce:
+        if ce.response["Error"]["Code"] != "NoSuchKey":
+            raise
+    response = client.get_object(Bucket=bucket, Key="last_ran_at.csv")
+    runtime_csv = response["Body"].read().decode("utf-8")
+    last_ran_at = next(csv.DictReader(io.StringIO(runtime_csv)))["last_ran_at"]
+    if datetime.fromisoformat(last_ran_at).year < 2000:
+        return "original_data_dump"
+    return last_ran_at
+
+
+def read_processed_manifest(client: boto3.client, folder: str) -> dict:
+    """Reads the manifest written by the transform lambda to a run folder in
+    the processed zone, which lists the key and row count of each table
+
+    Args:
+        client: S3 Boto3 client
+        folder: the run folder, a timestamp or original_data_dump
+
+    Returns:
+        The manifest as a dictionary, or None if the run has no manifest
+
+    Raises:
+        ClientError if the manifest can't be read for any other reason
+    """
+    try:
+        response = client.get_object(
+            Bucket="blackwater-processed-zone", Key=f"{folder}/manifest.json"
+        )
+        return json.loads(response["Body"].read())
+    except ClientError as ce:
+        if ce.response["Error"]["Code"] != "NoSuchKey":
+            raise
+        return None
+
+
+def list_keys(client: boto3.client, bucket: str, prefix: str) -> list:
+    """Lists every key under a prefix, following list_objects_v2 pages so
+    listings of more than 1000 keys aren't cut short. Scoping the listing to
+    a run's prefix keeps its cost to the files of that run, however much
+    history the bucket holds.
+
+    Args:
+        client: S3 Boto3 client
+        bucket: bucket name as a string
+        prefix: key prefix, e.g. {timestamp}/
+
+    Returns:
+        A list of keys in the order S3 returns them
+
+    Raises:
+        ClientError if the bucket can't be listed
+    """
+    paginator = client.get_paginator("list_objects_v2")
+    return [
+        file["Key"]
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix)
+        for file in page.get("Contents", [])
+    ]
+
+
 def get_latest_processed_file_list(
     client: boto3.client, timestamp_filtered: str = None
 ) -> dict:
-    """Gets a list of most recently updated keys from S3 processed bucket
+    """Gets a list of most recently updated keys from S3 processed bucket.
+    The keys are read from the manifest the transform lambda writes to the
+    run folder, skipping tables with no rows, so the bucket is only listed
+    for runs from before the manifest was written, and then only under the
+    run's prefix
 
     Args:
         client: S3 Boto3 client
-        timestamp_filtered: datetime timestamp stored as a string
+        timestamp_filtered: optional, datetime timestamp stored as a string.
+        If not given the folder of the latest run is read with
+        read_run_folder
 
     Returns:
         A dictionary containing the following:
@@ -58,27 +151,23 @@ def get_latest_processed_file_list(
     """
 
     bucket = "blackwater-processed-zone"
-    runtime_key = "last_ran_at.csv"
     if not timestamp_filtered:
-        get_previous_runtime = client.get_object(
-            Bucket="blackwater-ingestion-zone", Key=runtime_key
-        )
-        timestamp = get_previous_runtime["Body"].read().decode("utf-8")
-        timestamp_filtered = timestamp[12:-8]
+        timestamp_filtered = read_run_folder(client)
+    folder = timestamp_filtered
+    if timestamp_filtered == "1999-12-31 23:59:59":
+        folder = "original_data_dump"
     try:
-        output = client.list_objects_v2(Bucket=bucket)
-        if timestamp_filtered != "1999-12-31 23:59:59":
-            file_list = [
-                file["Key"]
-                for file in output["Contents"]
-                if timestamp_filtered in file["Key"]
-            ]
-        else:
-            file_list = [
-                file["Key"]
-                for file in output["Contents"]
-                if "original_data_dump" in file["Key"]
-            ]
+        manifest = read_processed_manifest(client, folder)
+        if manifest is not None:
+            return {
+                "status": "success",
+                "file_list": sorted(
+                    table["key"]
+                    for table in manifest["tables"].values()
+                    if table["rows"]
+                ),
+            }
+        file_list = list_keys(client, bucket, f"{folder}/")
         return {
             "status": "success",
             "file_list": file_list,
@@ -156,7 +245,7 @@ def insert_data_into_data_warehouse(
     if data["status"] == "success":
         try:
             table_name = pq_key.split("/")[-1][:-8]
-            table_name = sql_security(table_name)
+            table_name = sql_security(table_name, connection)
             query = get_insert_query(
                 table_name=table_name, dataframe=data["data"]
             )
@@ -7,13 +7,18 @@ from src.transform_lambda.transform_funcs import (
     convert_staff,
     create_dim_dates,
     convert_purchase_order,
+    INPUT_FILES,
 )
 from src.transform_lambda.utils import (
     write_parquet_data_to_s3,
-    read_latest_changes,
+    write_processed_manifest,
+    get_run_context,
+    prefetch_inputs,
+    PREFETCH_WORKERS,
 )
 import boto3
 import logging
+import os
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -21,32 +26,50 @@ logger.setLevel(logging.INFO)
 
 def lambda_handler(event, context) -> None:
     """Lambda handler function to read data from the S3 ingestion zone,
-    transform the data and load into the S3 processed zone
+    transform the data and load into the S3 processed zone. The run context
+    (the run folder, its files and whether it is the original data dump) is
+    resolved once and passed to every converter. The files the converters
+    read (INPUT_FILES) are fetched into the run's cache concurrently first,
+    on up to TRANSFORM_PREFETCH_WORKERS threads.
 
     Args:
         Lambda function expects event and context, but are unused within the
-        function
+        function. The run context is kept in run_context so it doesn't
+        shadow the Lambda context
     """
 
     session = boto3.session.Session(region_name="eu-west-2")
     client = session.client("s3")
 
-    curr = convert_currency(client, session)
-    cp = convert_counterparty(client, session)
-    des = convert_design(client, session)
-    loc = convert_location(client, session)
-    stf = convert_staff(client, session)
-    sales = convert_sales_order(client, session)
-    date = create_dim_dates(client)
+    run_context = get_run_context(client)
+    if run_context["status"] == "success":
+        max_workers = int(
+            os.environ.get("TRANSFORM_PREFETCH_WORKERS", PREFETCH_WORKERS)
+        )
+        resp = prefetch_inputs(session, run_context, INPUT_FILES, max_workers)
+        logging.info(resp)
+
+    curr = convert_currency(client, session, run_context=run_context)
+    cp = convert_counterparty(client, session, run_context=run_context)
+    des = convert_design(client, session, run_context=run_context)
+    loc = convert_location(client, session, run_context=run_context)
+    stf = convert_staff(client, session, run_context=run_context)
+    sales = convert_sales_order(client, session, run_context=run_context)
+    date = create_dim_dates(client, run_context=run_context)
+
+    if "cache" in run_context:
+        logging.info(f"Input cache: {run_context['cache'].stats()}")
 
     counter = 0
-    timestamp = read_latest_changes(client)["timestamp"]
+    written = []
+    timestamp = run_context["timestamp"]
 
     if curr["status"] == "success":
         resp = write_parquet_data_to_s3(
             curr["data"], "dim_currency", session, timestamp=timestamp
         )
         counter += 1
+        written.append(resp)
         logging.info(resp)
     else:
         print("currency not written")
@@ -57,6 +80,7 @@ def lambda_handler(event, context) -> None:
             cp["data"], "dim_counterparty", session, timestamp=timestamp
         )
         counter += 1
+        written.append(resp)
         logging.info(resp)
     else:
         print("counterparty not written")
@@ -67,6 +91,7 @@ def lambda_handler(event, context) -> None:
             des["data"], "dim_design", session, timestamp=timestamp
         )
         counter += 1
+        written.append(resp)
         logging.info(resp)
     else:
         print("design not written")
@@ -77,6 +102,7 @@ def lambda_handler(event, context) -> None:
             loc["data"], "dim_location", session, timestamp=timestamp
         )
         counter += 1
+        written.append(resp)
         logging.info(resp)
     else:
         print("location not written")
@@ -87,6 +113,7 @@ def lambda_handler(event, context) -> None:
             stf["data"], "dim_staff", session, timestamp=timestamp
         )
         counter += 1
+        written.append(resp)
         logging.info(resp)
     else:
         print("staff not written")
@@ -97,6 +124,7 @@ def lambda_handler(event, context) -> None:
             sales["data"], "fact_sales_order", session, timestamp=timestamp
         )
         counter += 1
+        written.append(resp)
         logging.info(resp)
     else:
         print("sales not written")
@@ -107,19 +135,22 @@ def lambda_handler(event, context) -> None:
             date["data"], "dim_date", session, timestamp=timestamp
         )
         counter += 1
+        written.append(resp)
         logging.info(resp)
     else:
         print("date not written")
         logging.info(date)
 
     if counter > 0:
+        resp = write_processed_manifest(client, timestamp, written)
+        logging.info(resp)
         s3 = boto3.resource("s3")
         bucket = s3.Bucket("blackwater-processed-zone")
         copy_source = {
             "Bucket": "blackwater-ingestion-zone",
-            "Key": "last_ran_at.csv",
+            "Key": "run_state.json",
         }
-        bucket.copy(copy_source, "last_ran_at.csv")
+        bucket.copy(copy_source, "run_state.json")
 
     message = f"Updated {counter} tables"
     logging.info(message)
@@ -3,16 +3,33 @@ import pandas as pd
 from src.transform_lambda.utils import (
     read_latest_changes,
     get_data_from_ingestion_bucket,
+    join_dimension,
 )
 
-
-def convert_design(client: boto3.client, session: boto3.session) -> dict:
+INPUT_FILES = [
+    ("design.csv", True),
+    ("currency.csv", True),
+    ("staff.csv", True),
+    ("department.csv", False),
+    ("address.csv", True),
+    ("address.csv", False),
+    ("counterparty.csv", True),
+    ("sales_order.csv", True),
+]
+
+
+def convert_design(
+    client: boto3.client, session: boto3.session, run_context: dict = None
+) -> dict:
     """Downloads data from S3 ingestion bucket and transforms it into a pandas
     dataframe, relating to the design table
 
     Args:
         client: Boto3 client
         session: Boto3 session
+        run_context: optional, run context from get_run_context, whose input
+        cache the files are read through. If not given the latest changes
+        are read from the ingestion bucket
 
     Returns:
         A dictionary containing the following:
@@ -23,7 +40,7 @@ def convert_design(client: boto3.client, session: boto3.session) -> dict:
         util functions are returned
     """
 
-    response1 = read_latest_changes(client)
+    response1 = run_context or read_latest_changes(client)
     if response1["status"] == "success":
         key = response1["timestamp"]
     else:
@@ -31,7 +48,9 @@ def convert_design(client: boto3.client, session: boto3.session) -> dict:
         return response1
 
     filename = "design.csv"
-    response2 = get_data_from_ingestion_bucket(key, filename, session)
+    response2 = get_data_from_ingestion_bucket(
+        key, filename, session, cache=response1.get("cache")
+    )
 
     if response2["status"] == "success":
         df_design = response2["data"]
@@ -44,13 +63,18 @@ def convert_design(client: boto3.client, session: boto3.session) -> dict:
     return output
 
 
-def convert_currency(client: boto3.client, session: boto3.session) -> dict:
+def convert_currency(
+    client: boto3.client, session: boto3.session, run_context: dict = None
+) -> dict:
     """Downloads data from S3 ingestion bucket and transforms it into a pandas
     dataframe, relating to the currency table
 
     Args:
         client: Boto3 client
         session: Boto3 session
+        run_context: optional, run context from get_run_context, whose input
+        cache the files are read through. If not given the latest changes
+        are read from the ingestion bucket
 
     Returns:
         A dictionary containing the following:
@@ -61,7 +85,7 @@ def convert_currency(client: boto3.client, session: boto3.session) -> dict:
         util functions are returned
     """
 
-    response1 = read_latest_changes(client)
+    response1 = run_context or read_latest_changes(client)
     if response1["status"] == "success":
         key = response1["timestamp"]
     else:
@@ -69,7 +93,9 @@ def convert_currency(client: boto3.client, session: boto3.session) -> dict:
         return response1
 
     filename = "currency.csv"
-    response2 = get_data_from_ingestion_bucket(key, filename, session)
+    response2 = get_data_from_ingestion_bucket(
+        key, filename, session, cache=response1.get("cache")
+    )
 
     if response2["status"] == "success":
         df = response2["data"]
@@ -98,13 +124,18 @@ def convert_currency(client: boto3.client, session: boto3.session) -> dict:
     return output
 
 
-def convert_staff(client: boto3.client, session: boto3.session) -> dict:
+def convert_staff(
+    client: boto3.client, session: boto3.session, run_context: dict = None
+) -> dict:
     """Downloads data from S3 ingestion bucket and transforms it into a pandas
     dataframe, relating to the staff table
 
     Args:
         client: Boto3 client
         session: Boto3 session
+        run_context: optional, run context from get_run_context, whose input
+        cache the files are read through. If not given the latest changes
+        are read from the ingestion bucket
 
     Returns:
         A dictionary containing the following:
@@ -115,7 +146,7 @@ def convert_staff(client: boto3.client, session: boto3.session) -> dict:
         util functions are returned
     """
 
-    response1 = read_latest_changes(client)
+    response1 = run_context or read_latest_changes(client)
     if response1["status"] == "success":
         key = response1["timestamp"]
     else:
@@ -125,39 +156,34 @@ def convert_staff(client: boto3.client, session: boto3.session) -> dict:
     filename1 = "staff.csv"
     filename2 = "department.csv"
 
-    response_staff = get_data_from_ingestion_bucket(key, filename1, session)
+    response_staff = get_data_from_ingestion_bucket(
+        key, filename1, session, cache=response1.get("cache")
+    )
     response_department = get_data_from_ingestion_bucket(
-        key, filename2, session, update=False
+        key, filename2, session, update=False, cache=response1.get("cache")
     )
 
     if response_staff["status"] == "success":
         df_staff = response_staff["data"]
         df_staff = df_staff.drop(["created_at", "last_updated"], axis=1)
-        staff_table_as_dict = df_staff.to_dict()
     else:
         return response_staff
 
     if response_department["status"] == "success":
         df_dep = response_department["data"]
-        df_dep = df_dep.drop(["manager", "created_at", "last_updated"], axis=1)
-        dep_table_as_dict = df_dep.to_dict()
     else:
         return response_department
 
-    dep_id_dict = staff_table_as_dict["department_id"]
-
     loc = "location"
     d_n = "department_name"
 
-    staff_table_as_dict[loc] = {}
-    staff_table_as_dict[d_n] = {}
-
-    for key in dep_id_dict:
-        id = dep_id_dict[key]
-        staff_table_as_dict[d_n][key] = dep_table_as_dict[d_n][id - 1]
-        staff_table_as_dict[loc][key] = dep_table_as_dict[loc][id - 1]
-
-    df_staff = pd.DataFrame(staff_table_as_dict)
+    df_staff = join_dimension(
+        df_staff,
+        df_dep,
+        "department_id",
+        "department_id",
+        {d_n: d_n, loc: loc},
+    )
     df_staff = df_staff[
         ["staff_id", "first_name", "last_name", d_n, loc, "email_address"]
     ]
@@ -168,7 +194,10 @@ def convert_staff(client: boto3.client, session: boto3.session) -> dict:
 
 
 def convert_location(
-    client: boto3.client, session: boto3.session, update: bool = False
+    client: boto3.client,
+    session: boto3.session,
+    update: bool = False,
+    run_context: dict = None,
 ):
     """Downloads data from S3 ingestion bucket and transforms it into a pandas
     dataframe, relating to the location table
@@ -177,6 +206,9 @@ def convert_location(
         client: Boto3 client
         session: Boto3 session
         update: optional, defaults to False
+        run_context: optional, run context from get_run_context, whose input
+        cache the files are read through. If not given the latest changes
+        are read from the ingestion bucket
 
     Returns:
         A dictionary containing the following:
@@ -187,14 +219,16 @@ def convert_location(
         util functions are returned
     """
 
-    response1 = read_latest_changes(client)
+    response1 = run_context or read_latest_changes(client)
     if response1["status"] == "success":
         key = response1["timestamp"]
     else:
         return response1
 
     filename = "address.csv"
-    response2 = get_data_from_ingestion_bucket(key, filename, session)
+    response2 = get_data_from_ingestion_bucket(
+        key, filename, session, cache=response1.get("cache")
+    )
 
     if response2["status"] == "success":
         df = response2["data"]
@@ -215,13 +249,18 @@ def convert_location(
     return output
 
 
-def convert_counterparty(client: boto3.client, session: boto3.session) -> dict:
+def convert_counterparty(
+    client: boto3.client, session: boto3.session, run_context: dict = None
+) -> dict:
     """Downloads data from S3 ingestion bucket and transforms it into a pandas
     dataframe, relating to the counterparty table
 
     Args:
         client: Boto3 client
         session: Boto3 session
+        run_context: optional, run context from get_run_context, whose input
+        cache the files are read through. If not given the latest changes
+        are read from the ingestion bucket
 
     Returns:
         A dictionary containing the following:
@@ -232,7 +271,7 @@ def convert_counterparty(client: boto3.client, session: boto3.session) -> dict:
         util functions are returned
     """
 
-    response1 = read_latest_changes(client)
+    response1 = run_context or read_latest_changes(client)
     if response1["status"] == "success":
         key = response1["timestamp"]
     else:
@@ -242,57 +281,41 @@ def convert_counterparty(client: boto3.client, session: boto3.session) -> dict:
     filename_counter = "counterparty.csv"
 
     response_address = get_data_from_ingestion_bucket(
-        key, filename_address, session, update=False
+        key,
+        filename_address,
+        session,
+        update=False,
+        cache=response1.get("cache"),
     )
     response_counter = get_data_from_ingestion_bucket(
-        key, filename_counter, session
+        key, filename_counter, session, cache=response1.get("cache")
     )
 
     if response_counter["status"] == "success":
         df_counter = response_counter["data"]
-        dict_counter = df_counter.to_dict()
     else:
         return response_counter
 
     if response_address["status"] == "success":
         df_address = response_address["data"]
-        dict_address = df_address.to_dict()
     else:
         return response_address
 
-    location_ids = dict_counter["legal_address_id"]
-    dict_counter["counterparty_legal_address_line_1"] = {}
-    dict_counter["counterparty_legal_address_line_2"] = {}
-    dict_counter["counterparty_legal_district"] = {}
-    dict_counter["counterparty_legal_city"] = {}
-    dict_counter["counterparty_legal_postal_code"] = {}
-    dict_counter["counterparty_legal_country"] = {}
-    dict_counter["counterparty_legal_phone_number"] = {}
-
-    for key in location_ids:
-        ids = location_ids[key]
-        dict_counter["counterparty_legal_address_line_1"][key] = dict_address[
-            "address_line_1"
-        ][ids - 1]
-        dict_counter["counterparty_legal_address_line_2"][key] = dict_address[
-            "address_line_2"
-        ][ids - 1]
-        dict_counter["counterparty_legal_district"][key] = dict_address[
-            "district"
-        ][ids - 1]
-        dict_counter["counterparty_legal_city"][key] = dict_address["city"][
-            ids - 1
-        ]
-        dict_counter["counterparty_legal_postal_code"][key] = dict_address[
-            "postal_code"
-        ][ids - 1]
-        dict_counter["counterparty_legal_country"][key] = dict_address[
-            "country"
-        ][ids - 1]
-        dict_counter["counterparty_legal_phone_number"][key] = dict_address[
-            "phone"
-        ][ids - 1]
-    df_counter = pd.DataFrame(dict_counter)
+    df_counter = join_dimension(
+        df_counter,
+        df_address,
+        "legal_address_id",
+        "address_id",
+        {
+            "address_line_1": "counterparty_legal_address_line_1",
+            "address_line_2": "counterparty_legal_address_line_2",
+            "district": "counterparty_legal_district",
+            "city": "counterparty_legal_city",
+            "postal_code": "counterparty_legal_postal_code",
+            "country": "counterparty_legal_country",
+            "phone": "counterparty_legal_phone_number",
+        },
+    )
     df_counter = df_counter.drop(
         [
             "legal_address_id",
@@ -307,13 +330,22 @@ def convert_counterparty(client: boto3.client, session: boto3.session) -> dict:
     return output
 
 
-def convert_sales_order(client: boto3.client, session: boto3.session) -> dict:
+def convert_sales_order(
+    client: boto3.client, session: boto3.session, run_context: dict = None
+) -> dict:
     """Downloads data from S3 ingestion bucket and transforms it into a pandas
-    dataframe, relating to the sales_order table
+    dataframe, relating to the sales_order table. created_at and
+    last_updated are parsed once (Parquet inputs are already typed) and
+    split into dates and times with .dt.date and .dt.time, which are
+    written as ISO strings for the warehouse INSERT. A missing timestamp
+    is left empty
 
     Args:
         client: Boto3 client
         session: Boto3 session
+        run_context: optional, run context from get_run_context, whose input
+        cache the files are read through. If not given the latest changes
+        are read from the ingestion bucket
 
     Returns:
         A dictionary containing the following:
@@ -323,7 +355,7 @@ def convert_sales_order(client: boto3.client, session: boto3.session) -> dict:
         If unsuccessful the dictionaries containing failure messages from the
         util functions are returned
     """
-    response1 = read_latest_changes(client)
+    response1 = run_context or read_latest_changes(client)
     if response1["status"] == "success":
         key = response1["timestamp"]
     else:
@@ -331,43 +363,34 @@ def convert_sales_order(client: boto3.client, session: boto3.session) -> dict:
         return response1
     filename_sales = "sales_order.csv"
     response_sales = get_data_from_ingestion_bucket(
-        key, filename_sales, session
+        key, filename_sales, session, cache=response1.get("cache")
     )
 
     if response_sales["status"] == "success":
         df_sales = response_sales["data"]
-        sales_dict = df_sales.to_dict()
     else:
         return response_sales
 
-    created_date = {}
-    created_time = {}
-
-    for key in sales_dict["created_at"]:
-        timestamp = sales_dict["created_at"][key]
-        splitted = timestamp.split()
-        date = splitted[0]
-        time = splitted[1]
-        created_date[key] = date
-        created_time[key] = time
-
-    last_updated_date = {}
-    last_updated_time = {}
-    for key in sales_dict["last_updated"]:
-        timestamp = sales_dict["last_updated"][key]
-        splitted = timestamp.split()
-        date = splitted[0]
-        time = splitted[1]
-        last_updated_date[key] = date
-        last_updated_time[key] = time
-
-    sales_dict["created_date"] = created_date
-    sales_dict["created_time"] = created_time
-    sales_dict["last_updated_date"] = last_updated_date
-    sales_dict["last_updated_time"] = last_updated_time
-
-    df_sales = pd.DataFrame(sales_dict)
+    columns = {}
+    for prefix, column in [
+        ("created", "created_at"),
+        ("last_updated", "last_updated"),
+    ]:
+        timestamps = pd.to_datetime(df_sales[column], format="ISO8601")
+        columns[f"{prefix}_date"] = timestamps.dt.date.map(
+            lambda value: value.isoformat(), na_action="ignore"
+        )
+        columns[f"{prefix}_time"] = timestamps.dt.time.map(
+            lambda value: value.isoformat(timespec="milliseconds"),
+            na_action="ignore",
+        )
+    for column in ["agreed_payment_date", "agreed_delivery_date"]:
+        columns[column] = pd.to_datetime(df_sales[column]).dt.strftime(
+            "%Y-%m-%d"
+        )
+
     df_sales = df_sales.drop(["created_at", "last_updated"], axis=1)
+    df_sales = df_sales.assign(**columns)
     df_sales = df_sales.rename(columns={"staff_id": "sales_staff_id"})
     df_sales = df_sales.loc[
         :,
@@ -394,7 +417,10 @@ def convert_sales_order(client: boto3.client, session: boto3.session) -> dict:
 
 
 def create_dim_dates(
-    client: boto3.client, start: str = "2020-01-01", end: str = "2030-01-01"
+    client: boto3.client,
+    start: str = "2020-01-01",
+    end: str = "2030-01-01",
+    run_context: dict = None,
 ):
     """Downloads data from S3 ingestion bucket and transforms it into a pandas
     dataframe, relating to the design table
@@ -403,6 +429,8 @@ def create_dim_dates(
         client: Boto3 client
         start: optional, string containing start date for dim_date table
         end: optional, string containing end date for dim_date table
+        run_context: optional, run context from get_run_context. If not given
+        the latest changes are read from the ingestion bucket
 
     Returns:
         A dictionary containing the following:
@@ -412,7 +440,7 @@ def create_dim_dates(
             message: an error message (if unsucessful)
     """
 
-    response = read_latest_changes(client)
+    response = run_context or read_latest_changes(client)
     if response["timestamp"] != "original_data_dump":
         output = {"status": "failure", "message": "dim date already set"}
         return output
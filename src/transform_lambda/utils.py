@@ -3,10 +3,157 @@ from botocore.exceptions import ClientError
 import pandas as pd
 import awswrangler as wr
 from awswrangler.exceptions import NoFilesFound
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import csv
+import io
+import json
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+INGESTION_EXTENSIONS = ["parquet", "csv.zst", "csv.gz", "csv"]
+CSV_COMPRESSION = {".csv.gz": "gzip", ".csv.zst": "zstd"}
+PREFETCH_WORKERS = 8
+
+
+class InputCache:
+    """Holds the ingestion files read during one transform run, parsed into
+    dataframes and keyed by S3 key, with the ETag each was read at. Several
+    converters read the same file (address.csv for dim_location and
+    dim_counterparty), so with a cache each file is downloaded and parsed
+    once per run. Files in a run folder are written once by the extract
+    lambda, so a cached file isn't checked against S3 again. The manifest of
+    each run folder is kept too. The cache can be filled from several
+    threads (see prefetch_inputs).
+
+    A cache is created per invocation by get_run_context and isn't shared
+    between runs.
+    """
+
+    def __init__(self):
+        self.files = {}
+        self.manifests = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> pd.DataFrame:
+        """Returns the cached dataframe of a key, or None if it hasn't been
+        read yet, counting the lookup as a hit or a miss"""
+        with self.lock:
+            if key in self.files:
+                self.hits += 1
+                return self.files[key]["data"]
+            self.misses += 1
+            return None
+
+    def put(self, key: str, etag: str, data: pd.DataFrame) -> None:
+        """Stores the dataframe parsed from a key"""
+        with self.lock:
+            self.files[key] = {"etag": etag, "data": data}
+
+    def stats(self) -> dict:
+        """Returns the hit and miss counts and the number of files held"""
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "files": len(self.files),
+            }
+
+
+def read_run_folder(client: boto3.client) -> str:
+    """Reads the ingestion zone folder written by the latest extract run from
+    the run state (run_state.json). Buckets written before the run state
+    existed only hold last_ran_at.csv, which is used instead if there is no
+    run state.
+
+    Args:
+        client: S3 Boto3 client
+
+    Returns:
+        The folder name: the timestamp of the latest run, or
+        original_data_dump for the first run
+
+    Raises:
+        ClientError if neither file can be read
+    """
+    bucket = "blackwater-ingestion-zone"
+    try:
+        response = client.get_object(Bucket=bucket, Key="run_state.json")
+        return json.loads(response["Body"].read())["folder"]
+    except ClientError as ce:
+        if ce.response["Error"]["Code"] != "NoSuchKey":
+            raise
+    response = client.get_object(Bucket=bucket, Key="last_ran_at.csv")
+    runtime_csv = response["Body"].read().decode("utf-8")
+    last_ran_at = next(csv.DictReader(io.StringIO(runtime_csv)))["last_ran_at"]
+    if datetime.fromisoformat(last_ran_at).year < 2000:
+        return "original_data_dump"
+    return last_ran_at
+
+
+def list_keys(client: boto3.client, bucket: str, prefix: str) -> list:
+    """Lists every key under a prefix, following list_objects_v2 pages so
+    listings of more than 1000 keys aren't cut short. Scoping the listing to
+    a run's prefix keeps its cost to the files of that run, however much
+    history the bucket holds.
+
+    Args:
+        client: S3 Boto3 client
+        bucket: bucket name as a string
+        prefix: key prefix, e.g. ingested_data/{timestamp}/
+
+    Returns:
+        A list of keys in the order S3 returns them
+
+    Raises:
+        ClientError if the bucket can't be listed
+    """
+    paginator = client.get_paginator("list_objects_v2")
+    return [
+        file["Key"]
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix)
+        for file in page.get("Contents", [])
+    ]
+
+
+def read_run_manifest(client: boto3.client, folder: str) -> dict:
+    """Reads the manifest written by the extract lambda to a run folder in
+    the ingestion zone, which lists the files, row count and columns of
+    each table extracted in the run
+
+    Args:
+        client: S3 Boto3 client
+        folder: the run folder, a timestamp or original_data_dump
+
+    Returns:
+        The manifest as a dictionary, or None if the run has no manifest
+        (runs from before the manifest was written)
+
+    Raises:
+        ClientError if the manifest can't be read for any other reason
+    """
+    try:
+        response = client.get_object(
+            Bucket="blackwater-ingestion-zone",
+            Key=f"ingested_data/{folder}/manifest.json",
+        )
+        return json.loads(response["Body"].read())
+    except ClientError as ce:
+        if ce.response["Error"]["Code"] != "NoSuchKey":
+            raise
+        return None
 
 
 def read_latest_changes(client: boto3.client) -> dict:
-    """Gets a list of most recently updated keys from S3 ingestion bucket
+    """Gets a list of most recently updated keys from S3 ingestion bucket.
+    The keys are read from the run's manifest if it has one, so the bucket
+    is only listed for runs from before the manifest was written, and then
+    only under the run's prefix
 
     Args:
         client: S3 Boto3 client
@@ -15,39 +162,31 @@ def read_latest_changes(client: boto3.client) -> dict:
         A dictionary containing the following:
             status: shows whether the function ran successfully
             timestamp: the datetime that the most recent data was written to
-            the ingestion zone
+            the ingestion zone, or original_data_dump for the first run
             file_list: a list of keys from the most recent folder in the
             ingestion zone
     """
     try:
-        output = client.list_objects_v2(Bucket="blackwater-ingestion-zone")
-        file_data = sorted(
-            [k for k in output["Contents"]],
-            key=lambda k: k["Key"],
-            reverse=True,
-        )
-        runtime_key = "last_ran_at.csv"
-        get_previous_runtime = client.get_object(
-            Bucket="blackwater-ingestion-zone", Key=runtime_key
-        )
-        timestamp = get_previous_runtime["Body"].read().decode("utf-8")
-        timestamp_filtered = timestamp.split("\n")[1]
-
-        year = int(timestamp_filtered[0:4])
-
-        if year < 2000:
-            file_list = [
-                file["Key"]
-                for file in file_data
-                if "original_data_dump" in file["Key"]
-            ]
-            timestamp_filtered = "original_data_dump"
+        timestamp_filtered = read_run_folder(client)
+        manifest = read_run_manifest(client, timestamp_filtered)
+        if manifest is not None:
+            file_list = sorted(
+                [
+                    file["key"]
+                    for table in manifest["tables"].values()
+                    for file in table["files"]
+                ],
+                reverse=True,
+            )
         else:
-            file_list = [
-                file["Key"]
-                for file in file_data
-                if timestamp_filtered in file["Key"]
-            ]
+            file_list = sorted(
+                list_keys(
+                    client,
+                    "blackwater-ingestion-zone",
+                    f"ingested_data/{timestamp_filtered}/",
+                ),
+                reverse=True,
+            )
 
         return {
             "status": "success",
@@ -63,20 +202,59 @@ def read_latest_changes(client: boto3.client) -> dict:
         }
 
 
+def get_run_context(client: boto3.client) -> dict:
+    """Resolves what a transform run works on once per invocation, so the
+    converters don't each read the run state and list the bucket again
+
+    Args:
+        client: S3 Boto3 client
+
+    Returns:
+        The response of read_latest_changes (status, timestamp and
+        file_list, or a failure message), with two keys added on success:
+            run_type: original_data_dump for the first run, otherwise update
+            cache: an empty InputCache the converters read their files
+            through
+    """
+    run_context = read_latest_changes(client)
+    if run_context["status"] == "success":
+        run_context["run_type"] = (
+            "original_data_dump"
+            if run_context["timestamp"] == "original_data_dump"
+            else "update"
+        )
+        run_context["cache"] = InputCache()
+    return run_context
+
+
 def get_data_from_ingestion_bucket(
     key: str,
     filename: str,
     session: boto3.session.Session,
     update: bool = True,
+    cache: InputCache = None,
 ) -> dict:
-    """Downloads csv data from S3 ingestion bucket and returns a pandas
-    dataframe
+    """Downloads table data from S3 ingestion bucket and returns a pandas
+    dataframe. The file written by the extract lambda may be plain CSV,
+    gzip or zstd compressed CSV (.csv.gz, .csv.zst) or Parquet, so the
+    table's files are listed and the format is detected from the extension.
+    Compressed files are decompressed and Parquet files keep their dtypes.
+    A large table may have been extracted as several part files (e.g.
+    sales_order.part-0000.csv), which are read together as one table.
+    If the run has a manifest the table's files are taken from it instead
+    of listing the bucket, and a table it lists with no rows isn't read.
+    Files written from the CDC source have cdc_operation and cdc_lsn
+    columns; their delete markers are dropped, as the warehouse keeps
+    deleted rows, and so are the two columns.
 
     Args:
         key: string representing S3 object to be downloaded
+        filename: name of the table file, e.g. staff.csv
         session: Boto3 session
         update: optional argument that is used to determine if full dataset or
         just updates are transformed
+        cache: optional, InputCache of the run. Files already read by another
+        converter are taken from it instead of being downloaded again
 
     Returns:
         A dictionary containing the following:
@@ -84,12 +262,25 @@ def get_data_from_ingestion_bucket(
             data: a pandas dataframe containing downloaded data (if successful)
             message: a relevant error message (if unsuccessful)
     """
-    if update:
-        path = f"s3://blackwater-ingestion-zone/ingested_data/{key}/{filename}"
-    else:
-        path = f"s3://blackwater-ingestion-zone/ingested_data/original_data_dump/{filename}"
+    bucket = "blackwater-ingestion-zone"
+    folder = key if update else "original_data_dump"
+    table = filename.split(".")[0]
     try:
-        df = wr.s3.read_csv(path=path, boto3_session=session)
+        client = session.client("s3")
+        object_keys = get_ingestion_keys(client, folder, table, cache)
+        if not object_keys:
+            return {"status": "failure", "message": "no new data"}
+        df = pd.concat(
+            [
+                read_ingestion_object(client, bucket, object_key, cache)
+                for object_key in object_keys
+            ],
+            ignore_index=True,
+        )
+        if "cdc_operation" in df.columns:
+            df = df[df["cdc_operation"] != "DELETE"]
+            df = df.drop(columns=["cdc_operation", "cdc_lsn"])
+            df = df.reset_index(drop=True)
         return {"status": "success", "data": df}
     except ClientError as ce:
         return {"status": "failure", "message": ce.response}
@@ -97,6 +288,236 @@ def get_data_from_ingestion_bucket(
         return {"status": "failure", "message": nff}
 
 
+def get_ingestion_keys(
+    client: boto3.client, folder: str, table: str, cache: InputCache = None
+) -> list:
+    """Finds the keys of the files a table was extracted to in a run folder,
+    from the run's manifest if it has one, otherwise by listing the table's
+    prefix. The manifest is kept in the cache, so it is read once per run
+    however many tables are looked up.
+
+    Args:
+        client: S3 Boto3 client
+        folder: the run folder, a timestamp or original_data_dump
+        table: table name, e.g. staff
+        cache: optional, InputCache of the run
+
+    Returns:
+        A list of keys (several for a table extracted as part files), empty
+        if the manifest lists the table with no rows. Without a manifest the
+        plain CSV key is returned if no file was found, so reading it raises
+        NoFilesFound
+
+    Raises:
+        ClientError if the manifest can't be read or the bucket listed
+    """
+    if cache is not None and folder in cache.manifests:
+        manifest = cache.manifests[folder]
+    else:
+        manifest = read_run_manifest(client, folder)
+        if cache is not None:
+            cache.manifests[folder] = manifest
+    if manifest is not None and table in manifest["tables"]:
+        if not manifest["tables"][table]["rows"]:
+            return []
+        return [file["key"] for file in manifest["tables"][table]["files"]]
+    prefix = f"ingested_data/{folder}/{table}."
+    keys = list_keys(client, "blackwater-ingestion-zone", prefix)
+    return find_ingestion_parts(keys, prefix) or [
+        find_ingestion_file(keys, prefix)
+    ]
+
+
+def prefetch_inputs(
+    session: boto3.session.Session,
+    run_context: dict,
+    inputs: list,
+    max_workers: int = PREFETCH_WORKERS,
+) -> dict:
+    """Downloads every file the converters will read into the run's cache
+    before they run, on a bounded thread pool, so the run waits for roughly
+    one S3 round trip instead of one per file. The keys are looked up first
+    (from the manifest, or by listing), then fetched concurrently. A file
+    that can't be fetched is left out of the cache, and the converter that
+    reads it reports the error as before.
+
+    Args:
+        session: Boto3 session
+        run_context: run context from get_run_context
+        inputs: list of (filename, update) tuples, as passed to
+        get_data_from_ingestion_bucket, e.g. ("address.csv", False)
+        max_workers: optional, maximum number of files fetched at the same
+        time
+
+    Returns:
+        A dictionary containing the following:
+            files: number of files fetched into the cache
+            failed: list of the keys that couldn't be fetched
+    """
+    bucket = "blackwater-ingestion-zone"
+    cache = run_context["cache"]
+    client = session.client("s3")
+    tables = {
+        (
+            run_context["timestamp"] if update else "original_data_dump",
+            filename,
+        )
+        for filename, update in inputs
+    }
+    object_keys = []
+    for folder, filename in sorted(tables):
+        try:
+            table_keys = get_ingestion_keys(
+                client, folder, filename.split(".")[0], cache
+            )
+        except ClientError as ce:
+            logger.warning(f"Inputs of {filename} not found: {ce}")
+            continue
+        object_keys += [key for key in table_keys if key not in object_keys]
+
+    def fetch(key: str) -> str:
+        try:
+            read_ingestion_object(client, bucket, key, cache)
+        except (ClientError, NoFilesFound) as error:
+            logger.warning(f"Prefetch of {key} failed: {error}")
+            return key
+        return None
+
+    with ThreadPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+        failed = [key for key in executor.map(fetch, object_keys) if key]
+    return {"files": len(object_keys) - len(failed), "failed": failed}
+
+
+def read_ingestion_object(
+    client: boto3.client,
+    bucket: str,
+    key: str,
+    cache: InputCache = None,
+) -> pd.DataFrame:
+    """Downloads one file written by the extract lambda and parses it into a
+    dataframe, or takes it from the run's cache if it has already been read.
+    The cached dataframe is returned as is, so callers concatenate or copy
+    it before changing it.
+
+    Args:
+        client: S3 Boto3 client
+        bucket: bucket name as a string
+        key: key of a CSV (optionally gzip or zstd compressed) or Parquet
+        file
+        cache: optional, InputCache of the run
+
+    Returns:
+        The file's data as a pandas dataframe
+
+    Raises:
+        NoFilesFound if the file doesn't exist
+        ClientError if it can't be read for any other reason
+    """
+    if cache is not None:
+        data = cache.get(key)
+        if data is not None:
+            return data
+    try:
+        response = client.get_object(Bucket=bucket, Key=key)
+    except ClientError as ce:
+        if ce.response["Error"]["Code"] != "NoSuchKey":
+            raise
+        raise NoFilesFound(f"No files Found on: s3://{bucket}/{key}.")
+    body = io.BytesIO(response["Body"].read())
+    if key.endswith(".parquet"):
+        data = pd.read_parquet(body)
+    else:
+        compression = next(
+            (
+                codec
+                for extension, codec in CSV_COMPRESSION.items()
+                if key.endswith(extension)
+            ),
+            None,
+        )
+        data = pd.read_csv(body, compression=compression)
+    if cache is not None:
+        cache.put(key, response["ETag"], data)
+    return data
+
+
+def join_dimension(
+    df: pd.DataFrame,
+    lookup: pd.DataFrame,
+    left_on: str,
+    right_on: str,
+    columns: dict,
+) -> pd.DataFrame:
+    """Adds columns from a lookup table to each row of a dataframe by key,
+    e.g. the address of each counterparty from its legal_address_id. The
+    rows are matched on their key values with an indexed lookup, so the lookup
+    table's ids may be sparse or in any order, and the cost grows linearly
+    with the number of rows. If the lookup table has several rows with the
+    same key the last one is used, and rows whose key isn't in it get nulls.
+
+    Args:
+        df: dataframe to add the columns to
+        lookup: dataframe to take the columns from
+        left_on: name of the key column in df
+        right_on: name of the key column in lookup
+        columns: dictionary of lookup column name to the name it is given in
+        the result, e.g. {"city": "counterparty_legal_city"}
+
+    Returns:
+        A new dataframe with the rows of df in the same order and the added
+        columns after its own
+    """
+    lookup = lookup.drop_duplicates(subset=right_on, keep="last")
+    positions = pd.Index(lookup[right_on]).get_indexer(df[left_on])
+    joined = df.reset_index(drop=True)
+    for column, name in columns.items():
+        joined[name] = pd.api.extensions.take(
+            lookup[column].array, positions, allow_fill=True
+        )
+    return joined
+
+
+def find_ingestion_file(keys: list, prefix: str) -> str:
+    """Picks the file for a table out of a list of keys, preferring Parquet,
+    then compressed CSV, then plain CSV
+
+    Args:
+        keys: list of S3 keys starting with the prefix
+        prefix: the table's key without its extension, ending in a "."
+
+    Returns:
+        The key of the table's file, or the plain CSV key if none was found
+    """
+    for extension in INGESTION_EXTENSIONS:
+        if f"{prefix}{extension}" in keys:
+            return f"{prefix}{extension}"
+    return f"{prefix}csv"
+
+
+def find_ingestion_parts(keys: list, prefix: str) -> list:
+    """Picks the part files of a table extracted in partitions out of a list
+    of keys, using the same format preference as find_ingestion_file
+
+    Args:
+        keys: list of S3 keys starting with the prefix
+        prefix: the table's key without its extension, ending in a "."
+
+    Returns:
+        The sorted keys of the table's part files, empty if the table was
+        written as a single file
+    """
+    for extension in INGESTION_EXTENSIONS:
+        parts = [
+            key
+            for key in keys
+            if key.startswith(f"{prefix}part-")
+            and key.endswith(f".{extension}")
+        ]
+        if parts:
+            return sorted(parts)
+    return []
+
+
 def write_parquet_data_to_s3(
     data: pd.DataFrame,
     table_name: str,
@@ -116,17 +537,23 @@ def write_parquet_data_to_s3(
         A dictionary containing the following:
             status: shows whether the function ran successfully
             message: a relevant success/failure message
+            table, key, rows: the table name, the key it was written to and
+            its row count (if successful)
     """
     if isinstance(data, pd.DataFrame):
         try:
+            key = f"{timestamp}/{table_name}.parquet"
             wr.s3.to_parquet(
                 df=data,
-                path=f"s3://blackwater-processed-zone/{timestamp}/{table_name}.parquet",
+                path=f"s3://blackwater-processed-zone/{key}",
                 boto3_session=session,
             )
             return {
                 "status": "success",
                 "message": f"{table_name} written to processed bucket",
+                "table": table_name,
+                "key": key,
+                "rows": len(data),
             }
         except ClientError as e:
             return {
@@ -138,3 +565,43 @@ def write_parquet_data_to_s3(
             "status": "failure",
             "message": f"Data is in wrong format {str(type(data))} is not a pandas dataframe",
         }
+
+
+def write_processed_manifest(
+    client: boto3.client, timestamp: str, written: list
+) -> dict:
+    """Writes a manifest of the tables written to the processed zone in this
+    run, so the load lambda can find them without listing the bucket
+
+    Args:
+        client: S3 Boto3 client
+        timestamp: the run folder the tables were written to
+        written: list of responses from write_parquet_data_to_s3, only the
+        successful ones are listed
+
+    Returns:
+        A dictionary containing the following:
+            status: shows whether the function ran successfully
+            message: a relevant success/failure message
+    """
+    manifest = {
+        "folder": timestamp,
+        "tables": {
+            response["table"]: {
+                "key": response["key"],
+                "rows": response["rows"],
+            }
+            for response in written
+            if response["status"] == "success"
+        },
+    }
+    try:
+        client.put_object(
+            Bucket="blackwater-processed-zone",
+            Key=f"{timestamp}/manifest.json",
+            Body=json.dumps(manifest, indent=2).encode("utf-8"),
+            ContentType="application/json",
+        )
+        return {"status": "success", "message": "manifest written"}
+    except ClientError as e:
+        return {"status": "failure", "message": e.response}
@@ -16,9 +16,13 @@ data "aws_iam_policy_document" "extract_lambda_trust_policy" {
 
 data "aws_iam_policy_document" "read_write_from_ingestion_zone" {
   statement {
-    actions   = ["s3:PutObject", "s3:GetObject"]
+    actions   = ["s3:PutObject", "s3:GetObject", "s3:DeleteObject", "s3:AbortMultipartUpload"]
     resources = ["${aws_s3_bucket.tf_ingestion_zone.arn}/*"]
   }
+  statement {
+    actions   = ["s3:ListBucket"]
+    resources = [aws_s3_bucket.tf_ingestion_zone.arn]
+  }
 }
 
 resource "aws_iam_policy" "read_write_policy_ingestion_zone" {
@@ -55,7 +59,10 @@ data "aws_iam_policy_document" "extract_lambda_cloudwatch" {
   }
   statement {
     actions   = ["logs:CreateLogStream", "logs:PutLogEvents"]
-    resources = ["arn:aws:logs:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:log-group:/aws/lambda/${aws_lambda_function.extract_lambda.function_name}:*"]
+    resources = [
+      "arn:aws:logs:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:log-group:/aws/lambda/${aws_lambda_function.extract_lambda.function_name}:*",
+      "arn:aws:logs:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:log-group:/aws/lambda/${aws_lambda_function.extract_backfill_lambda.function_name}:*",
+    ]
   }
 }
 
@@ -8,6 +8,26 @@ resource "aws_lambda_function" "extract_lambda" {
   layers           = ["arn:aws:lambda:eu-west-2:336392948345:layer:AWSSDKPandas-Python311:12", aws_lambda_layer_version.utility_layer.arn]
   timeout          = 45
   memory_size      = 1024
+
+  environment {
+    variables = {
+      EXTRACT_MAX_WORKERS           = 4
+      EXTRACT_MAX_CONNECTIONS       = 8
+      EXTRACT_STREAM_TABLES         = "sales_order,transaction,payment"
+      INGESTION_FORMAT              = var.ingestion_format
+      INGESTION_COMPRESSION         = var.ingestion_compression
+      EXTRACT_SNAPSHOT              = "false"
+      EXTRACT_PARTITION_TABLES      = "sales_order,transaction,payment"
+      EXTRACT_PARTITIONS            = 4
+      EXTRACT_INCLUDE_TABLES        = "*"
+      EXTRACT_EXCLUDE_TABLES        = ""
+      EXTRACT_ADAPTIVE_SCHEDULE     = "true"
+      EXTRACT_FRESHNESS_MINUTES     = 30
+      EXTRACT_SOURCE                = var.extract_source
+      EXTRACT_CDC_SLOT              = "blackwater_cdc"
+      EXTRACT_CATALOGUE_TTL_SECONDS = 3600
+    }
+  }
 }
 
 data "archive_file" "extract_lambda_dir_zip" {
@@ -16,6 +36,33 @@ data "archive_file" "extract_lambda_dir_zip" {
   output_path = "${path.module}/../lambda_extract.zip"
 }
 
+resource "aws_lambda_function" "extract_backfill_lambda" {
+  function_name    = "extract_backfill_lambda"
+  filename         = "${path.module}/../lambda_extract_backfill.zip"
+  role             = aws_iam_role.extract_lambda_role.arn
+  handler          = "backfill.backfill_handler"
+  runtime          = "python3.11"
+  source_code_hash = data.archive_file.extract_backfill_lambda_dir_zip.output_base64sha256
+  layers           = ["arn:aws:lambda:eu-west-2:336392948345:layer:AWSSDKPandas-Python311:12", aws_lambda_layer_version.utility_layer.arn]
+  timeout          = 900
+  memory_size      = 1024
+
+  environment {
+    variables = {
+      EXTRACT_MAX_WORKERS     = 4
+      EXTRACT_MAX_CONNECTIONS = 8
+      INGESTION_FORMAT        = var.ingestion_format
+      INGESTION_COMPRESSION   = var.ingestion_compression
+    }
+  }
+}
+
+data "archive_file" "extract_backfill_lambda_dir_zip" {
+  type        = "zip"
+  source_file = "${path.module}/../src/extract_lambda/backfill.py"
+  output_path = "${path.module}/../lambda_extract_backfill.zip"
+}
+
 resource "aws_lambda_permission" "extract_lambda_eventbridge" {
   action         = "lambda:InvokeFunction"
   function_name  = aws_lambda_function.extract_lambda.function_name
@@ -41,7 +88,7 @@ resource "aws_lambda_permission" "load_lambda_s3_trigger" {
 }
 
 locals {
-  source_files = ["${path.module}/../src/extract_lambda/connection.py", "${path.module}/../src/extract_lambda/credentials_manager.py", "${path.module}/../src/extract_lambda/utils.py"]
+  source_files = ["${path.module}/../src/extract_lambda/connection.py", "${path.module}/../src/extract_lambda/credentials_manager.py", "${path.module}/../src/extract_lambda/catalogue.py", "${path.module}/../src/extract_lambda/run_state.py", "${path.module}/../src/extract_lambda/manifest.py", "${path.module}/../src/extract_lambda/metrics.py", "${path.module}/../src/extract_lambda/schedule.py", "${path.module}/../src/extract_lambda/cdc.py", "${path.module}/../src/extract_lambda/utils.py"]
 }
 
 data "template_file" "t_file" {
@@ -84,6 +131,12 @@ resource "aws_lambda_function" "transform_lambda" {
   layers           = ["arn:aws:lambda:eu-west-2:336392948345:layer:AWSSDKPandas-Python311:12", aws_lambda_layer_version.utility_layer_transform.arn]
   timeout          = 45
   memory_size      = 1024
+
+  environment {
+    variables = {
+      TRANSFORM_PREFETCH_WORKERS = 8
+    }
+  }
 }
 
 data "archive_file" "transform_lambda_dir_zip" {
@@ -144,7 +197,7 @@ data "archive_file" "load_lambda_dir_zip" {
 }
 
 locals {
-  source_files_load = ["${path.module}/../src/load_lambda/connection.py", "${path.module}/../src/load_lambda/credentials_manager.py", "${path.module}/../src/load_lambda/utils.py"]
+  source_files_load = ["${path.module}/../src/load_lambda/connection.py", "${path.module}/../src/load_lambda/credentials_manager.py", "${path.module}/../src/load_lambda/catalogue.py", "${path.module}/../src/load_lambda/utils.py"]
 }
 
 data "template_file" "t_file_load" {
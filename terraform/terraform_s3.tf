@@ -11,8 +11,8 @@ resource "aws_s3_bucket_notification" "processed_trigger" {
   lambda_function {
     lambda_function_arn = aws_lambda_function.load_lambda.arn
     events              = ["s3:ObjectCreated:*"]
-    filter_prefix       = "last_ran_at"
-    filter_suffix       = ".csv"
+    filter_prefix       = "run_state"
+    filter_suffix       = ".json"
   }
 
   depends_on = [
@@ -25,8 +25,8 @@ resource "aws_s3_bucket_notification" "ingestion_trigger" {
   lambda_function {
     lambda_function_arn = aws_lambda_function.transform_lambda.arn
     events              = ["s3:ObjectCreated:*"]
-    filter_prefix       = "last_ran_at"
-    filter_suffix       = ".csv"
+    filter_prefix       = "run_state"
+    filter_suffix       = ".json"
   }
   depends_on = [
     aws_lambda_permission.transform_lambda_s3_trigger
@@ -0,0 +1,22 @@
+variable "ingestion_format" {
+  description = "File format written to the ingestion zone by the extract lambda (csv or parquet)"
+  type        = string
+  default     = "csv"
+}
+
+variable "ingestion_compression" {
+  description = "Compression codec for ingestion zone files (gzip for csv, snappy for parquet, empty for none). zstd is not offered because zstandard isn't packaged in the lambda layers"
+  type        = string
+  default     = ""
+
+  validation {
+    condition     = contains(["", "gzip", "snappy"], var.ingestion_compression)
+    error_message = "ingestion_compression must be gzip, snappy or empty."
+  }
+}
+
+variable "extract_source" {
+  description = "Where incremental extracts read changes from: poll (last_updated queries) or cdc (logical replication slot, needs wal_level=logical)"
+  type        = string
+  default     = "poll"
+}
@@ -0,0 +1,388 @@
+import pytest
+import boto3
+import os
+import json
+import time
+from datetime import datetime, timedelta
+from unittest.mock import patch
+from moto import mock_aws
+from src.extract_lambda.backfill import (
+    backfill_handler,
+    finish_backfill,
+    get_backfill_chunks,
+    get_table_response,
+    new_checkpoint,
+    record_chunk_result,
+    CHECKPOINT_KEY,
+    TIME_MARGIN_SECONDS,
+)
+
+BUCKET = "blackwater-ingestion-zone"
+
+
+@pytest.fixture(scope="function")
+def aws_creds():
+    os.environ["AWS_ACCESS_KEY_ID"] = "test"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "test"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture(scope="function")
+def s3_client(aws_creds):
+    with mock_aws():
+        client = boto3.client("s3")
+        client.create_bucket(
+            Bucket=BUCKET,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        yield client
+
+
+@pytest.fixture(scope="function")
+def database():
+    with patch("src.extract_lambda.backfill.get_connection"), patch(
+        "src.extract_lambda.backfill.get_catalogue"
+    ) as mock_catalogue:
+        mock_catalogue.return_value.column_types.return_value = {
+            "staff_id": "integer",
+            "last_updated": "timestamp without time zone",
+        }
+        yield mock_catalogue
+
+
+class FakeContext:
+    def __init__(self, remaining_millis: int):
+        self.remaining_millis = remaining_millis
+
+    def get_remaining_time_in_millis(self) -> int:
+        return self.remaining_millis
+
+
+def fake_extract(session, table, bucket, key, **kwargs):
+    return {
+        "success": True,
+        "message": "written to bucket",
+        "rows": 2,
+        "files": [{"key": key, "bytes": 10, "sha256": "abc"}],
+        "min_last_updated": kwargs["watermark"] + timedelta(hours=1),
+        "max_last_updated": kwargs["upper_bound"],
+    }
+
+
+event = {
+    "start": "2022-11-01 00:00:00",
+    "end": "2022-11-10 00:00:00",
+    "chunk_days": 4,
+    "tables": ["staff"],
+}
+
+
+class TestGetBackfillChunks:
+    def test_range_split_into_consecutive_windows(self):
+        result = get_backfill_chunks(
+            datetime(2022, 11, 1), datetime(2022, 11, 10), timedelta(days=4)
+        )
+        assert result == [
+            (datetime(2022, 11, 1), datetime(2022, 11, 5)),
+            (datetime(2022, 11, 5), datetime(2022, 11, 9)),
+            (datetime(2022, 11, 9), datetime(2022, 11, 10)),
+        ]
+
+    def test_empty_range_has_no_chunks(self):
+        start = datetime(2022, 11, 1)
+        assert get_backfill_chunks(start, start, timedelta(days=1)) == []
+
+
+class TestGetTableResponse:
+    def test_chunks_combined_into_one_response(self):
+        checkpoint = new_checkpoint(
+            datetime(2022, 11, 1),
+            datetime(2022, 11, 10),
+            timedelta(days=4),
+            ["staff"],
+            "original_data_dump",
+        )
+        for chunk in [1, 0]:
+            record_chunk_result(
+                checkpoint,
+                "staff",
+                chunk,
+                {
+                    "success": True,
+                    "rows": 3,
+                    "files": [{"key": f"part-{chunk}"}],
+                    "min_last_updated": datetime(2022, 11, 1 + chunk * 4),
+                    "max_last_updated": datetime(2022, 11, 2 + chunk * 4),
+                },
+            )
+        record_chunk_result(
+            checkpoint,
+            "staff",
+            2,
+            {"success": False, "message": "no new data"},
+        )
+        result = get_table_response(checkpoint, "staff")
+        assert result == {
+            "success": True,
+            "message": "written to bucket",
+            "rows": 6,
+            "files": [{"key": "part-0"}, {"key": "part-1"}],
+            "min_last_updated": datetime(2022, 11, 1),
+            "max_last_updated": datetime(2022, 11, 6),
+        }
+
+    def test_failed_chunk_not_recorded(self):
+        checkpoint = new_checkpoint(
+            datetime(2022, 11, 1),
+            datetime(2022, 11, 10),
+            timedelta(days=4),
+            ["staff"],
+            "original_data_dump",
+        )
+        record_chunk_result(
+            checkpoint, "staff", 0, {"success": False, "message": "timeout"}
+        )
+        assert checkpoint["chunks"]["staff"] == {}
+
+
+class TestBackfillHandler:
+    def test_every_chunk_written_as_a_part_file(self, s3_client, database):
+        with patch(
+            "src.extract_lambda.backfill.extract_slice_to_s3",
+            side_effect=fake_extract,
+        ) as mock_extract:
+            result = backfill_handler(event, FakeContext(900000))
+        assert result == {
+            "success": "true",
+            "message": "backfill complete",
+            "complete": True,
+        }
+        keys = sorted(call.args[3] for call in mock_extract.call_args_list)
+        assert keys == [
+            "ingested_data/original_data_dump/staff.part-0000.csv",
+            "ingested_data/original_data_dump/staff.part-0001.csv",
+            "ingested_data/original_data_dump/staff.part-0002.csv",
+        ]
+        response = s3_client.get_object(
+            Bucket=BUCKET, Key="ingested_data/original_data_dump/manifest.json"
+        )
+        manifest = json.loads(response["Body"].read())
+        assert manifest["tables"]["staff"]["rows"] == 6
+        assert len(manifest["tables"]["staff"]["files"]) == 3
+        response = s3_client.get_object(Bucket=BUCKET, Key="run_state.json")
+        state = json.loads(response["Body"].read())
+        assert state["folder"] == "original_data_dump"
+        assert state["tables"]["staff"]["watermark"] == "2022-11-10 00:00:00"
+
+    def test_no_chunks_started_when_out_of_time(self, s3_client, database):
+        with patch(
+            "src.extract_lambda.backfill.extract_slice_to_s3",
+            side_effect=fake_extract,
+        ) as mock_extract:
+            result = backfill_handler(event, FakeContext(1000))
+        assert result["complete"] is False
+        assert result["message"] == "3 chunks left, invoke again to resume"
+        assert mock_extract.call_count == 0
+        response = s3_client.get_object(Bucket=BUCKET, Key=CHECKPOINT_KEY)
+        checkpoint = json.loads(response["Body"].read())
+        assert checkpoint["chunks"] == {"staff": {}}
+        assert "Contents" not in s3_client.list_objects_v2(
+            Bucket=BUCKET, Prefix="run_state"
+        )
+
+    def test_backfill_resumes_from_checkpoint(self, s3_client, database):
+        checkpoint = new_checkpoint(
+            datetime(2022, 11, 1),
+            datetime(2022, 11, 10),
+            timedelta(days=4),
+            ["staff"],
+            "original_data_dump",
+        )
+        record_chunk_result(
+            checkpoint,
+            "staff",
+            0,
+            fake_extract(
+                None,
+                "staff",
+                BUCKET,
+                "part-0",
+                watermark=datetime(2022, 11, 1),
+                upper_bound=datetime(2022, 11, 5),
+            ),
+        )
+        s3_client.put_object(
+            Bucket=BUCKET, Key=CHECKPOINT_KEY, Body=json.dumps(checkpoint)
+        )
+        with patch(
+            "src.extract_lambda.backfill.extract_slice_to_s3",
+            side_effect=fake_extract,
+        ) as mock_extract:
+            result = backfill_handler({}, FakeContext(900000))
+        assert result["complete"] is True
+        windows = sorted(
+            call.kwargs["watermark"] for call in mock_extract.call_args_list
+        )
+        assert windows == [datetime(2022, 11, 5), datetime(2022, 11, 9)]
+
+    def test_failed_chunk_retried_on_next_run(self, s3_client, database):
+        with patch(
+            "src.extract_lambda.backfill.extract_slice_to_s3",
+            return_value={"success": False, "message": "timeout"},
+        ):
+            result = backfill_handler(event, FakeContext(900000))
+        assert result["success"] == "false"
+        assert result["complete"] is False
+        with patch(
+            "src.extract_lambda.backfill.extract_slice_to_s3",
+            side_effect=fake_extract,
+        ) as mock_extract:
+            result = backfill_handler({}, FakeContext(900000))
+        assert result["complete"] is True
+        assert mock_extract.call_count == 3
+
+    def test_finished_chunks_kept_when_a_chunk_raises(
+        self, s3_client, database
+    ):
+        def extract(session, table, bucket, key, **kwargs):
+            if key.endswith("part-0001.csv"):
+                raise ConnectionError("connection reset")
+            return fake_extract(session, table, bucket, key, **kwargs)
+
+        with patch(
+            "src.extract_lambda.backfill.extract_slice_to_s3",
+            side_effect=extract,
+        ):
+            result = backfill_handler(event, FakeContext(900000))
+        assert result == {
+            "success": "false",
+            "message": "staff chunk 1: connection reset",
+            "complete": False,
+        }
+        response = s3_client.get_object(Bucket=BUCKET, Key=CHECKPOINT_KEY)
+        checkpoint = json.loads(response["Body"].read())
+        assert sorted(checkpoint["chunks"]["staff"]) == ["0", "2"]
+
+    def test_checkpoint_written_as_each_chunk_finishes(
+        self, s3_client, database
+    ):
+        chunks_done = []
+
+        def write_checkpoint(session, bucket, checkpoint):
+            chunks_done.append(len(checkpoint["chunks"]["staff"]))
+            return {"success": True, "message": "checkpoint written"}
+
+        with patch(
+            "src.extract_lambda.backfill.extract_slice_to_s3",
+            side_effect=fake_extract,
+        ), patch(
+            "src.extract_lambda.backfill.write_checkpoint",
+            side_effect=write_checkpoint,
+        ):
+            backfill_handler(event, FakeContext(900000))
+        assert chunks_done[:3] == [1, 2, 3]
+
+    def test_chunk_not_taken_if_it_would_run_past_the_limit(
+        self, s3_client, database
+    ):
+        def slow_extract(*args, **kwargs):
+            time.sleep(0.4)
+            return fake_extract(*args, **kwargs)
+
+        remaining_millis = TIME_MARGIN_SECONDS * 1000 + 600
+        with patch(
+            "src.extract_lambda.backfill.extract_slice_to_s3",
+            side_effect=slow_extract,
+        ) as mock_extract:
+            result = backfill_handler(
+                dict(event, max_workers=1), FakeContext(remaining_millis)
+            )
+        assert mock_extract.call_count == 1
+        assert result["message"] == "2 chunks left, invoke again to resume"
+
+
+class TestFinishBackfill:
+    def finished_checkpoint(self):
+        checkpoint = new_checkpoint(
+            datetime(2022, 11, 1),
+            datetime(2022, 11, 10),
+            timedelta(days=9),
+            ["staff", "currency"],
+            "original_data_dump",
+        )
+        for table in checkpoint["tables"]:
+            record_chunk_result(
+                checkpoint,
+                table,
+                0,
+                fake_extract(
+                    None,
+                    table,
+                    BUCKET,
+                    f"{table}.part-0000.csv",
+                    watermark=datetime(2022, 11, 1),
+                    upper_bound=datetime(2022, 11, 10),
+                ),
+            )
+        return checkpoint
+
+    def test_newer_run_keeps_its_folder_and_later_watermarks(
+        self, s3_client, database
+    ):
+        newer_run = {
+            "last_ran_at": "2022-11-12 00:00:00",
+            "folder": "2022-11-12 00:00:00",
+            "tables": {
+                "staff": {
+                    "watermark": "2022-11-12 00:00:00",
+                    "rows": 1,
+                    "status": "success",
+                    "message": "written to bucket",
+                },
+                "currency": {
+                    "watermark": None,
+                    "rows": 0,
+                    "status": "failure",
+                    "message": "db error",
+                },
+            },
+        }
+        s3_client.put_object(
+            Bucket=BUCKET, Key="run_state.json", Body=json.dumps(newer_run)
+        )
+        result = finish_backfill(None, BUCKET, self.finished_checkpoint())
+        assert result["success"]
+        response = s3_client.get_object(Bucket=BUCKET, Key="run_state.json")
+        state = json.loads(response["Body"].read())
+        assert state["folder"] == "2022-11-12 00:00:00"
+        assert state["last_ran_at"] == "2022-11-12 00:00:00"
+        assert state["tables"]["staff"] == newer_run["tables"]["staff"]
+        assert state["tables"]["currency"]["watermark"] == (
+            "2022-11-10 00:00:00"
+        )
+
+    def test_run_state_not_rewritten_if_already_past_backfill(
+        self, s3_client, database
+    ):
+        newer_run = {
+            "last_ran_at": "2022-11-12 00:00:00",
+            "folder": "2022-11-12 00:00:00",
+            "tables": {
+                table: {
+                    "watermark": "2022-11-12 00:00:00",
+                    "rows": 1,
+                    "status": "success",
+                    "message": "written to bucket",
+                }
+                for table in ["staff", "currency"]
+            },
+        }
+        s3_client.put_object(
+            Bucket=BUCKET, Key="run_state.json", Body=json.dumps(newer_run)
+        )
+        with patch(
+            "src.extract_lambda.backfill.write_run_state"
+        ) as mock_write:
+            result = finish_backfill(None, BUCKET, self.finished_checkpoint())
+        assert result == {"success": True, "message": "run state unchanged"}
+        assert mock_write.call_count == 0
@@ -0,0 +1,114 @@
+from unittest.mock import MagicMock
+import pytest
+import src.extract_lambda.catalogue as catalogue
+from src.extract_lambda.catalogue import (
+    SchemaCatalogue,
+    get_catalogue,
+    invalidate_catalogue,
+)
+
+rows = [
+    ["staff", "staff_id", "integer", True],
+    ["staff", "first_name", "text", False],
+    ["staff", "last_updated", "timestamp without time zone", False],
+    ["currency", "currency_id", "integer", True],
+    ["currency", "currency_code", "character varying", False],
+    ["pg_statistic", "starelid", "oid", False],
+    ["_prisma_migrations", "id", "character varying", True],
+]
+
+
+@pytest.fixture(scope="function", autouse=True)
+def clear_cached_catalogue():
+    invalidate_catalogue()
+    yield
+    invalidate_catalogue()
+
+
+class TestSchemaCatalogue:
+    def test_tables_excludes_system_tables(self):
+        result = SchemaCatalogue(rows)
+        assert result.tables == ["currency", "staff"]
+
+    def test_columns_returned_in_defined_order(self):
+        result = SchemaCatalogue(rows)
+        assert result.columns("staff") == [
+            "staff_id",
+            "first_name",
+            "last_updated",
+        ]
+
+    def test_column_types_returned(self):
+        result = SchemaCatalogue(rows)
+        assert result.column_types("currency") == {
+            "currency_id": "integer",
+            "currency_code": "character varying",
+        }
+
+    def test_has_table(self):
+        result = SchemaCatalogue(rows)
+        assert result.has_table("staff")
+        assert not result.has_table("pg_statistic")
+        assert not result.has_table("staff; drop table staff;")
+
+    def test_default_ttl_outlasts_the_extract_schedule(self):
+        assert SchemaCatalogue(rows).ttl > 5 * 60
+
+    def test_catalogue_is_stale_after_ttl(self):
+        result = SchemaCatalogue(rows, ttl=-1)
+        assert result.is_stale()
+        assert not SchemaCatalogue(rows).is_stale()
+
+    def test_primary_key_columns(self):
+        result = SchemaCatalogue(rows)
+        assert result.primary_key("staff") == ["staff_id"]
+
+    def test_primary_key_empty_if_table_has_none(self):
+        result = SchemaCatalogue([["log", "message", "text", False]])
+        assert result.primary_key("log") == []
+
+    def test_extractable_tables_need_last_updated(self):
+        result = SchemaCatalogue(rows).extractable_tables()
+        assert result == ["staff"]
+
+    def test_extractable_tables_filtered_by_rules(self):
+        extra = [
+            ["payment", "last_updated", "timestamp without time zone", False],
+            ["payment_type", "last_updated", "timestamp", False],
+            ["sales_order", "last_updated", "timestamp", False],
+        ]
+        result = SchemaCatalogue(rows + extra)
+        assert result.extractable_tables(include=["payment*"]) == [
+            "payment",
+            "payment_type",
+        ]
+        assert result.extractable_tables(
+            include=["payment*", "staff"], exclude=["payment_type"]
+        ) == ["payment", "staff"]
+        assert result.extractable_tables(exclude=["*"]) == []
+
+
+class TestGetCatalogue:
+    def test_catalogue_only_queried_once_while_fresh(self):
+        conn = MagicMock()
+        conn.run.return_value = rows
+        first = get_catalogue(conn)
+        second = get_catalogue(conn)
+        assert first is second
+        assert conn.run.call_count == 1
+
+    def test_stale_catalogue_is_reloaded(self):
+        conn = MagicMock()
+        conn.run.return_value = rows
+        get_catalogue(conn, ttl=-1)
+        get_catalogue(conn)
+        assert conn.run.call_count == 2
+
+    def test_invalidate_forces_reload(self):
+        conn = MagicMock()
+        conn.run.return_value = rows
+        get_catalogue(conn)
+        invalidate_catalogue()
+        get_catalogue(conn)
+        assert conn.run.call_count == 2
+        assert catalogue.cached_catalogue is not None
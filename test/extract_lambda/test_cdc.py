@@ -0,0 +1,309 @@
+import pytest
+import boto3
+import os
+import uuid
+from unittest.mock import patch
+from moto import mock_aws
+from pg8000.native import Connection
+from src.extract_lambda.catalogue import SchemaCatalogue
+from src.extract_lambda.cdc import (
+    ensure_replication_slot,
+    extract_changes_to_s3,
+    get_change_rows,
+    parse_change,
+)
+
+BUCKET = "blackwater-ingestion-zone"
+
+
+@pytest.fixture(scope="function")
+def aws_creds():
+    os.environ["AWS_ACCESS_KEY_ID"] = "test"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "test"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture(scope="function")
+def s3_client(aws_creds):
+    with mock_aws():
+        client = boto3.client("s3")
+        client.create_bucket(
+            Bucket=BUCKET,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        yield client
+
+
+staff_catalogue = SchemaCatalogue(
+    [
+        ("staff", "staff_id", "integer", True),
+        ("staff", "first_name", "text", False),
+        ("staff", "active", "boolean", False),
+        ("staff", "last_updated", "timestamp without time zone", False),
+    ]
+)
+
+changes = [
+    ("0/16B3700", "BEGIN 750"),
+    (
+        "0/16B3748",
+        "table public.staff: INSERT: staff_id[integer]:1 "
+        "first_name[text]:'Jeremie' active[boolean]:true "
+        "last_updated[timestamp without time zone]:'2024-05-20 12:01:00'",
+    ),
+    (
+        "0/16B37C0",
+        "table public.staff: INSERT: staff_id[integer]:2 "
+        "first_name[text]:'Deron' active[boolean]:false "
+        "last_updated[timestamp without time zone]:'2024-05-20 12:02:00'",
+    ),
+    ("0/16B3800", "COMMIT 750"),
+    ("0/16B3838", "BEGIN 751"),
+    (
+        "0/16B3870",
+        "table public.staff: UPDATE: staff_id[integer]:1 "
+        "first_name[text]:'O''Brien' active[boolean]:null "
+        "last_updated[timestamp without time zone]:'2024-05-20 12:03:00'",
+    ),
+    ("0/16B38E8", "table public.staff: DELETE: staff_id[integer]:2"),
+    ("0/16B3920", "COMMIT 751"),
+]
+
+
+class FakeSlotConnection:
+    """Stands in for a pg8000 connection, returning the changes for a peek of
+    the replication slot and recording the slot being advanced"""
+
+    def __init__(self, changes):
+        self.changes = changes
+        self.advanced_to = None
+
+    def run(self, sql, **params):
+        if "peek_changes" in sql:
+            return [list(change) for change in self.changes]
+        if "slot_advance" in sql:
+            self.advanced_to = params["lsn"]
+        return []
+
+
+class TestParseChange:
+    def test_insert_parsed_into_columns(self):
+        result = parse_change(changes[1][1])
+        assert result == {
+            "table": "staff",
+            "operation": "INSERT",
+            "columns": {
+                "staff_id": "1",
+                "first_name": "Jeremie",
+                "active": True,
+                "last_updated": "2024-05-20 12:01:00",
+            },
+            "old_key": None,
+        }
+
+    def test_quotes_and_nulls_unescaped(self):
+        result = parse_change(changes[5][1])
+        assert result["columns"]["first_name"] == "O'Brien"
+        assert result["columns"]["active"] is None
+
+    def test_spaces_inside_quoted_values_kept(self):
+        result = parse_change(
+            "table public.address: INSERT: address_id[integer]:1 "
+            "address_line_1[character varying]:'6826 Herzog Via' "
+            "city[character varying]:'New Patienceburgh'"
+        )
+        assert result["columns"] == {
+            "address_id": "1",
+            "address_line_1": "6826 Herzog Via",
+            "city": "New Patienceburgh",
+        }
+
+    def test_key_change_has_old_key(self):
+        result = parse_change(
+            "table public.staff: UPDATE: old-key: staff_id[integer]:1 "
+            "new-tuple: staff_id[integer]:5 first_name[text]:'Jeremie'"
+        )
+        assert result["old_key"] == {"staff_id": "1"}
+        assert result["columns"] == {"staff_id": "5", "first_name": "Jeremie"}
+
+    def test_transaction_markers_ignored(self):
+        assert parse_change("BEGIN 750") is None
+        assert parse_change("COMMIT 750") is None
+
+
+class TestGetChangeRows:
+    def test_latest_change_of_each_key_kept(self):
+        result = get_change_rows(changes, {"staff": ["staff_id"]})
+        assert result == {
+            "staff": [
+                {
+                    "staff_id": "1",
+                    "first_name": "O'Brien",
+                    "active": None,
+                    "last_updated": "2024-05-20 12:03:00",
+                    "cdc_operation": "UPDATE",
+                    "cdc_lsn": "0/16B3870",
+                },
+                {
+                    "staff_id": "2",
+                    "cdc_operation": "DELETE",
+                    "cdc_lsn": "0/16B38E8",
+                },
+            ]
+        }
+
+    def test_every_change_kept_without_primary_key(self):
+        result = get_change_rows(changes)
+        operations = [row["cdc_operation"] for row in result["staff"]]
+        assert operations == ["INSERT", "INSERT", "UPDATE", "DELETE"]
+
+
+class TestExtractChangesToS3:
+    def test_changes_written_with_delete_markers(self, s3_client):
+        conn = FakeSlotConnection(changes)
+        with patch(
+            "src.extract_lambda.cdc.get_catalogue",
+            return_value=staff_catalogue,
+        ):
+            result = extract_changes_to_s3(
+                None, BUCKET, "2024-05-20 12:05:00", ["staff", "design"], conn
+            )
+        assert result["staff"]["success"] is True
+        assert result["staff"]["rows"] == 2
+        assert result["staff"]["max_last_updated"] == "2024-05-20 12:03:00"
+        assert result["design"]["message"] == "no new data"
+        assert conn.advanced_to == "0/16B3920"
+        response = s3_client.get_object(
+            Bucket=BUCKET, Key="ingested_data/2024-05-20 12:05:00/staff.csv"
+        )
+        assert response["Body"].read().decode("utf-8") == (
+            "staff_id,first_name,active,last_updated,cdc_operation,cdc_lsn\n"
+            "1,O'Brien,,2024-05-20 12:03:00,UPDATE,0/16B3870\n"
+            "2,,,,DELETE,0/16B38E8\n"
+        )
+
+    def test_slot_not_advanced_if_a_write_fails(self, s3_client):
+        conn = FakeSlotConnection(changes)
+        with patch(
+            "src.extract_lambda.cdc.get_catalogue",
+            return_value=staff_catalogue,
+        ):
+            result = extract_changes_to_s3(
+                None, "no-such-bucket", "2024-05-20 12:05:00", ["staff"], conn
+            )
+        assert result["staff"]["success"] is False
+        assert conn.advanced_to is None
+
+    def test_slot_advanced_as_far_as_every_table_has_got(self, s3_client):
+        conn = FakeSlotConnection(changes)
+        with patch(
+            "src.extract_lambda.cdc.get_catalogue",
+            return_value=staff_catalogue,
+        ):
+            result = extract_changes_to_s3(
+                None,
+                "no-such-bucket",
+                "2024-05-20 12:05:00",
+                ["staff", "design"],
+                conn,
+                table_lsns={"staff": "0/16B3800", "design": None},
+            )
+        assert result["staff"]["cdc_lsn"] == "0/16B3800"
+        assert result["design"]["cdc_lsn"] == "0/16B3920"
+        assert conn.advanced_to == "0/16B3800"
+
+    def test_changes_already_written_for_a_table_skipped(self, s3_client):
+        conn = FakeSlotConnection(changes)
+        with patch(
+            "src.extract_lambda.cdc.get_catalogue",
+            return_value=SchemaCatalogue([]),
+        ):
+            result = extract_changes_to_s3(
+                None,
+                BUCKET,
+                "2024-05-20 12:05:00",
+                ["staff"],
+                conn,
+                table_lsns={"staff": "0/16B3800"},
+            )
+        assert result["staff"]["rows"] == 2
+        assert result["staff"]["cdc_lsn"] == "0/16B3920"
+        assert conn.advanced_to == "0/16B3920"
+        response = s3_client.get_object(
+            Bucket=BUCKET, Key="ingested_data/2024-05-20 12:05:00/staff.csv"
+        )
+        lines = response["Body"].read().decode("utf-8").splitlines()
+        assert [line.split(",")[-1] for line in lines[1:]] == [
+            "0/16B3870",
+            "0/16B38E8",
+        ]
+
+
+@pytest.mark.skipif(
+    "PGHOST" not in os.environ,
+    reason="needs a local Postgres with wal_level=logical (PGHOST etc.)",
+)
+class TestExtractChangesFromPostgres:
+    """Runs against a local Postgres started with wal_level=logical, e.g.
+    docker run -p 5432:5432 -e POSTGRES_PASSWORD=postgres postgres
+    -c wal_level=logical, with PGHOST, PGUSER, PGPASSWORD and optionally
+    PGPORT and PGDATABASE set"""
+
+    @pytest.fixture(scope="function")
+    def local_db(self):
+        conn = Connection(
+            user=os.environ.get("PGUSER", "postgres"),
+            password=os.environ.get("PGPASSWORD"),
+            host=os.environ["PGHOST"],
+            port=int(os.environ.get("PGPORT", 5432)),
+            database=os.environ.get("PGDATABASE", "postgres"),
+        )
+        table = f"cdc_test_{uuid.uuid4().hex[:8]}"
+        slot = f"{table}_slot"
+        conn.run(
+            f"CREATE TABLE {table} (staff_id integer PRIMARY KEY, "
+            "first_name text, last_updated timestamp DEFAULT now());"
+        )
+        yield conn, table, slot
+        conn.run(
+            "SELECT pg_drop_replication_slot(slot_name) "
+            "FROM pg_replication_slots WHERE slot_name = :slot;",
+            slot=slot,
+        )
+        conn.run(f"DROP TABLE {table};")
+        conn.close()
+
+    def test_changes_read_from_replication_slot(self, s3_client, local_db):
+        conn, table, slot = local_db
+        assert ensure_replication_slot(conn, slot) is True
+        assert ensure_replication_slot(conn, slot) is False
+        conn.run(
+            f"INSERT INTO {table} (staff_id, first_name) "
+            "VALUES (1, 'Jeremie'), (2, 'Deron');"
+        )
+        conn.run(f"UPDATE {table} SET first_name = 'Jo' WHERE staff_id = 1;")
+        conn.run(f"DELETE FROM {table} WHERE staff_id = 2;")
+        catalogue = SchemaCatalogue(
+            [
+                (table, "staff_id", "integer", True),
+                (table, "first_name", "text", False),
+                (table, "last_updated", "timestamp", False),
+            ]
+        )
+        with patch(
+            "src.extract_lambda.cdc.get_catalogue", return_value=catalogue
+        ):
+            result = extract_changes_to_s3(
+                None, BUCKET, "cdc", [table], conn, slot=slot
+            )
+            assert result[table]["rows"] == 2
+            response = s3_client.get_object(
+                Bucket=BUCKET, Key=f"ingested_data/cdc/{table}.csv"
+            )
+            lines = response["Body"].read().decode("utf-8").splitlines()
+            assert lines[1].startswith("1,Jo,")
+            assert lines[2].startswith("2,,,DELETE,")
+            result = extract_changes_to_s3(
+                None, BUCKET, "cdc-2", [table], conn, slot=slot
+            )
+        assert result[table]["message"] == "no new data"
@@ -0,0 +1,140 @@
+from unittest.mock import MagicMock, patch
+from pg8000.native import DatabaseError, InterfaceError
+import pytest
+import threading
+import src.extract_lambda.connection as connection
+
+
+@pytest.fixture(scope="function", autouse=True)
+def clear_cached_connection():
+    connection.cached_connection = None
+    yield
+    connection.cached_connection = None
+
+
+class TestGetConnection:
+    def test_opens_new_connection_when_none_cached(self):
+        new_conn = MagicMock()
+        with patch.object(
+            connection, "connect_to_db", return_value=new_conn
+        ) as mock_connect:
+            result = connection.get_connection()
+        assert result is new_conn
+        assert mock_connect.call_count == 1
+
+    def test_reuses_cached_connection_if_alive(self):
+        new_conn = MagicMock()
+        with patch.object(
+            connection, "connect_to_db", return_value=new_conn
+        ) as mock_connect:
+            first = connection.get_connection()
+            second = connection.get_connection()
+        assert first is second
+        assert mock_connect.call_count == 1
+        new_conn.run.assert_called_with("SELECT 1;")
+
+    def test_reconnects_if_cached_connection_is_dead(self):
+        dead_conn = MagicMock()
+        dead_conn.run.side_effect = InterfaceError("network error")
+        new_conn = MagicMock()
+        connection.cached_connection = dead_conn
+        with patch.object(connection, "connect_to_db", return_value=new_conn):
+            result = connection.get_connection()
+        assert result is new_conn
+        assert dead_conn.close.called
+
+
+class TestCloseConnection:
+    def test_close_connection_forgets_cached_connection(self):
+        conn = MagicMock()
+        connection.cached_connection = conn
+        connection.close_connection()
+        assert conn.close.called
+        assert connection.cached_connection is None
+
+
+class TestConnectionPool:
+    @pytest.fixture(scope="function", autouse=True)
+    def clear_pool(self):
+        connection.connection_pool.clear()
+        connection.connection_slots = threading.BoundedSemaphore(
+            connection.MAX_CONNECTIONS
+        )
+        yield
+        connection.connection_pool.clear()
+
+    def test_acquire_opens_new_connection_when_pool_empty(self):
+        new_conn = MagicMock()
+        with patch.object(connection, "connect_to_db", return_value=new_conn):
+            result = connection.acquire_connection()
+        assert result is new_conn
+
+    def test_released_connection_is_reused(self):
+        conn = MagicMock()
+        with patch.object(connection, "connect_to_db", return_value=conn):
+            connection.release_connection(connection.acquire_connection())
+        with patch.object(connection, "connect_to_db") as mock_connect:
+            result = connection.acquire_connection()
+        connection.release_connection(result)
+        assert result is conn
+        assert mock_connect.call_count == 0
+
+    def test_dead_pooled_connection_is_discarded(self):
+        dead_conn = MagicMock()
+        dead_conn.run.side_effect = InterfaceError("network error")
+        new_conn = MagicMock()
+        with patch.object(connection, "connect_to_db", return_value=dead_conn):
+            connection.release_connection(connection.acquire_connection())
+        with patch.object(connection, "connect_to_db", return_value=new_conn):
+            result = connection.acquire_connection()
+        connection.release_connection(result)
+        assert result is new_conn
+        assert dead_conn.close.called
+
+    def test_no_connection_when_pool_limit_reached(self):
+        with patch.object(connection, "connect_to_db", side_effect=MagicMock):
+            held = [
+                connection.acquire_connection()
+                for _ in range(connection.MAX_CONNECTIONS)
+            ]
+            result = connection.acquire_connection(blocking=False)
+            connection.release_connection(held.pop())
+            assert result is None
+            assert connection.acquire_connection(blocking=False) is not None
+
+    def test_surplus_connections_closed_on_release(self):
+        with patch.object(connection, "connect_to_db", side_effect=MagicMock):
+            held = [
+                connection.acquire_connection()
+                for _ in range(connection.MAX_IDLE_CONNECTIONS + 1)
+            ]
+        for conn in held:
+            connection.release_connection(conn)
+        assert connection.connection_pool == held[:-1]
+        assert held[-1].close.called
+        assert not held[0].close.called
+
+
+class TestConnectToDb:
+    def test_retries_with_refreshed_credentials_on_auth_failure(self):
+        auth_error = DatabaseError({"C": "28P01", "M": "auth failed"})
+        new_conn = MagicMock()
+        with patch.object(
+            connection, "get_credentials", return_value={}
+        ) as mock_creds, patch.object(
+            connection, "connect_with", side_effect=[auth_error, new_conn]
+        ):
+            result = connection.connect_to_db()
+        assert result is new_conn
+        mock_creds.assert_called_with(force_refresh=True)
+
+    def test_other_database_errors_are_raised(self):
+        error = DatabaseError({"C": "3D000", "M": "no such database"})
+        with patch.object(
+            connection, "get_credentials", return_value={}
+        ) as mock_creds, patch.object(
+            connection, "connect_with", side_effect=error
+        ):
+            with pytest.raises(DatabaseError):
+                connection.connect_to_db()
+        assert mock_creds.call_count == 1
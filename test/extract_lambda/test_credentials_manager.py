@@ -0,0 +1,77 @@
+from moto import mock_aws
+from unittest.mock import patch
+import boto3
+import json
+import os
+import pytest
+import src.extract_lambda.credentials_manager as credentials_manager
+
+SECRET = {
+    "username": "user",
+    "password": "pass",
+    "dbname": "totesys",
+    "host": "localhost",
+    "port": 5432,
+}
+
+
+@pytest.fixture(scope="function")
+def aws_creds():
+    os.environ["AWS_ACCESS_KEY_ID"] = "test"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "test"
+    os.environ["AWS_SECURITY_TOKEN"] = "test"
+    os.environ["AWS_SESSION_TOKEN"] = "test"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture(scope="function")
+def secretsmanager(aws_creds):
+    with mock_aws():
+        client = boto3.client("secretsmanager", region_name="eu-west-2")
+        client.create_secret(
+            Name="totesys-blackwater-credentials",
+            SecretString=json.dumps(SECRET),
+        )
+        yield client
+
+
+@pytest.fixture(scope="function", autouse=True)
+def clear_cached_credentials():
+    credentials_manager.clear_credentials()
+    yield
+    credentials_manager.clear_credentials()
+
+
+class TestGetSecret:
+    def test_parses_json_secret(self, secretsmanager):
+        assert credentials_manager.get_secret() == SECRET
+
+
+class TestGetCredentials:
+    def test_fetches_secret_on_first_call_only(self):
+        with patch.object(
+            credentials_manager, "get_secret", return_value=SECRET
+        ) as mock_get_secret:
+            first = credentials_manager.get_credentials()
+            second = credentials_manager.get_credentials()
+        assert first == second == SECRET
+        assert mock_get_secret.call_count == 1
+
+    def test_force_refresh_fetches_secret_again(self):
+        with patch.object(
+            credentials_manager, "get_secret", return_value=SECRET
+        ) as mock_get_secret:
+            credentials_manager.get_credentials()
+            credentials_manager.get_credentials(force_refresh=True)
+        assert mock_get_secret.call_count == 2
+
+    def test_fetches_secret_again_once_expired(self):
+        with patch.object(
+            credentials_manager, "get_secret", return_value=SECRET
+        ) as mock_get_secret:
+            credentials_manager.get_credentials()
+            credentials_manager.cached_at -= (
+                credentials_manager.SECRET_TTL_SECONDS + 1
+            )
+            credentials_manager.get_credentials()
+        assert mock_get_secret.call_count == 2
@@ -1,8 +1,26 @@
 import pytest
 import boto3
 import os
+import json
+from datetime import datetime, timedelta
+from unittest.mock import patch
 from moto import mock_aws
 from src.extract_lambda.handler import lambda_handler
+from src.extract_lambda.catalogue import SchemaCatalogue
+
+TABLES = [
+    "address",
+    "counterparty",
+    "currency",
+    "department",
+    "design",
+    "payment",
+    "payment_type",
+    "purchase_order",
+    "sales_order",
+    "staff",
+    "transaction",
+]
 
 
 @pytest.fixture(scope="function")
@@ -18,6 +36,19 @@ def s3_client(aws_creds):
         yield boto3.client("s3")
 
 
+@pytest.fixture(scope="function")
+def database():
+    with patch("src.extract_lambda.handler.get_connection"), patch(
+        "src.extract_lambda.handler.get_catalogue"
+    ) as mock_catalogue:
+        mock_catalogue.return_value.extractable_tables.return_value = TABLES
+        mock_catalogue.return_value.column_types.return_value = {
+            "staff_id": "integer",
+            "last_updated": "timestamp without time zone",
+        }
+        yield mock_catalogue
+
+
 class TestLambdaHandler:
     def test_handler_returns_false_message(self, s3_client):
         session = boto3.session.Session(
@@ -68,3 +99,530 @@ class TestLambdaHandler:
         )
         for file in response["Contents"]:
             assert file["Size"] > 1
+
+
+class TestLambdaHandlerParallel:
+    def test_failed_table_does_not_advance_its_watermark(
+        self, s3_client, database
+    ):
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        s3_client.create_bucket(
+            Bucket="blackwater-ingestion-zone",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        results = {
+            "staff": {"success": True, "message": "written to bucket"},
+            "currency": {"success": False, "message": "db error"},
+        }
+        with patch(
+            "src.extract_lambda.handler.update_tables_in_parallel",
+            return_value=results,
+        ):
+            result = lambda_handler(
+                "unused", "unused2", session, max_workers=4
+            )
+        assert result == {"success": "false", "message": "db error"}
+        response = s3_client.get_object(
+            Bucket="blackwater-ingestion-zone", Key="run_state.json"
+        )
+        state = json.loads(response["Body"].read())
+        assert state["folder"] == "original_data_dump"
+        assert state["tables"]["staff"]["status"] == "success"
+        assert state["tables"]["staff"]["watermark"] == state["last_ran_at"]
+        assert state["tables"]["currency"]["status"] == "failure"
+        assert state["tables"]["currency"]["watermark"] is None
+
+    def test_run_state_written_once_all_tables_succeed(
+        self, s3_client, database
+    ):
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        s3_client.create_bucket(
+            Bucket="blackwater-ingestion-zone",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        results = {
+            "staff": {"success": True, "message": "written to bucket"},
+            "currency": {"success": False, "message": "no new data"},
+        }
+        with patch(
+            "src.extract_lambda.handler.update_tables_in_parallel",
+            return_value=results,
+        ) as mock_parallel:
+            result = lambda_handler(
+                "unused", "unused2", session, max_workers=4
+            )
+        assert mock_parallel.call_args.args[-1] == 4
+        assert result["success"] == "true"
+        response = s3_client.list_objects_v2(
+            Bucket="blackwater-ingestion-zone"
+        )
+        keys = [file["Key"] for file in response["Contents"]]
+        assert keys == [
+            "ingested_data/original_data_dump/manifest.json",
+            "run_state.json",
+        ]
+
+    def test_manifest_lists_each_table_written(self, s3_client, database):
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        s3_client.create_bucket(
+            Bucket="blackwater-ingestion-zone",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        files = [
+            {
+                "key": "ingested_data/original_data_dump/staff.csv",
+                "bytes": 120,
+                "sha256": "abc123",
+            }
+        ]
+        results = {
+            "staff": {
+                "success": True,
+                "message": "written to bucket",
+                "rows": 2,
+                "files": files,
+                "min_last_updated": datetime(2022, 11, 3, 14, 20, 51),
+                "max_last_updated": datetime(2023, 1, 5, 9, 0),
+            },
+            "currency": {"success": False, "message": "no new data"},
+        }
+        with patch(
+            "src.extract_lambda.handler.update_tables_in_parallel",
+            return_value=results,
+        ):
+            lambda_handler("unused", "unused2", session, max_workers=4)
+        response = s3_client.get_object(
+            Bucket="blackwater-ingestion-zone",
+            Key="ingested_data/original_data_dump/manifest.json",
+        )
+        manifest = json.loads(response["Body"].read())
+        assert manifest["folder"] == "original_data_dump"
+        assert manifest["tables"]["staff"] == {
+            "status": "success",
+            "rows": 2,
+            "files": files,
+            "columns": ["staff_id", "last_updated"],
+            "dtypes": {
+                "staff_id": "integer",
+                "last_updated": "timestamp without time zone",
+            },
+            "min_last_updated": "2022-11-03 14:20:51",
+            "max_last_updated": "2023-01-05 09:00:00",
+        }
+        assert manifest["tables"]["currency"]["rows"] == 0
+        assert manifest["tables"]["currency"]["files"] == []
+
+
+class TestLambdaHandlerChangeProbe:
+    def test_tables_without_changes_are_skipped(self, s3_client, database):
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        s3_client.create_bucket(
+            Bucket="blackwater-ingestion-zone",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        s3_client.upload_file(
+            "test/data/last_ran_at.csv",
+            "blackwater-ingestion-zone",
+            "last_ran_at.csv",
+        )
+        changes = {
+            table: {"changed_rows": 0, "max_last_updated": None}
+            for table in TABLES
+        }
+        changes["staff"]["changed_rows"] = 3
+        with patch("src.extract_lambda.handler.get_connection"), patch(
+            "src.extract_lambda.handler.probe_table_changes",
+            return_value=changes,
+        ), patch(
+            "src.extract_lambda.handler.update_data_in_bucket",
+            return_value={"success": True, "message": "written to bucket"},
+        ) as mock_update:
+            result = lambda_handler("unused", "unused2", session)
+        assert result["success"] == "true"
+        assert mock_update.call_count == 1
+        assert mock_update.call_args.args[0] == "staff"
+
+    def test_every_table_extracted_if_probe_fails(self, s3_client, database):
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        s3_client.create_bucket(
+            Bucket="blackwater-ingestion-zone",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        s3_client.upload_file(
+            "test/data/last_ran_at.csv",
+            "blackwater-ingestion-zone",
+            "last_ran_at.csv",
+        )
+        with patch("src.extract_lambda.handler.get_connection"), patch(
+            "src.extract_lambda.handler.probe_table_changes",
+            return_value=None,
+        ), patch(
+            "src.extract_lambda.handler.update_data_in_bucket",
+            return_value={"success": False, "message": "no new data"},
+        ) as mock_update:
+            result = lambda_handler("unused", "unused2", session)
+        assert result["success"] == "true"
+        assert mock_update.call_count == 11
+
+
+class TestLambdaHandlerSnapshot:
+    def test_upper_watermark_taken_from_database_clock(
+        self, s3_client, database, monkeypatch
+    ):
+        monkeypatch.setenv("EXTRACT_SNAPSHOT", "true")
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        s3_client.create_bucket(
+            Bucket="blackwater-ingestion-zone",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        database_time = datetime(2024, 5, 20, 12, 15)
+        results = {"staff": {"success": True, "message": "written to bucket"}}
+        with patch("src.extract_lambda.handler.get_connection"), patch(
+            "src.extract_lambda.handler.begin_snapshot",
+            return_value=database_time,
+        ), patch(
+            "src.extract_lambda.handler.update_tables_in_snapshot",
+            return_value=results,
+        ) as mock_snapshot, patch(
+            "src.extract_lambda.handler.update_tables_in_parallel"
+        ) as mock_parallel:
+            result = lambda_handler("unused", "unused2", session, 4)
+        assert result["success"] == "true"
+        assert mock_snapshot.call_args.args[3] == database_time
+        assert mock_parallel.call_count == 0
+        response = s3_client.get_object(
+            Bucket="blackwater-ingestion-zone", Key="run_state.json"
+        )
+        state = json.loads(response["Body"].read())
+        assert state["tables"]["staff"]["watermark"] == str(database_time)
+
+
+class TestLambdaHandlerTableDiscovery:
+    def test_tables_read_from_catalogue_with_rules(
+        self, s3_client, database, monkeypatch
+    ):
+        monkeypatch.setenv("EXTRACT_INCLUDE_TABLES", "payment*,staff")
+        monkeypatch.setenv("EXTRACT_EXCLUDE_TABLES", "payment_type")
+        database.return_value.extractable_tables.return_value = [
+            "payment",
+            "staff",
+        ]
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        s3_client.create_bucket(
+            Bucket="blackwater-ingestion-zone",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        with patch(
+            "src.extract_lambda.handler.update_data_in_bucket",
+            return_value={"success": False, "message": "no new data"},
+        ) as mock_update:
+            result = lambda_handler("unused", "unused2", session)
+        assert result["success"] == "true"
+        database.return_value.extractable_tables.assert_called_once_with(
+            include=["payment*", "staff"], exclude=["payment_type"]
+        )
+        tables = [call.args[0] for call in mock_update.call_args_list]
+        assert tables == ["payment", "staff"]
+
+    def test_nothing_written_when_rules_exclude_every_table(
+        self, s3_client, database, monkeypatch
+    ):
+        monkeypatch.setenv("EXTRACT_EXCLUDE_TABLES", "*")
+        database.return_value = SchemaCatalogue(
+            [
+                ("staff", "staff_id", "integer", True),
+                ("staff", "last_updated", "timestamp", False),
+            ]
+        )
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        s3_client.create_bucket(
+            Bucket="blackwater-ingestion-zone",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        with patch(
+            "src.extract_lambda.handler.update_data_in_bucket"
+        ) as mock_update:
+            result = lambda_handler("unused", "unused2", session)
+        assert result == {
+            "success": "true",
+            "message": "no tables to extract",
+        }
+        assert mock_update.call_count == 0
+        response = s3_client.list_objects_v2(
+            Bucket="blackwater-ingestion-zone"
+        )
+        assert "Contents" not in response
+
+
+class TestLambdaHandlerAdaptiveSchedule:
+    def put_run_state(self, s3_client, next_checks):
+        s3_client.create_bucket(
+            Bucket="blackwater-ingestion-zone",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        state = {
+            "last_ran_at": "2024-05-20 12:00:00",
+            "folder": "2024-05-20 12:00:00",
+            "tables": {
+                table: {
+                    "watermark": "2024-05-20 12:00:00",
+                    "rows": 0,
+                    "status": "no new data",
+                    "message": "no new data",
+                    "change_rate": 0.0,
+                    "next_check": str(next_check),
+                }
+                for table, next_check in next_checks.items()
+            },
+        }
+        s3_client.put_object(
+            Bucket="blackwater-ingestion-zone",
+            Key="run_state.json",
+            Body=json.dumps(state),
+        )
+
+    def test_nothing_read_when_no_table_due(
+        self, s3_client, database, monkeypatch
+    ):
+        monkeypatch.setenv("EXTRACT_ADAPTIVE_SCHEDULE", "true")
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        next_check = datetime.now() + timedelta(minutes=20)
+        self.put_run_state(s3_client, {table: next_check for table in TABLES})
+        with patch(
+            "src.extract_lambda.handler.get_connection"
+        ) as mock_connection:
+            result = lambda_handler("unused", "unused2", session)
+        assert result == {
+            "success": "true",
+            "message": "no tables due",
+            "next_suggested_run": str(next_check),
+        }
+        assert mock_connection.call_count == 0
+
+    def test_only_due_tables_extracted_and_scheduled(
+        self, s3_client, database, monkeypatch
+    ):
+        monkeypatch.setenv("EXTRACT_ADAPTIVE_SCHEDULE", "true")
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        later = datetime.now() + timedelta(minutes=20)
+        next_checks = {table: later for table in TABLES}
+        next_checks["staff"] = datetime(2024, 5, 20, 12, 5)
+        self.put_run_state(s3_client, next_checks)
+        with patch(
+            "src.extract_lambda.handler.probe_table_changes",
+            return_value={
+                "staff": {"changed_rows": 3, "max_last_updated": None}
+            },
+        ), patch(
+            "src.extract_lambda.handler.update_data_in_bucket",
+            return_value={
+                "success": True,
+                "message": "written to bucket",
+                "rows": 3,
+            },
+        ) as mock_update:
+            result = lambda_handler("unused", "unused2", session)
+        assert result["success"] == "true"
+        tables = [call.args[0] for call in mock_update.call_args_list]
+        assert tables == ["staff"]
+        response = s3_client.get_object(
+            Bucket="blackwater-ingestion-zone", Key="run_state.json"
+        )
+        state = json.loads(response["Body"].read())
+        assert state["tables"]["staff"]["change_rate"] > 0
+        assert state["tables"]["design"]["next_check"] == str(later)
+        assert state["next_suggested_run"] == str(later)
+
+
+class TestLambdaHandlerCdc:
+    def test_incremental_run_reads_replication_slot(
+        self, s3_client, database, monkeypatch
+    ):
+        monkeypatch.setenv("EXTRACT_SOURCE", "cdc")
+        monkeypatch.setenv("INGESTION_FORMAT", "parquet")
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        s3_client.create_bucket(
+            Bucket="blackwater-ingestion-zone",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        s3_client.upload_file(
+            "test/data/last_ran_at.csv",
+            "blackwater-ingestion-zone",
+            "last_ran_at.csv",
+        )
+        results = {
+            table: {"success": False, "message": "no new data"}
+            for table in TABLES
+        }
+        results["staff"] = {
+            "success": True,
+            "message": "written to bucket",
+            "rows": 2,
+        }
+        with patch(
+            "src.extract_lambda.handler.ensure_replication_slot",
+            return_value=False,
+        ) as mock_slot, patch(
+            "src.extract_lambda.handler.extract_changes_to_s3",
+            return_value=results,
+        ) as mock_cdc, patch(
+            "src.extract_lambda.handler.probe_table_changes"
+        ) as mock_probe, patch(
+            "src.extract_lambda.handler.update_data_in_bucket"
+        ) as mock_update:
+            result = lambda_handler("unused", "unused2", session)
+        assert result["success"] == "true"
+        assert mock_slot.call_count == 1
+        assert mock_cdc.call_args.args[3] == TABLES
+        assert mock_probe.call_count == 0
+        assert mock_update.call_count == 0
+        response = s3_client.get_object(
+            Bucket="blackwater-ingestion-zone", Key="run_state.json"
+        )
+        state = json.loads(response["Body"].read())
+        folder = state["folder"]
+        response = s3_client.get_object(
+            Bucket="blackwater-ingestion-zone",
+            Key=f"ingested_data/{folder}/manifest.json",
+        )
+        manifest = json.loads(response["Body"].read())
+        assert manifest["format"] == "csv"
+        assert manifest["tables"]["staff"]["rows"] == 2
+
+    def test_run_that_creates_slot_polls_from_watermarks(
+        self, s3_client, database, monkeypatch
+    ):
+        monkeypatch.setenv("EXTRACT_SOURCE", "cdc")
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        s3_client.create_bucket(
+            Bucket="blackwater-ingestion-zone",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        s3_client.upload_file(
+            "test/data/last_ran_at.csv",
+            "blackwater-ingestion-zone",
+            "last_ran_at.csv",
+        )
+        with patch(
+            "src.extract_lambda.handler.ensure_replication_slot",
+            return_value=True,
+        ), patch(
+            "src.extract_lambda.handler.extract_changes_to_s3"
+        ) as mock_cdc, patch(
+            "src.extract_lambda.handler.probe_table_changes",
+            return_value=None,
+        ), patch(
+            "src.extract_lambda.handler.update_data_in_bucket",
+            return_value={"success": False, "message": "no new data"},
+        ) as mock_update:
+            lambda_handler("unused", "unused2", session)
+        assert mock_cdc.call_count == 0
+        assert mock_update.call_count == len(TABLES)
+
+    def test_tables_read_from_their_own_lsn(
+        self, s3_client, database, monkeypatch
+    ):
+        monkeypatch.setenv("EXTRACT_SOURCE", "cdc")
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        s3_client.create_bucket(
+            Bucket="blackwater-ingestion-zone",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        state = {
+            "last_ran_at": "2024-05-20 12:00:00",
+            "folder": "2024-05-20 12:00:00",
+            "tables": {
+                "staff": {
+                    "watermark": "2024-05-20 12:00:00",
+                    "rows": 1,
+                    "status": "success",
+                    "message": "written to bucket",
+                    "cdc_lsn": "0/16B3800",
+                },
+            },
+        }
+        s3_client.put_object(
+            Bucket="blackwater-ingestion-zone",
+            Key="run_state.json",
+            Body=json.dumps(state),
+        )
+        results = {
+            table: {
+                "success": False,
+                "message": "no new data",
+                "cdc_lsn": "0/16B3900",
+            }
+            for table in TABLES
+        }
+        results["staff"] = {
+            "success": False,
+            "message": "upload failed",
+            "cdc_lsn": "0/16B3800",
+        }
+        with patch(
+            "src.extract_lambda.handler.ensure_replication_slot",
+            return_value=False,
+        ), patch(
+            "src.extract_lambda.handler.extract_changes_to_s3",
+            return_value=results,
+        ) as mock_cdc:
+            lambda_handler("unused", "unused2", session)
+        table_lsns = mock_cdc.call_args.kwargs["table_lsns"]
+        assert table_lsns["staff"] == "0/16B3800"
+        assert table_lsns["currency"] is None
+        response = s3_client.get_object(
+            Bucket="blackwater-ingestion-zone", Key="run_state.json"
+        )
+        tables = json.loads(response["Body"].read())["tables"]
+        assert tables["staff"]["cdc_lsn"] == "0/16B3800"
+        assert tables["currency"]["cdc_lsn"] == "0/16B3900"
+
+    def test_slot_created_before_original_data_dump(
+        self, s3_client, database, monkeypatch
+    ):
+        monkeypatch.setenv("EXTRACT_SOURCE", "cdc")
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        s3_client.create_bucket(
+            Bucket="blackwater-ingestion-zone",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        with patch(
+            "src.extract_lambda.handler.ensure_replication_slot"
+        ) as mock_slot, patch(
+            "src.extract_lambda.handler.extract_changes_to_s3"
+        ) as mock_cdc, patch(
+            "src.extract_lambda.handler.update_data_in_bucket",
+            return_value={"success": False, "message": "no new data"},
+        ) as mock_update:
+            lambda_handler("unused", "unused2", session)
+        assert mock_slot.call_count == 1
+        assert mock_cdc.call_count == 0
+        assert mock_update.call_count == len(TABLES)
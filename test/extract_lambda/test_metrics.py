@@ -0,0 +1,99 @@
+import json
+from src.extract_lambda.metrics import (
+    get_emf_record,
+    get_table_metrics,
+    put_table_metrics,
+    put_run_metrics,
+    NAMESPACE,
+)
+
+written = {
+    "success": True,
+    "message": "written to bucket",
+    "rows": 3,
+    "rows_fetched": 3,
+    "files": [
+        {"key": "staff.part-0000.csv", "bytes": 100, "sha256": "a"},
+        {"key": "staff.part-0001.csv", "bytes": 50, "sha256": "b"},
+    ],
+    "timings": {"query": 0.25, "serialise": 0.5, "upload": 0.125},
+}
+
+
+class TestGetEmfRecord:
+    def test_record_declares_metrics_and_dimensions(self):
+        result = get_emf_record([("RowsKept", 3, "Count")], {"Table": "staff"})
+        assert result["_aws"]["CloudWatchMetrics"] == [
+            {
+                "Namespace": NAMESPACE,
+                "Dimensions": [["Table"]],
+                "Metrics": [{"Name": "RowsKept", "Unit": "Count"}],
+            }
+        ]
+        assert isinstance(result["_aws"]["Timestamp"], int)
+        assert result["Table"] == "staff"
+        assert result["RowsKept"] == 3
+
+
+class TestGetTableMetrics:
+    def test_timings_in_milliseconds_and_bytes_summed(self):
+        result = get_table_metrics(written)
+        assert result == [
+            ("QueryLatency", 250.0, "Milliseconds"),
+            ("RowsFetched", 3, "Count"),
+            ("RowsKept", 3, "Count"),
+            ("SerialisationTime", 500.0, "Milliseconds"),
+            ("UploadTime", 125.0, "Milliseconds"),
+            ("UploadBytes", 150, "Bytes"),
+            ("ExtractFailures", 0, "Count"),
+        ]
+
+    def test_no_new_data_is_not_a_failure(self):
+        result = dict(
+            (name, value)
+            for name, value, unit in get_table_metrics(
+                {"success": False, "message": "no new data"}
+            )
+        )
+        assert result["ExtractFailures"] == 0
+        assert result["RowsKept"] == 0
+        assert result["UploadBytes"] == 0
+
+    def test_failed_table_counted(self):
+        result = dict(
+            (name, value)
+            for name, value, unit in get_table_metrics(
+                {"success": False, "message": "connection reset"}
+            )
+        )
+        assert result["ExtractFailures"] == 1
+
+
+class TestPutMetrics:
+    def test_table_record_printed_as_one_json_line(self, capsys):
+        put_table_metrics("staff", written)
+        lines = capsys.readouterr().out.splitlines()
+        assert len(lines) == 1
+        record = json.loads(lines[0])
+        assert record["Table"] == "staff"
+        assert record["UploadBytes"] == 150
+
+    def test_run_record_totals_tables(self, capsys):
+        table_metrics = {
+            "staff": get_table_metrics(written),
+            "design": get_table_metrics(
+                {"success": False, "message": "no new data"}
+            ),
+            "payment": get_table_metrics(
+                {"success": False, "message": "timeout"}
+            ),
+        }
+        put_run_metrics(table_metrics, 2.5)
+        record = json.loads(capsys.readouterr().out)
+        assert record["Stage"] == "extract"
+        assert record["RunDuration"] == 2500.0
+        assert record["TablesExtracted"] == 1
+        assert record["TablesSkipped"] == 1
+        assert record["ExtractFailures"] == 1
+        assert record["RowsKept"] == 3
+        assert record["UploadBytes"] == 150
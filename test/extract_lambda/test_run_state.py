@@ -0,0 +1,162 @@
+from botocore.exceptions import ClientError
+from unittest.mock import MagicMock, patch
+from moto import mock_aws
+from datetime import datetime
+import boto3
+import os
+import pytest
+from src.extract_lambda.run_state import (
+    read_run_state,
+    legacy_run_state,
+    new_run_state,
+    get_table_watermark,
+    record_table_result,
+    failed_tables,
+    write_run_state,
+)
+
+
+@pytest.fixture(scope="function")
+def aws_creds():
+    os.environ["AWS_ACCESS_KEY_ID"] = "test"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "test"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture(scope="function")
+def s3_client(aws_creds):
+    with mock_aws():
+        yield boto3.client("s3")
+
+
+@pytest.fixture(scope="function")
+def bucket(s3_client):
+    s3_client.create_bucket(
+        Bucket="blackwater-ingestion-zone",
+        CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+    )
+    return "blackwater-ingestion-zone"
+
+
+class TestReadRunState:
+    def test_returns_none_if_there_has_been_no_run(self, s3_client, bucket):
+        session = boto3.session.Session()
+        assert read_run_state(session, bucket) is None
+
+    def test_reads_state_written_by_write_run_state(self, s3_client, bucket):
+        session = boto3.session.Session()
+        state = new_run_state(
+            datetime(2024, 5, 20, 12, 10), "original_data_dump", None
+        )
+        record_table_result(
+            state,
+            "staff",
+            {"success": True, "message": "written to bucket", "rows": 3},
+            datetime(2024, 5, 20, 12, 10),
+        )
+        assert write_run_state(session, bucket, state)["success"]
+        assert read_run_state(session, bucket) == state
+
+    def test_converts_legacy_runtime_file(self, s3_client, bucket):
+        session = boto3.session.Session()
+        s3_client.upload_file(
+            "test/data/last_ran_at.csv", bucket, "last_ran_at.csv"
+        )
+        state = read_run_state(session, bucket)
+        assert get_table_watermark(state, "staff") == datetime(
+            2024, 5, 20, 12, 10, 3, 998128
+        )
+
+    def test_errors_other_than_a_missing_key_are_raised(
+        self, s3_client, bucket
+    ):
+        session = boto3.session.Session()
+        error = ClientError(
+            {"Error": {"Code": "SlowDown", "Message": "Please reduce rate"}},
+            "GetObject",
+        )
+        with patch.object(
+            session, "client", return_value=MagicMock()
+        ) as mock_client:
+            mock_client.return_value.get_object.side_effect = error
+            with pytest.raises(ClientError):
+                read_run_state(session, bucket)
+        assert mock_client.return_value.get_object.call_count == 1
+
+
+class TestLegacyRunState:
+    def test_original_data_dump_runtime_means_no_previous_run(self):
+        runtime_csv = "last_ran_at\n1999-12-31 23:59:59.099999\n"
+        assert legacy_run_state(runtime_csv) is None
+
+
+class TestRecordTableResult:
+    upper_bound = datetime(2024, 5, 20, 12, 15)
+
+    def previous_state(self):
+        previous = new_run_state(
+            datetime(2024, 5, 20, 12, 10), "2024-05-20 12:10:00", None
+        )
+        for table in ["staff", "currency"]:
+            record_table_result(
+                previous,
+                table,
+                {"success": True, "message": "written to bucket"},
+                datetime(2024, 5, 20, 12, 10),
+            )
+        return new_run_state(self.upper_bound, "2024-05-20 12:15:00", previous)
+
+    def test_successful_table_advances_watermark(self):
+        state = self.previous_state()
+        record_table_result(
+            state,
+            "staff",
+            {"success": True, "message": "written to bucket", "rows": 5},
+            self.upper_bound,
+        )
+        assert get_table_watermark(state, "staff") == self.upper_bound
+        assert state["tables"]["staff"]["rows"] == 5
+        assert state["tables"]["staff"]["status"] == "success"
+
+    def test_table_with_no_new_data_advances_watermark(self):
+        state = self.previous_state()
+        record_table_result(
+            state,
+            "staff",
+            {"success": False, "message": "no new data"},
+            self.upper_bound,
+        )
+        assert get_table_watermark(state, "staff") == self.upper_bound
+        assert state["tables"]["staff"]["status"] == "no new data"
+        assert failed_tables(state) == []
+
+    def test_failed_table_keeps_previous_watermark(self):
+        state = self.previous_state()
+        record_table_result(
+            state,
+            "staff",
+            {"success": False, "message": "db error"},
+            self.upper_bound,
+        )
+        record_table_result(
+            state,
+            "currency",
+            {"success": True, "message": "written to bucket", "rows": 1},
+            self.upper_bound,
+        )
+        assert get_table_watermark(state, "staff") == datetime(
+            2024, 5, 20, 12, 10
+        )
+        assert get_table_watermark(state, "currency") == self.upper_bound
+        assert failed_tables(state) == ["staff"]
+
+
+class TestGetTableWatermark:
+    def test_new_table_has_no_watermark(self):
+        state = new_run_state(
+            datetime(2024, 5, 20, 12, 10), "2024-05-20 12:10:00", None
+        )
+        assert get_table_watermark(state, "staff") is None
+
+    def test_no_previous_run_has_no_watermark(self):
+        assert get_table_watermark(None, "staff") is None
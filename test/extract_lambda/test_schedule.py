@@ -0,0 +1,133 @@
+from datetime import datetime, timedelta
+from src.extract_lambda.schedule import (
+    get_check_interval,
+    record_table_schedule,
+    is_table_due,
+    get_next_suggested_run,
+    SCHEDULE_INTERVAL,
+)
+
+upper_bound = datetime(2024, 5, 20, 12, 0)
+
+
+def get_state(status="success", rows=0):
+    return {
+        "tables": {
+            "staff": {
+                "watermark": str(upper_bound),
+                "rows": rows,
+                "status": status,
+                "message": "",
+            }
+        }
+    }
+
+
+class TestGetCheckInterval:
+    def test_busy_table_checked_every_scheduled_run(self):
+        assert get_check_interval(10) == SCHEDULE_INTERVAL
+
+    def test_quiet_table_checked_inside_freshness_target(self):
+        assert get_check_interval(0) == timedelta(minutes=25)
+        assert get_check_interval(0.001) == timedelta(minutes=25)
+        assert get_check_interval(0, timedelta(minutes=60)) == timedelta(
+            minutes=55
+        )
+
+    def test_interval_is_time_to_next_expected_change(self):
+        assert get_check_interval(0.1) == timedelta(minutes=10)
+
+
+class TestRecordTableSchedule:
+    def test_rate_is_rows_per_minute_since_watermark(self):
+        state = get_state(rows=20)
+        record_table_schedule(
+            state,
+            None,
+            "staff",
+            upper_bound - timedelta(minutes=10),
+            upper_bound,
+        )
+        assert state["tables"]["staff"]["change_rate"] == 2
+        assert state["tables"]["staff"]["next_check"] == str(
+            upper_bound + SCHEDULE_INTERVAL
+        )
+
+    def test_rate_smoothed_with_previous_rate(self):
+        state = get_state(rows=0)
+        previous_state = {"tables": {"staff": {"change_rate": 0.2}}}
+        record_table_schedule(
+            state,
+            previous_state,
+            "staff",
+            upper_bound - timedelta(minutes=10),
+            upper_bound,
+        )
+        assert state["tables"]["staff"]["change_rate"] == 0.1
+        assert state["tables"]["staff"]["next_check"] == str(
+            upper_bound + timedelta(minutes=10)
+        )
+
+    def test_failed_table_checked_on_next_run(self):
+        state = get_state(status="failure")
+        previous_state = {"tables": {"staff": {"change_rate": 0.01}}}
+        record_table_schedule(
+            state,
+            previous_state,
+            "staff",
+            upper_bound - timedelta(minutes=10),
+            upper_bound,
+        )
+        assert state["tables"]["staff"]["change_rate"] == 0.01
+        assert state["tables"]["staff"]["next_check"] == str(upper_bound)
+
+    def test_table_read_in_full_has_no_rate(self):
+        state = get_state(rows=5000)
+        record_table_schedule(state, None, "staff", None, upper_bound)
+        assert state["tables"]["staff"]["change_rate"] is None
+        assert state["tables"]["staff"]["next_check"] == str(upper_bound)
+
+
+class TestIsTableDue:
+    state = {
+        "tables": {
+            "staff": {"next_check": "2024-05-20 12:20:00"},
+            "design": {"watermark": "2024-05-20 12:00:00"},
+        }
+    }
+
+    def test_table_not_due_before_its_next_check(self):
+        assert not is_table_due(
+            self.state, "staff", datetime(2024, 5, 20, 12, 15)
+        )
+
+    def test_table_due_within_tolerance_of_next_check(self):
+        time_of_day = datetime(2024, 5, 20, 12, 19, 59)
+        assert is_table_due(self.state, "staff", time_of_day)
+
+    def test_table_without_schedule_always_due(self):
+        time_of_day = datetime(2024, 5, 20, 12, 15)
+        assert is_table_due(self.state, "design", time_of_day)
+        assert is_table_due(self.state, "currency", time_of_day)
+        assert is_table_due(None, "staff", time_of_day)
+
+
+class TestGetNextSuggestedRun:
+    def test_earliest_next_check_returned(self):
+        state = {
+            "tables": {
+                "staff": {"next_check": "2024-05-20 12:20:00"},
+                "design": {"next_check": "2024-05-20 12:10:00"},
+            }
+        }
+        assert get_next_suggested_run(state) == datetime(2024, 5, 20, 12, 10)
+
+    def test_none_if_any_table_unscheduled(self):
+        state = {
+            "tables": {
+                "staff": {"next_check": "2024-05-20 12:20:00"},
+                "design": {"watermark": "2024-05-20 12:00:00"},
+            }
+        }
+        assert get_next_suggested_run(state) is None
+        assert get_next_suggested_run(None) is None
@@ -1,10 +1,42 @@
 import pytest
 import boto3
 import os
+import re
+import subprocess
+import sys
 import datetime
+import gzip
+import hashlib
+import zstandard
+import pandas as pd
+import awswrangler as wr
+from decimal import Decimal
+from unittest.mock import MagicMock, patch
 from moto import mock_aws
-from src.extract_lambda.utils import write_csv_to_s3, convert_table_to_dict
+from src.extract_lambda.utils import (
+    convert_rows_to_csv,
+    get_last_updated_range,
+    write_csv_to_s3,
+    convert_table_to_dict,
+    get_table_query,
+    update_tables_in_parallel,
+    stream_table_to_s3,
+    get_copy_query,
+    copy_table_to_s3,
+    S3MultipartUpload,
+    get_ingestion_key,
+    get_change_probe_query,
+    probe_table_changes,
+    begin_snapshot,
+    import_snapshot,
+    run_in_savepoint,
+    update_tables_in_snapshot,
+    get_partition_column,
+    get_partition_ranges,
+    extract_table_in_partitions,
+)
 from pg8000.exceptions import DatabaseError
+from botocore.exceptions import ClientError
 
 
 @pytest.fixture(scope="function")
@@ -55,6 +87,60 @@ def test_sql_statement_not_vulnerable_to_injection():
         convert_table_to_dict(table)
 
 
+def test_incremental_query_only_returns_rows_after_watermark():
+    table = "staff"
+    watermark = datetime.datetime(2022, 11, 3, 14, 20, 51, 563000)
+    result = convert_table_to_dict(table, watermark=watermark)
+    assert isinstance(result, list)
+    for r in result:
+        assert r["last_updated"] > watermark
+
+
+class TestGetTableQuery:
+    def test_full_table_query_when_no_watermark(self):
+        query, params = get_table_query("staff")
+        assert query == "SELECT * FROM staff;"
+        assert params == {}
+
+    def test_watermark_is_passed_as_parameter(self):
+        watermark = datetime.datetime(2024, 5, 20, 12, 10, 3, 998128)
+        query, params = get_table_query("staff", watermark)
+        assert query == "SELECT * FROM staff WHERE last_updated > :watermark;"
+        assert params == {"watermark": watermark}
+
+    def test_upper_bound_added_when_given(self):
+        watermark = datetime.datetime(2024, 5, 20, 12, 10, 3, 998128)
+        upper_bound = datetime.datetime(2024, 5, 20, 12, 15, 3, 998128)
+        query, params = get_table_query("staff", watermark, upper_bound)
+        assert query == (
+            "SELECT * FROM staff WHERE last_updated > :watermark "
+            "AND last_updated <= :upper_bound;"
+        )
+        assert params == {"watermark": watermark, "upper_bound": upper_bound}
+
+    def test_upper_bound_ignored_without_watermark(self):
+        upper_bound = datetime.datetime(2024, 5, 20, 12, 15, 3, 998128)
+        query, params = get_table_query("staff", upper_bound=upper_bound)
+        assert query == "SELECT * FROM staff;"
+        assert params == {}
+
+    def test_partition_limits_query_to_key_range(self):
+        query, params = get_table_query(
+            "staff", partition=("staff_id", 1, 50, False)
+        )
+        assert query == (
+            "SELECT * FROM staff WHERE staff_id >= :range_start "
+            "AND staff_id < :range_end;"
+        )
+        assert params == {"range_start": 1, "range_end": 50}
+
+    def test_last_partition_includes_its_end(self):
+        query, params = get_table_query(
+            "staff", partition=("staff_id", 50, 100, True)
+        )
+        assert query.endswith("AND staff_id <= :range_end;")
+
+
 class TestWriteCsvToS3:
     def test_csv_file_is_written_to_bucket(self, s3_client):
         session = boto3.session.Session(
@@ -183,3 +269,1113 @@ class TestWriteCsvToS3:
 
         result = write_csv_to_s3(session, data, bucket, key)
         assert result["message"] == "The specified bucket does not exist"
+
+
+class TestUpdateTablesInParallel:
+    def test_results_returned_for_every_table_in_order(self, s3_client):
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        table_list = ["staff", "currency", "design"]
+
+        def fake_update(table, *args, **kwargs):
+            return {"success": True, "message": f"{table} written"}
+
+        with patch(
+            "src.extract_lambda.utils.update_data_in_bucket",
+            side_effect=fake_update,
+        ), patch("src.extract_lambda.utils.acquire_connection"), patch(
+            "src.extract_lambda.utils.release_connection"
+        ) as mock_release:
+            result = update_tables_in_parallel(
+                table_list,
+                "bucket",
+                session,
+                datetime.datetime.now(),
+                datetime.datetime.now(),
+                max_workers=2,
+            )
+        assert list(result) == table_list
+        assert result["currency"]["message"] == "currency written"
+        assert mock_release.call_count == len(table_list)
+
+    def test_connection_released_when_update_fails(self, s3_client):
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        with patch(
+            "src.extract_lambda.utils.update_data_in_bucket",
+            side_effect=DatabaseError("Table not found"),
+        ), patch("src.extract_lambda.utils.acquire_connection"), patch(
+            "src.extract_lambda.utils.release_connection"
+        ) as mock_release:
+            with pytest.raises(DatabaseError):
+                update_tables_in_parallel(
+                    ["staff"],
+                    "bucket",
+                    session,
+                    datetime.datetime.now(),
+                    datetime.datetime.now(),
+                    max_workers=2,
+                )
+        assert mock_release.call_count == 1
+
+
+class TestWriteParquetToS3:
+    def test_parquet_file_keeps_dtypes(self, s3_client):
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        data = [
+            {
+                "sales_order_id": 2,
+                "unit_price": Decimal("3.94"),
+                "agreed_payment_date": datetime.date(2022, 11, 8),
+                "last_updated": datetime.datetime(
+                    2022, 11, 3, 14, 20, 52, 186000
+                ),
+            },
+        ]
+        bucket = "bucket-for-my-emotions"
+        key = "folder/file.parquet"
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        result = write_csv_to_s3(
+            session, data, bucket, key, file_format="parquet"
+        )
+        assert result["message"] == "written to bucket"
+        df = wr.s3.read_parquet(
+            path=f"s3://{bucket}/{key}", boto3_session=session
+        )
+        assert df["unit_price"].dtype == "float64"
+        assert pd.api.types.is_datetime64_any_dtype(df["last_updated"])
+        assert df["unit_price"][0] == 3.94
+
+
+class TestCompressedCsv:
+    data = [
+        {"staff_id": 1, "first_name": "Jeremie"},
+        {"staff_id": 2, "first_name": "Deron"},
+    ]
+
+    def test_gzip_csv_written_with_content_encoding(self, s3_client):
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        bucket = "bucket-for-my-emotions"
+        key = "folder/file.csv.gz"
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        result = write_csv_to_s3(
+            session, self.data, bucket, key, compression="gzip"
+        )
+        assert result["message"] == "written to bucket"
+        response = s3_client.get_object(Bucket=bucket, Key=key)
+        assert response["ContentEncoding"] == "gzip"
+        output = gzip.decompress(response["Body"].read()).decode("UTF-8")
+        assert output == "staff_id,first_name\n1,Jeremie\n2,Deron\n"
+
+    def test_zstd_csv_written_with_content_encoding(self, s3_client):
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        bucket = "bucket-for-my-emotions"
+        key = "folder/file.csv.zst"
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        write_csv_to_s3(session, self.data, bucket, key, compression="zstd")
+        response = s3_client.get_object(Bucket=bucket, Key=key)
+        assert response["ContentEncoding"] == "zstd"
+        body = zstandard.ZstdDecompressor().decompressobj()
+        output = body.decompress(response["Body"].read()).decode("UTF-8")
+        assert output == "staff_id,first_name\n1,Jeremie\n2,Deron\n"
+
+
+class TestManifestDetails:
+    data = [
+        {
+            "staff_id": 1,
+            "last_updated": datetime.datetime(2022, 11, 3, 14, 20, 51),
+        },
+        {"staff_id": 2, "last_updated": None},
+        {
+            "staff_id": 3,
+            "last_updated": datetime.datetime(2023, 1, 5, 9, 0, 0),
+        },
+    ]
+
+    def test_written_file_size_and_checksum_match_object(self, s3_client):
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        bucket = "bucket-for-my-emotions"
+        key = "folder/file.csv.gz"
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        result = write_csv_to_s3(
+            session, self.data, bucket, key, compression="gzip"
+        )
+        body = s3_client.get_object(Bucket=bucket, Key=key)["Body"].read()
+        assert result["files"] == [
+            {
+                "key": key,
+                "bytes": len(body),
+                "sha256": hashlib.sha256(body).hexdigest(),
+            }
+        ]
+
+    def test_last_updated_range_skips_missing_values(self):
+        values = [row["last_updated"] for row in self.data]
+        assert get_last_updated_range(values) == (
+            datetime.datetime(2022, 11, 3, 14, 20, 51),
+            datetime.datetime(2023, 1, 5, 9, 0, 0),
+        )
+        assert get_last_updated_range([]) == (None, None)
+
+    def test_last_updated_range_widens_current_range(self):
+        current = (
+            datetime.datetime(2023, 1, 1),
+            datetime.datetime(2023, 1, 2),
+        )
+        values = [datetime.datetime(2022, 6, 1)]
+        assert get_last_updated_range(values, current) == (
+            datetime.datetime(2022, 6, 1),
+            datetime.datetime(2023, 1, 2),
+        )
+
+
+class TestGetIngestionKey:
+    def test_key_extension_matches_format_and_compression(self):
+        assert (
+            get_ingestion_key("original_data_dump", "staff")
+            == "ingested_data/original_data_dump/staff.csv"
+        )
+        assert (
+            get_ingestion_key("2024", "staff", "csv", "gzip")
+            == "ingested_data/2024/staff.csv.gz"
+        )
+        assert (
+            get_ingestion_key("2024", "staff", "csv", "zstd")
+            == "ingested_data/2024/staff.csv.zst"
+        )
+        assert (
+            get_ingestion_key("2024", "staff", "parquet", "zstd")
+            == "ingested_data/2024/staff.parquet"
+        )
+
+    def test_part_number_added_for_part_files(self):
+        assert (
+            get_ingestion_key("2024", "staff", "csv", "gzip", part=1)
+            == "ingested_data/2024/staff.part-0001.csv.gz"
+        )
+
+
+class FakeCursorConnection:
+    """Stands in for a pg8000 connection, returning rows from FETCH
+    statements in batches"""
+
+    def __init__(self, columns, rows):
+        self.columns = [{"name": column} for column in columns]
+        self.rows = rows
+        self.statements = []
+
+    def run(self, sql, **params):
+        self.statements.append(sql)
+        if sql.startswith("FETCH"):
+            batch_size = int(sql.split()[2])
+            batch, self.rows = self.rows[:batch_size], self.rows[batch_size:]
+            return batch
+        return []
+
+
+class TestStreamTableToS3:
+    columns = ["staff_id", "first_name", "last_updated"]
+    rows = [
+        [1, "Jeremie", datetime.datetime(2022, 11, 3, 14, 20, 51, 563000)],
+        [2, "Deron", datetime.datetime(2022, 11, 3, 14, 20, 51, 563000)],
+        [3, "Jeanette", datetime.datetime(2022, 11, 3, 14, 20, 51, 563000)],
+    ]
+
+    def test_rows_streamed_to_bucket_in_batches(self, s3_client):
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        bucket = "bucket-for-my-emotions"
+        key = "folder/file.csv"
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        conn = FakeCursorConnection(self.columns, list(self.rows))
+        with patch(
+            "src.extract_lambda.utils.sql_security", return_value="staff"
+        ):
+            result = stream_table_to_s3(
+                session, "staff", bucket, key, conn=conn, batch_size=2
+            )
+        assert result["success"] is True
+        assert result["rows"] == 3
+        assert result["rows_fetched"] == 3
+        assert set(result["timings"]) == {"query", "serialise", "upload"}
+        assert result["min_last_updated"] == self.rows[0][2]
+        assert result["max_last_updated"] == self.rows[2][2]
+        fetches = [sql for sql in conn.statements if sql.startswith("FETCH")]
+        assert len(fetches) == 3
+        assert conn.statements[-1] == "COMMIT;"
+        response = s3_client.get_object(Bucket=bucket, Key=key)
+        output = response["Body"].read().decode("UTF-8")
+        assert output == (
+            "staff_id,first_name,last_updated\n"
+            "1,Jeremie,2022-11-03 14:20:51.563\n"
+            "2,Deron,2022-11-03 14:20:51.563\n"
+            "3,Jeanette,2022-11-03 14:20:51.563\n"
+        )
+
+    def test_large_table_uploaded_in_multiple_parts(self, s3_client):
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        bucket = "bucket-for-my-emotions"
+        key = "folder/file.csv"
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        name = "x" * 1000
+        rows = [[i, name, self.rows[0][2]] for i in range(12000)]
+        conn = FakeCursorConnection(self.columns, rows)
+        with patch(
+            "src.extract_lambda.utils.sql_security", return_value="staff"
+        ):
+            result = stream_table_to_s3(
+                session,
+                "staff",
+                bucket,
+                key,
+                conn=conn,
+                batch_size=1000,
+                part_size=5 * 1024 * 1024,
+            )
+        assert result["success"]
+        response = s3_client.head_object(Bucket=bucket, Key=key, PartNumber=1)
+        assert response["PartsCount"] == 3
+        body = s3_client.get_object(Bucket=bucket, Key=key)["Body"].read()
+        assert body.count(b"\n") == 12001
+
+    def test_returns_no_new_data_and_writes_nothing_if_no_rows(
+        self, s3_client
+    ):
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        bucket = "bucket-for-my-emotions"
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        conn = FakeCursorConnection(self.columns, [])
+        with patch(
+            "src.extract_lambda.utils.sql_security", return_value="staff"
+        ):
+            result = stream_table_to_s3(
+                session, "staff", bucket, "folder/file.csv", conn=conn
+            )
+        assert set(result.pop("timings")) == {"query"}
+        assert result == {
+            "success": False,
+            "message": "no new data",
+            "rows_fetched": 0,
+        }
+        assert "Contents" not in s3_client.list_objects_v2(Bucket=bucket)
+
+    def test_write_fails_when_bucket_not_found(self, s3_client):
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        conn = FakeCursorConnection(self.columns, list(self.rows))
+        with patch(
+            "src.extract_lambda.utils.sql_security", return_value="staff"
+        ):
+            result = stream_table_to_s3(
+                session,
+                "staff",
+                "bucket-for-my-emotions",
+                "file.csv",
+                conn=conn,
+            )
+        assert result["success"] is False
+        assert result["message"] == "The specified bucket does not exist"
+
+
+class FakeCopyConnection:
+    """Stands in for a pg8000 connection, writing CSV bytes to the stream
+    passed for a COPY statement and returning last_updated_range for any
+    other SELECT"""
+
+    def __init__(self, output, row_count, last_updated_range=(None, None)):
+        self.output = output
+        self.row_count = row_count
+        self.last_updated_range = last_updated_range
+        self.statements = []
+
+    def run(self, sql, stream=None, **params):
+        self.statements.append(sql)
+        if sql.startswith("COPY"):
+            for i in range(0, len(self.output), 4):
+                stream.write(self.output[i : i + 4])
+        elif sql.startswith("SELECT"):
+            return [list(self.last_updated_range)]
+        return None
+
+
+class TestGetCopyQuery:
+    column_types = {
+        "payment_id": "integer",
+        "paid": "boolean",
+        "last_updated": "timestamp without time zone",
+    }
+
+    def test_full_table_copy_lists_columns(self):
+        result = get_copy_query("payment", self.column_types)
+        assert result == (
+            'COPY (SELECT "payment_id", '
+            """CASE WHEN "paid" THEN 'True' WHEN NOT "paid" THEN 'False' """
+            'END AS "paid", '
+            """to_char("last_updated", 'YYYY-MM-DD HH24:MI:SS.MS') """
+            'AS "last_updated" FROM payment) '
+            "TO STDOUT WITH (FORMAT csv, HEADER true);"
+        )
+
+    def test_watermarks_added_to_copy(self):
+        watermark = datetime.datetime(2024, 5, 20, 12, 10, 3, 998128)
+        upper_bound = datetime.datetime(2024, 5, 20, 12, 15)
+        result = get_copy_query(
+            "payment", {"payment_id": "integer"}, watermark, upper_bound
+        )
+        assert result == (
+            'COPY (SELECT "payment_id" FROM payment '
+            "WHERE last_updated > '2024-05-20 12:10:03.998128' "
+            "AND last_updated <= '2024-05-20 12:15:00') "
+            "TO STDOUT WITH (FORMAT csv, HEADER true);"
+        )
+
+    def test_partition_limits_copy_to_key_range(self):
+        result = get_copy_query(
+            "payment",
+            {"payment_id": "integer"},
+            partition=("payment_id", 1, 50, False),
+        )
+        assert result == (
+            'COPY (SELECT "payment_id" FROM payment '
+            "WHERE payment_id >= 1 AND payment_id < 50) "
+            "TO STDOUT WITH (FORMAT csv, HEADER true);"
+        )
+
+    def test_last_time_slice_includes_its_end(self):
+        partition = (
+            "last_updated",
+            datetime.datetime(2024, 1, 1),
+            datetime.datetime(2024, 1, 2),
+            True,
+        )
+        result = get_copy_query(
+            "payment", {"payment_id": "integer"}, partition=partition
+        )
+        assert (
+            "WHERE last_updated >= '2024-01-01 00:00:00' "
+            "AND last_updated <= '2024-01-02 00:00:00')"
+        ) in result
+
+    def test_text_range_boundary_rejected(self):
+        with pytest.raises(TypeError):
+            get_copy_query(
+                "payment",
+                {"payment_id": "integer"},
+                partition=("payment_id", "1; DROP TABLE payment", 2, True),
+            )
+
+
+class TestCopyTableToS3:
+    output = (
+        b"staff_id,first_name,last_updated\n"
+        b"1,Jeremie,2022-11-03 14:20:51.563\n"
+        b"2,Deron,2022-11-03 14:20:51.563\n"
+    )
+
+    def test_copy_output_written_to_bucket(self, s3_client):
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        bucket = "bucket-for-my-emotions"
+        key = "ingested_data/original_data_dump/staff.csv"
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        conn = FakeCopyConnection(self.output, 2)
+        with patch(
+            "src.extract_lambda.utils.sql_security", return_value="staff"
+        ), patch("src.extract_lambda.utils.get_catalogue"):
+            result = copy_table_to_s3(session, "staff", bucket, key, conn=conn)
+        timings = result.pop("timings")
+        assert set(timings) == {"query", "serialise", "upload"}
+        assert timings["serialise"] == 0
+        assert result == {
+            "success": True,
+            "message": "written to bucket",
+            "rows": 2,
+            "rows_fetched": 2,
+            "files": [
+                {
+                    "key": key,
+                    "bytes": len(self.output),
+                    "sha256": hashlib.sha256(self.output).hexdigest(),
+                }
+            ],
+            "min_last_updated": None,
+            "max_last_updated": None,
+        }
+        assert conn.statements[1].startswith("COPY")
+        response = s3_client.get_object(Bucket=bucket, Key=key)
+        assert response["Body"].read() == self.output
+
+    def test_range_read_in_same_transaction_as_copy(self, s3_client):
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        bucket = "bucket-for-my-emotions"
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        last_updated = datetime.datetime(2022, 11, 3, 14, 20, 51, 563000)
+        conn = FakeCopyConnection(self.output, 2, (last_updated, last_updated))
+        catalogue = MagicMock()
+        catalogue.column_types.return_value = {
+            "staff_id": "integer",
+            "first_name": "text",
+            "last_updated": "timestamp without time zone",
+        }
+        with patch(
+            "src.extract_lambda.utils.sql_security", return_value="staff"
+        ), patch(
+            "src.extract_lambda.utils.get_catalogue", return_value=catalogue
+        ):
+            result = copy_table_to_s3(
+                session, "staff", bucket, "staff.csv", conn=conn
+            )
+        assert result["min_last_updated"] == last_updated
+        assert result["max_last_updated"] == last_updated
+        assert conn.statements[0] == (
+            "START TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY;"
+        )
+        assert conn.statements[1].startswith("COPY")
+        assert "min(last_updated), max(last_updated)" in conn.statements[2]
+        assert conn.statements[3] == "COMMIT;"
+
+    def test_no_transaction_started_inside_snapshot(self, s3_client):
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        bucket = "bucket-for-my-emotions"
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        conn = FakeCopyConnection(self.output, 2)
+        with patch(
+            "src.extract_lambda.utils.sql_security", return_value="staff"
+        ), patch("src.extract_lambda.utils.get_catalogue"):
+            copy_table_to_s3(
+                session,
+                "staff",
+                bucket,
+                "staff.csv",
+                conn=conn,
+                in_transaction=True,
+            )
+        assert len(conn.statements) == 1
+        assert conn.statements[0].startswith("COPY")
+
+    def test_no_object_written_if_no_rows(self, s3_client):
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        bucket = "bucket-for-my-emotions"
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        conn = FakeCopyConnection(b"staff_id,first_name,last_updated\n", 0)
+        with patch(
+            "src.extract_lambda.utils.sql_security", return_value="staff"
+        ), patch("src.extract_lambda.utils.get_catalogue"):
+            result = copy_table_to_s3(
+                session, "staff", bucket, "staff.csv", conn=conn
+            )
+        assert set(result.pop("timings")) == {"query"}
+        assert result == {
+            "success": False,
+            "message": "no new data",
+            "rows_fetched": 0,
+        }
+        assert "Contents" not in s3_client.list_objects_v2(Bucket=bucket)
+
+    def test_copy_fails_when_bucket_not_found(self, s3_client):
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        conn = FakeCopyConnection(self.output, 2)
+        with patch(
+            "src.extract_lambda.utils.sql_security", return_value="staff"
+        ), patch("src.extract_lambda.utils.get_catalogue"):
+            result = copy_table_to_s3(
+                session, "staff", "bucket-for-my-emotions", "a.csv", conn=conn
+            )
+        assert result["message"] == "The specified bucket does not exist"
+
+
+class TestS3MultipartUpload:
+    def test_compressed_parts_decompress_to_original(self, s3_client):
+        bucket = "bucket-for-my-emotions"
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        upload = S3MultipartUpload(
+            s3_client,
+            bucket,
+            "file.csv.gz",
+            part_size=5 * 1024 * 1024,
+            compression="gzip",
+        )
+        expected = os.urandom(6 * 1024 * 1024)
+        for i in range(0, len(expected), 65536):
+            upload.write(expected[i : i + 65536])
+        upload.close()
+        assert len(upload.parts) == 2
+        response = s3_client.get_object(Bucket=bucket, Key="file.csv.gz")
+        assert gzip.decompress(response["Body"].read()) == expected
+
+    def test_write_returns_uncompressed_size(self, s3_client):
+        upload = S3MultipartUpload(
+            s3_client,
+            "bucket-for-my-emotions",
+            "file.csv.gz",
+            compression="gzip",
+        )
+        data = b"staff_id\n" * 1000
+        assert upload.write(data) == len(data)
+        assert upload.bytes_written == len(data)
+
+    def test_write_errors_held_until_close(self, s3_client):
+        upload = S3MultipartUpload(
+            s3_client, "bucket-for-my-emotions", "file.csv", part_size=4
+        )
+        upload.write(b"staff_id\n")
+        assert upload.error is not None
+        with pytest.raises(ClientError):
+            upload.close()
+
+
+class FakeProbeConnection:
+    """Stands in for a pg8000 connection, returning the rows of a change
+    probe or raising the error given"""
+
+    def __init__(self, rows=None, error=None):
+        self.rows = rows
+        self.error = error
+        self.statements = []
+
+    def run(self, sql, **params):
+        self.statements.append((sql, params))
+        if self.error is not None:
+            raise self.error
+        return self.rows
+
+
+class TestGetChangeProbeQuery:
+    def test_tables_probed_in_one_union_all_query(self):
+        watermark = datetime.datetime(2024, 5, 20, 12, 0)
+        upper_bound = datetime.datetime(2024, 5, 20, 12, 5)
+        query, params = get_change_probe_query(
+            {"staff": watermark, "currency": watermark}, upper_bound
+        )
+        assert query == (
+            "SELECT 'staff' AS table_name, "
+            "max(last_updated) AS max_last_updated, "
+            "count(*) AS changed_rows FROM staff "
+            "WHERE last_updated > :watermark_0 "
+            "AND last_updated <= :upper_bound "
+            "UNION ALL "
+            "SELECT 'currency' AS table_name, "
+            "max(last_updated) AS max_last_updated, "
+            "count(*) AS changed_rows FROM currency "
+            "WHERE last_updated > :watermark_1 "
+            "AND last_updated <= :upper_bound;"
+        )
+        assert params == {
+            "upper_bound": upper_bound,
+            "watermark_0": watermark,
+            "watermark_1": watermark,
+        }
+
+
+@patch("src.extract_lambda.utils.sql_security", side_effect=lambda t, c: t)
+class TestProbeTableChanges:
+    watermark = datetime.datetime(2024, 5, 20, 12, 0)
+    upper_bound = datetime.datetime(2024, 5, 20, 12, 5)
+
+    def test_returns_changes_for_each_table(self, mock_security):
+        latest = datetime.datetime(2024, 5, 20, 12, 3)
+        conn = FakeProbeConnection(
+            rows=[["staff", latest, 2], ["currency", None, 0]]
+        )
+        result = probe_table_changes(
+            {"staff": self.watermark, "currency": self.watermark},
+            self.upper_bound,
+            conn,
+        )
+        assert result == {
+            "staff": {"changed_rows": 2, "max_last_updated": latest},
+            "currency": {"changed_rows": 0, "max_last_updated": None},
+        }
+        assert len(conn.statements) == 1
+
+    def test_returns_none_if_probe_fails(self, mock_security):
+        conn = FakeProbeConnection(error=DatabaseError("no last_updated"))
+        result = probe_table_changes(
+            {"staff": self.watermark}, self.upper_bound, conn
+        )
+        assert result is None
+
+
+class FakeSnapshotConnection:
+    """Stands in for a pg8000 connection, recording the statements run and
+    raising an error for any statement in fail_on"""
+
+    def __init__(self, fail_on=()):
+        self.fail_on = fail_on
+        self.statements = []
+
+    def run(self, sql, **params):
+        self.statements.append(sql)
+        if sql in self.fail_on:
+            raise DatabaseError("current transaction is aborted")
+        if sql == "SELECT LOCALTIMESTAMP;":
+            return [[datetime.datetime(2024, 5, 20, 12, 15)]]
+        return []
+
+
+class TestSnapshot:
+    def test_begin_snapshot_returns_database_clock(self):
+        conn = FakeSnapshotConnection()
+        result = begin_snapshot(conn)
+        assert result == datetime.datetime(2024, 5, 20, 12, 15)
+        assert conn.statements[1] == (
+            "START TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY;"
+        )
+
+    def test_import_snapshot_sets_transaction_snapshot(self):
+        conn = FakeSnapshotConnection()
+        import_snapshot(conn, "00000003-0000001B-1")
+        assert conn.statements == [
+            "START TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY;",
+            "SET TRANSACTION SNAPSHOT '00000003-0000001B-1';",
+        ]
+
+    def test_import_snapshot_rejects_anything_but_an_id(self):
+        conn = FakeSnapshotConnection()
+        with pytest.raises(ValueError):
+            import_snapshot(conn, "1'; DROP TABLE staff; --")
+        assert conn.statements == []
+
+    def test_savepoint_released_after_successful_step(self):
+        conn = FakeSnapshotConnection()
+        result = run_in_savepoint(conn, lambda x: x * 2, 21)
+        assert result == 42
+        assert conn.statements == [
+            "SAVEPOINT snapshot_step;",
+            "RELEASE SAVEPOINT snapshot_step;",
+        ]
+
+    def test_rolled_back_to_savepoint_after_failed_step(self):
+        conn = FakeSnapshotConnection(
+            fail_on=["RELEASE SAVEPOINT snapshot_step;"]
+        )
+        with pytest.raises(DatabaseError):
+            run_in_savepoint(conn, lambda: None)
+        assert "ROLLBACK TO SAVEPOINT snapshot_step;" in conn.statements
+
+    def test_tables_extracted_in_one_transaction(self):
+        conn = FakeSnapshotConnection()
+        time_of_day = datetime.datetime(2024, 5, 20, 12, 15)
+        runtimes = {
+            "staff": datetime.datetime(2024, 5, 20, 12, 10),
+            "currency": datetime.datetime(2024, 5, 20, 12, 5),
+        }
+        with patch(
+            "src.extract_lambda.utils.update_data_in_bucket",
+            return_value={"success": False, "message": "no new data"},
+        ) as mock_update:
+            result = update_tables_in_snapshot(
+                ["staff", "currency"],
+                "bucket",
+                None,
+                time_of_day,
+                runtimes,
+                conn,
+            )
+        assert list(result) == ["staff", "currency"]
+        assert mock_update.call_args_list[1].args[4] == runtimes["currency"]
+        assert mock_update.call_args.kwargs["conn"] is conn
+        assert mock_update.call_args.kwargs["in_transaction"]
+        assert conn.statements.count("SAVEPOINT snapshot_step;") == 2
+        assert conn.statements[-1] == "COMMIT;"
+
+    def test_stream_does_not_end_snapshot_transaction(self, s3_client):
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        bucket = "bucket-for-my-emotions"
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        rows = [[1, "Jeremie", datetime.datetime(2022, 11, 3, 14, 20)]]
+        conn = FakeCursorConnection(["staff_id", "name", "last_updated"], rows)
+        with patch(
+            "src.extract_lambda.utils.sql_security", return_value="staff"
+        ):
+            result = stream_table_to_s3(
+                session,
+                "staff",
+                bucket,
+                "staff.csv",
+                conn=conn,
+                in_transaction=True,
+            )
+        assert result["success"]
+        assert "COMMIT;" not in conn.statements
+        assert not any(sql.startswith("START") for sql in conn.statements)
+
+
+class FakeMinMaxConnection:
+    """Stands in for a pg8000 connection, returning the min and max given"""
+
+    def __init__(self, low, high):
+        self.low = low
+        self.high = high
+        self.statements = []
+
+    def run(self, sql, **params):
+        self.statements.append(sql)
+        return [[self.low, self.high]]
+
+
+class TestGetPartitionRanges:
+    def test_integer_key_split_into_contiguous_ranges(self):
+        conn = FakeMinMaxConnection(1, 100)
+        result = get_partition_ranges("staff", "staff_id", 4, conn=conn)
+        assert result == [
+            ("staff_id", 1, 25, False),
+            ("staff_id", 25, 50, False),
+            ("staff_id", 50, 75, False),
+            ("staff_id", 75, 100, True),
+        ]
+        assert conn.statements == [
+            "SELECT min(staff_id), max(staff_id) FROM staff;"
+        ]
+
+    def test_small_key_range_gives_fewer_partitions(self):
+        conn = FakeMinMaxConnection(1, 2)
+        result = get_partition_ranges("staff", "staff_id", 4, conn=conn)
+        assert result == [("staff_id", 1, 2, True)]
+
+    def test_timestamps_split_into_time_slices(self):
+        low = datetime.datetime(2024, 1, 1)
+        high = datetime.datetime(2024, 1, 3)
+        conn = FakeMinMaxConnection(low, high)
+        result = get_partition_ranges("staff", "last_updated", 2, conn=conn)
+        assert result == [
+            ("last_updated", low, datetime.datetime(2024, 1, 2), False),
+            ("last_updated", datetime.datetime(2024, 1, 2), high, True),
+        ]
+
+    def test_empty_table_has_no_ranges(self):
+        conn = FakeMinMaxConnection(None, None)
+        assert get_partition_ranges("staff", "staff_id", 4, conn=conn) == []
+
+
+class TestGetPartitionColumn:
+    def test_single_integer_primary_key_used(self):
+        with patch("src.extract_lambda.utils.get_catalogue") as mock_cat:
+            mock_cat.return_value.primary_key.return_value = ["staff_id"]
+            mock_cat.return_value.column_types.return_value = {
+                "staff_id": "integer"
+            }
+            assert get_partition_column("staff") == "staff_id"
+
+    def test_last_updated_used_without_integer_primary_key(self):
+        with patch("src.extract_lambda.utils.get_catalogue") as mock_cat:
+            mock_cat.return_value.primary_key.return_value = ["code"]
+            mock_cat.return_value.column_types.return_value = {"code": "text"}
+            assert get_partition_column("currency") == "last_updated"
+
+
+class FakePartitionConnection:
+    """Stands in for a pg8000 connection holding a table of rows with an
+    integer id, answering the min/max query, exporting a snapshot and
+    writing the rows of the key range a COPY is run for"""
+
+    snapshot = "00000003-0000001B-1"
+
+    def __init__(self, rows, fail_from=None):
+        self.rows = rows
+        self.fail_from = fail_from
+        self.row_count = -1
+        self.statements = []
+
+    def run(self, sql, stream=None, **params):
+        self.statements.append(sql)
+        if sql.startswith("SELECT min"):
+            ids = [row[0] for row in self.rows]
+            return [[min(ids), max(ids)]]
+        if sql == "SELECT pg_export_snapshot();":
+            return [[self.snapshot]]
+        if sql.startswith("COPY"):
+            start, operator, end = re.search(
+                r"staff_id >= (\d+) AND staff_id (<=?) (\d+)", sql
+            ).groups()
+            start, end = int(start), int(end)
+            if self.fail_from is not None and start >= self.fail_from:
+                raise DatabaseError("canceling statement due to timeout")
+            rows = [
+                row
+                for row in self.rows
+                if start <= row[0]
+                and (row[0] < end or operator == "<=" and row[0] == end)
+            ]
+            stream.write(b"staff_id,first_name\n")
+            for row in rows:
+                stream.write(f"{row[0]},{row[1]}\n".encode())
+            self.row_count = len(rows)
+        return []
+
+
+@patch(
+    "src.extract_lambda.utils.get_catalogue",
+    **{
+        "return_value.column_types.return_value": {
+            "staff_id": "integer",
+            "first_name": "text",
+        }
+    },
+)
+@patch("src.extract_lambda.utils.release_connection")
+@patch("src.extract_lambda.utils.sql_security", side_effect=lambda t, c: t)
+@patch(
+    "src.extract_lambda.utils.get_partition_column", return_value="staff_id"
+)
+class TestExtractTableInPartitions:
+    rows = [[i, f"name{i}"] for i in range(1, 9)]
+
+    def test_parts_written_and_read_back_as_one_table(
+        self, mock_column, mock_security, mock_release, mock_cat, s3_client
+    ):
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        bucket = "bucket-for-my-emotions"
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        conn = FakePartitionConnection(self.rows)
+        with patch(
+            "src.extract_lambda.utils.acquire_connection",
+            side_effect=lambda blocking=True: FakePartitionConnection(
+                self.rows
+            ),
+        ):
+            result = extract_table_in_partitions(
+                session, "staff", bucket, "2024", 3, conn=conn
+            )
+        assert result["rows"] == 8
+        assert result["parts"] == 3
+        response = s3_client.list_objects_v2(Bucket=bucket)
+        keys = [file["Key"] for file in response["Contents"]]
+        assert [file["key"] for file in result["files"]] == keys
+        assert keys == [
+            "ingested_data/2024/staff.part-0000.csv",
+            "ingested_data/2024/staff.part-0001.csv",
+            "ingested_data/2024/staff.part-0002.csv",
+        ]
+        df = wr.s3.read_csv(
+            path=[f"s3://{bucket}/{key}" for key in keys],
+            boto3_session=session,
+        )
+        assert list(df["staff_id"]) == list(range(1, 9))
+
+    def test_written_parts_deleted_if_a_part_fails(
+        self, mock_column, mock_security, mock_release, mock_cat, s3_client
+    ):
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        bucket = "bucket-for-my-emotions"
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        conn = FakePartitionConnection(self.rows)
+        with patch(
+            "src.extract_lambda.utils.acquire_connection",
+            side_effect=lambda blocking=True: FakePartitionConnection(
+                self.rows, 5
+            ),
+        ):
+            result = extract_table_in_partitions(
+                session, "staff", bucket, "2024", 3, conn=conn
+            )
+        assert result["success"] is False
+        assert result["message"] == 'relation "staff" does not exist'
+        response = s3_client.list_objects_v2(Bucket=bucket)
+        assert "Contents" not in response
+
+    def test_parts_run_on_table_connection_when_pool_is_full(
+        self, mock_column, mock_security, mock_release, mock_cat, s3_client
+    ):
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        bucket = "bucket-for-my-emotions"
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        conn = FakePartitionConnection(self.rows)
+        with patch(
+            "src.extract_lambda.utils.acquire_connection", return_value=None
+        ) as mock_acquire:
+            result = extract_table_in_partitions(
+                session, "staff", bucket, "2024", 3, conn=conn
+            )
+        assert result["rows"] == 8
+        assert result["parts"] == 3
+        mock_acquire.assert_called_once_with(blocking=False)
+        assert mock_release.call_count == 0
+
+    def test_parts_read_in_one_exported_snapshot(
+        self, mock_column, mock_security, mock_release, mock_cat, s3_client
+    ):
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        bucket = "bucket-for-my-emotions"
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        conn = FakePartitionConnection(self.rows)
+        extra = FakePartitionConnection(self.rows)
+        with patch(
+            "src.extract_lambda.utils.acquire_connection",
+            side_effect=[extra, None],
+        ):
+            result = extract_table_in_partitions(
+                session, "staff", bucket, "2024", 3, conn=conn
+            )
+        assert result["rows"] == 8
+        start = "START TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY;"
+        assert conn.statements[:2] == [start, "SELECT pg_export_snapshot();"]
+        assert conn.statements[-1] == "COMMIT;"
+        assert conn.statements.count(start) == 1
+        assert [sql for sql in extra.statements if "COPY" not in sql] == [
+            start,
+            f"SET TRANSACTION SNAPSHOT '{conn.snapshot}';",
+            "COMMIT;",
+        ]
+
+    def test_failed_cleanup_does_not_hide_part_error(
+        self, mock_column, mock_security, mock_release, mock_cat, caplog
+    ):
+        session = MagicMock()
+        session.client.return_value.delete_objects.side_effect = ClientError(
+            {"Error": {"Code": "AccessDenied", "Message": "Access Denied"}},
+            "DeleteObjects",
+        )
+        responses = [
+            {"success": True, "message": "written to bucket"},
+            {"success": False, "message": "canceling statement"},
+        ]
+        with patch(
+            "src.extract_lambda.utils.get_partition_ranges",
+            return_value=[("staff_id", 1, 4, False), ("staff_id", 4, 8, True)],
+        ), patch(
+            "src.extract_lambda.utils.acquire_connection", return_value=None
+        ), patch(
+            "src.extract_lambda.utils.extract_slice_to_s3",
+            side_effect=responses,
+        ):
+            result = extract_table_in_partitions(
+                session, "staff", "bucket", "2024", 2, conn=MagicMock()
+            )
+        assert result == responses[1]
+        assert "could not be deleted" in caplog.text
+
+
+class TestColdStartImports:
+    def test_extract_lambda_imports_without_pandas(self):
+        result = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import sys, src.extract_lambda.handler; "
+                "print('pandas' in sys.modules, 'awswrangler' in sys.modules)",
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        assert result.stdout.strip() == "False False"
+
+    def test_rows_serialised_with_one_timestamp_precision(self):
+        data = [
+            {
+                "payment_id": 1,
+                "amount": Decimal("552548.62"),
+                "paid": False,
+                "payment_date": datetime.date(2022, 11, 3),
+                "company_ac_number": None,
+                "last_updated": datetime.datetime(2022, 11, 3, 14, 20, 52),
+            },
+            {
+                "payment_id": 2,
+                "amount": Decimal("205952.22"),
+                "paid": True,
+                "payment_date": datetime.date(2022, 11, 4),
+                "company_ac_number": "a, b",
+                "last_updated": datetime.datetime(
+                    2022, 11, 3, 14, 20, 52, 187000
+                ),
+            },
+        ]
+        result = convert_rows_to_csv(data).decode("utf-8")
+        assert result == (
+            "payment_id,amount,paid,payment_date,company_ac_number,"
+            "last_updated\n"
+            "1,552548.62,False,2022-11-03,,2022-11-03 14:20:52.000\n"
+            '2,205952.22,True,2022-11-04,"a, b",2022-11-03 14:20:52.187\n'
+        )
+
+    def test_empty_rows_serialised_as_empty_file(self):
+        assert convert_rows_to_csv([]) == b""
@@ -0,0 +1,125 @@
+from unittest.mock import MagicMock, patch
+from pg8000.exceptions import DatabaseError
+import pytest
+import src.load_lambda.catalogue as catalogue
+from src.load_lambda.catalogue import (
+    SchemaCatalogue,
+    get_catalogue,
+    invalidate_catalogue,
+)
+from src.load_lambda.utils import sql_security
+
+rows = [
+    ["dim_staff", "staff_record_id", "integer"],
+    ["dim_staff", "first_name", "character varying"],
+    ["dim_staff", "email_address", "character varying"],
+    ["dim_currency", "currency_record_id", "integer"],
+    ["dim_currency", "currency_code", "character varying"],
+    ["pg_statistic", "starelid", "oid"],
+    ["_prisma_migrations", "id", "character varying"],
+]
+
+
+@pytest.fixture(scope="function", autouse=True)
+def clear_cached_catalogue():
+    invalidate_catalogue()
+    yield
+    invalidate_catalogue()
+
+
+class TestSchemaCatalogue:
+    def test_tables_excludes_system_tables(self):
+        result = SchemaCatalogue(rows)
+        assert result.tables == ["dim_currency", "dim_staff"]
+
+    def test_columns_returned_in_defined_order(self):
+        result = SchemaCatalogue(rows)
+        assert result.columns("dim_staff") == [
+            "staff_record_id",
+            "first_name",
+            "email_address",
+        ]
+
+    def test_column_types_returned(self):
+        result = SchemaCatalogue(rows)
+        assert result.column_types("dim_currency") == {
+            "currency_record_id": "integer",
+            "currency_code": "character varying",
+        }
+
+    def test_unknown_table_raises_key_error(self):
+        result = SchemaCatalogue(rows)
+        with pytest.raises(KeyError):
+            result.columns("pg_statistic")
+
+    def test_has_table(self):
+        result = SchemaCatalogue(rows)
+        assert result.has_table("dim_staff")
+        assert not result.has_table("pg_statistic")
+        assert not result.has_table("dim_staff; drop table dim_staff;")
+
+    def test_catalogue_is_stale_after_ttl(self):
+        result = SchemaCatalogue(rows, ttl=-1)
+        assert result.is_stale()
+        assert not SchemaCatalogue(rows).is_stale()
+
+
+class TestGetCatalogue:
+    def test_catalogue_only_queried_once_while_fresh(self):
+        conn = MagicMock()
+        conn.run.return_value = rows
+        first = get_catalogue(conn)
+        second = get_catalogue(conn)
+        assert first is second
+        assert conn.run.call_count == 1
+
+    def test_stale_catalogue_is_reloaded(self):
+        conn = MagicMock()
+        conn.run.return_value = rows
+        get_catalogue(conn, ttl=-1)
+        get_catalogue(conn)
+        assert conn.run.call_count == 2
+
+    def test_invalidate_forces_reload(self):
+        conn = MagicMock()
+        conn.run.return_value = rows
+        get_catalogue(conn)
+        invalidate_catalogue()
+        get_catalogue(conn)
+        assert conn.run.call_count == 2
+        assert catalogue.cached_catalogue is not None
+
+    def test_own_connection_opened_and_closed_if_none_given(self):
+        conn = MagicMock()
+        conn.run.return_value = rows
+        with patch(
+            "src.load_lambda.catalogue.connect_to_db", return_value=conn
+        ):
+            result = get_catalogue()
+        assert result.has_table("dim_staff")
+        conn.close.assert_called_once()
+
+
+class TestSqlSecurity:
+    def test_known_table_returned_without_reload(self):
+        conn = MagicMock()
+        conn.run.return_value = rows
+        assert sql_security("dim_staff", conn) == "dim_staff"
+        assert conn.run.call_count == 1
+
+    def test_missing_table_reloads_catalogue_once(self):
+        conn = MagicMock()
+        conn.run.side_effect = [
+            rows,
+            rows + [["fact_sales_order", "sales_record_id", "integer"]],
+        ]
+        get_catalogue(conn)
+        assert sql_security("fact_sales_order", conn) == "fact_sales_order"
+        assert conn.run.call_count == 2
+
+    def test_unknown_table_raises_database_error(self):
+        conn = MagicMock()
+        conn.run.return_value = rows
+        with pytest.raises(DatabaseError):
+            sql_security("pg_statistic", conn)
+        assert conn.run.call_count == 2
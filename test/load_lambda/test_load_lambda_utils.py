@@ -1,6 +1,7 @@
 import pytest
 import boto3
 import os
+import json
 import pandas as pd
 from moto import mock_aws
 from src.load_lambda.utils import (
@@ -8,6 +9,7 @@ from src.load_lambda.utils import (
     get_latest_processed_file_list,
     insert_data_into_data_warehouse,
     get_insert_query,
+    read_run_folder,
 )
 from test_warehouse_db import seed_warehouse_db, root_warehouse_db
 
@@ -25,6 +27,33 @@ def s3_client(aws_creds):
         yield boto3.client("s3")
 
 
+class TestReadRunFolder:
+    def test_folder_read_from_run_state(self, s3_client):
+        bucket = "blackwater-ingestion-zone"
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        state = {"folder": "2024-05-20 12:10:03.998128", "tables": {}}
+        s3_client.put_object(
+            Bucket=bucket, Key="run_state.json", Body=json.dumps(state)
+        )
+        assert read_run_folder(s3_client) == "2024-05-20 12:10:03.998128"
+
+    def test_legacy_runtime_used_if_no_run_state(self, s3_client):
+        bucket = "blackwater-ingestion-zone"
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        s3_client.upload_file(
+            Filename="test/data/last_ran_at_99/last_ran_at.csv",
+            Bucket=bucket,
+            Key="last_ran_at.csv",
+        )
+        assert read_run_folder(s3_client) == "original_data_dump"
+
+
 class TestGetLatestProcessedFileList:
     def test_function_returns_failure_message_if_bucket_does_not_exist(
         self, s3_client
@@ -103,6 +132,59 @@ class TestGetLatestProcessedFileList:
             "2024-05-20 12:10:03.998128/staff.parquet",
         ]
 
+    def test_runs_sharing_a_timestamp_prefix_not_mixed(self, s3_client):
+        bucket = "blackwater-processed-zone"
+        timestamp = "2024-05-20 12:10:03"
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        for key in [
+            f"{timestamp}/staff.parquet",
+            f"{timestamp}.5/staff.parquet",
+            f"archive/{timestamp}/staff.parquet",
+        ]:
+            s3_client.put_object(Bucket=bucket, Key=key, Body=b"")
+        result = get_latest_processed_file_list(s3_client, timestamp)
+        assert result["file_list"] == [f"{timestamp}/staff.parquet"]
+
+    def test_file_list_read_from_manifest_skipping_empty_tables(
+        self, s3_client
+    ):
+        bucket = "blackwater-processed-zone"
+        timestamp = "2024-05-20 12:10:03.998128"
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        manifest = {
+            "folder": timestamp,
+            "tables": {
+                "fact_sales_order": {
+                    "key": f"{timestamp}/fact_sales_order.parquet",
+                    "rows": 3,
+                },
+                "dim_staff": {
+                    "key": f"{timestamp}/dim_staff.parquet",
+                    "rows": 2,
+                },
+                "dim_design": {
+                    "key": f"{timestamp}/dim_design.parquet",
+                    "rows": 0,
+                },
+            },
+        }
+        s3_client.put_object(
+            Bucket=bucket,
+            Key=f"{timestamp}/manifest.json",
+            Body=json.dumps(manifest),
+        )
+        result = get_latest_processed_file_list(s3_client, timestamp)
+        assert result["file_list"] == [
+            f"{timestamp}/dim_staff.parquet",
+            f"{timestamp}/fact_sales_order.parquet",
+        ]
+
 
 class TestGetProcessedData:
 
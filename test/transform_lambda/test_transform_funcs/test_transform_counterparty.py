@@ -1,10 +1,15 @@
 import boto3
+import json
 import os
 from moto import mock_aws
 import pytest
 import pandas as pd
 from numpy import nan
-from src.transform_lambda.transform_funcs import convert_counterparty
+from src.transform_lambda.transform_funcs import (
+    convert_counterparty,
+    convert_location,
+)
+from src.transform_lambda.utils import get_run_context
 
 
 @pytest.fixture(scope="function")
@@ -218,6 +223,42 @@ class TestConvertCounterParty:
             "4949 998070",
         ]
 
+    def test_address_read_once_when_shared_with_location(self, s3_client):
+        bucket = "blackwater-ingestion-zone"
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        for table in ["address", "counterparty"]:
+            s3_client.upload_file(
+                Filename=f"test/data/{table}.csv",
+                Bucket=bucket,
+                Key=f"ingested_data/original_data_dump/{table}.csv",
+            )
+        s3_client.put_object(
+            Bucket=bucket,
+            Key="run_state.json",
+            Body=json.dumps({"folder": "original_data_dump", "tables": {}}),
+        )
+        context = get_run_context(s3_client)
+        location = convert_location(s3_client, session, run_context=context)
+        counterparty = convert_counterparty(
+            s3_client, session, run_context=context
+        )
+        assert location["status"] == "success"
+        assert counterparty["status"] == "success"
+        assert counterparty["data"].equals(
+            convert_counterparty(s3_client, session)["data"]
+        )
+        assert context["cache"].stats() == {
+            "hits": 1,
+            "misses": 2,
+            "files": 2,
+        }
+
     def test_convert_counterparty_without_req_file_returns_expected_error(
         self, s3_client, file_name1="address", file_name2="department"
     ):
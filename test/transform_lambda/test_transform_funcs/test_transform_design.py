@@ -2,6 +2,7 @@ import boto3
 import os
 from moto import mock_aws
 import pytest
+from unittest.mock import patch
 import pandas as pd
 from src.transform_lambda.transform_funcs import convert_design
 
@@ -167,3 +168,33 @@ class TestConvertDesign:
         assert result["timestamp"] == ""
 
         result = convert_design(s3_client, session)
+
+    def test_convert_design_uses_run_context_given(
+        self, s3_client, file_name="design"
+    ):
+        timestamp = "2024-05-20 12:10:03.998128"
+        bucket = "blackwater-ingestion-zone"
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        s3_client.upload_file(
+            Filename=f"test/data/{file_name}.csv",
+            Bucket=bucket,
+            Key=f"ingested_data/{timestamp}/{file_name}.csv",
+        )
+        context = {
+            "status": "success",
+            "timestamp": timestamp,
+            "file_list": [f"ingested_data/{timestamp}/{file_name}.csv"],
+            "run_type": "update",
+        }
+        with patch(
+            "src.transform_lambda.transform_funcs.read_latest_changes"
+        ) as mock_read:
+            result = convert_design(s3_client, session, run_context=context)
+        assert result["status"] == "success"
+        assert mock_read.call_count == 0
@@ -3,6 +3,7 @@ import os
 from moto import mock_aws
 import pytest
 import pandas as pd
+import awswrangler as wr
 from src.transform_lambda.transform_funcs import convert_sales_order
 
 
@@ -297,3 +298,81 @@ class TestConvertSales:
         result = convert_sales_order(s3_client, session)
         assert result["status"] == "failure"
         assert result["timestamp"] == ""
+
+
+class TestConvertSalesParquet:
+    def test_parquet_ingestion_gives_same_result_as_csv(self, s3_client):
+        bucket = "blackwater-ingestion-zone"
+        key = "ingested_data/original_data_dump/sales_order"
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        s3_client.upload_file(
+            Filename="test/data/sales_order.csv",
+            Bucket=bucket,
+            Key=f"{key}.csv",
+        )
+        s3_client.upload_file(
+            Filename="test/data/last_ran_at_99/last_ran_at.csv",
+            Bucket=bucket,
+            Key="last_ran_at.csv",
+        )
+        from_csv = convert_sales_order(s3_client, session)
+
+        s3_client.delete_object(Bucket=bucket, Key=f"{key}.csv")
+        typed = pd.read_csv(
+            "test/data/sales_order.csv",
+            parse_dates=["created_at", "last_updated"],
+        )
+        for column in ["agreed_payment_date", "agreed_delivery_date"]:
+            typed[column] = pd.to_datetime(typed[column]).dt.date
+        wr.s3.to_parquet(
+            df=typed,
+            path=f"s3://{bucket}/{key}.parquet",
+            boto3_session=session,
+            index=False,
+        )
+        from_parquet = convert_sales_order(s3_client, session)
+
+        assert from_parquet["status"] == "success"
+        for column in from_csv["data"].columns:
+            assert list(from_parquet["data"][column]) == list(
+                from_csv["data"][column]
+            )
+
+    def test_missing_timestamp_left_empty(self, s3_client):
+        bucket = "blackwater-ingestion-zone"
+        key = "ingested_data/original_data_dump/sales_order"
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        s3_client.upload_file(
+            Filename="test/data/last_ran_at_99/last_ran_at.csv",
+            Bucket=bucket,
+            Key="last_ran_at.csv",
+        )
+        typed = pd.read_csv(
+            "test/data/sales_order.csv",
+            parse_dates=["created_at", "last_updated"],
+        )
+        typed.loc[0, "last_updated"] = pd.NaT
+        wr.s3.to_parquet(
+            df=typed,
+            path=f"s3://{bucket}/{key}.parquet",
+            boto3_session=session,
+            index=False,
+        )
+        result = convert_sales_order(s3_client, session)
+
+        assert result["status"] == "success"
+        assert pd.isna(result["data"]["last_updated_date"][0])
+        assert pd.isna(result["data"]["last_updated_time"][0])
+        assert result["data"]["created_time"][0] == "14:20:52.186"
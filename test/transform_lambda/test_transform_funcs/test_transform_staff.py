@@ -23,6 +23,47 @@ def s3_client(aws_creds):
 
 
 class TestConvertStaff:
+    def test_departments_matched_by_id_when_sparse_and_out_of_order(
+        self, s3_client
+    ):
+        timestamp = "2024-05-20 12:10:03.998128"
+        bucket = "blackwater-ingestion-zone"
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        department = pd.read_csv("test/data/department.csv")
+        department["department_id"] = department["department_id"] * 10
+        department = department.iloc[::-1]
+        staff = pd.read_csv("test/data/staff.csv")
+        staff["department_id"] = staff["department_id"] * 10
+        s3_client.put_object(
+            Bucket=bucket,
+            Key="ingested_data/original_data_dump/department.csv",
+            Body=department.to_csv(index=False).encode(),
+        )
+        s3_client.put_object(
+            Bucket=bucket,
+            Key=f"ingested_data/{timestamp}/staff.csv",
+            Body=staff.to_csv(index=False).encode(),
+        )
+        s3_client.upload_file(
+            Filename="test/data/last_ran_at.csv",
+            Bucket=bucket,
+            Key="last_ran_at.csv",
+        )
+        result = convert_staff(s3_client, session)
+        assert result["status"] == "success"
+        names = department.set_index("department_id")["department_name"]
+        expected = staff["department_id"].map(names).tolist()
+        assert result["data"]["department_name"].tolist() == expected
+        assert (
+            result["data"]["staff_id"].tolist() == staff["staff_id"].tolist()
+        )
+
     def test_convert_staff_rtns_df_type_removes_drop_cols_and_adds_dept_cols(
         self,
         s3_client,
@@ -1,13 +1,29 @@
 import pytest
 import boto3
+import gzip
+import json
 import os
+import zstandard
 import pandas as pd
+import threading
 import awswrangler as wr
+from awswrangler.exceptions import NoFilesFound
 from moto import mock_aws
+from unittest.mock import patch
 from src.transform_lambda.utils import (
     read_latest_changes,
+    read_run_folder,
     get_data_from_ingestion_bucket,
     write_parquet_data_to_s3,
+    find_ingestion_file,
+    find_ingestion_parts,
+    write_processed_manifest,
+    get_run_context,
+    list_keys,
+    read_ingestion_object,
+    prefetch_inputs,
+    join_dimension,
+    InputCache,
 )
 
 
@@ -93,6 +109,171 @@ class TestReadLatestChanges:
         ]
 
 
+class TestListKeys:
+    def test_listing_follows_pages_and_stays_in_prefix(self, s3_client):
+        bucket = "blackwater-ingestion-zone"
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        timestamp = "2024-05-20 12:10:03.998128"
+        for part in range(1001):
+            s3_client.put_object(
+                Bucket=bucket,
+                Key=f"ingested_data/{timestamp}/staff.part-{part:04d}.csv",
+                Body=b"",
+            )
+        s3_client.put_object(
+            Bucket=bucket,
+            Key="ingested_data/2024-05-19 12:10:03.998128/staff.csv",
+            Body=b"",
+        )
+        result = list_keys(s3_client, bucket, f"ingested_data/{timestamp}/")
+        assert len(result) == 1001
+        assert all(timestamp in key for key in result)
+
+    def test_empty_prefix_listed_as_no_keys(self, s3_client):
+        bucket = "blackwater-ingestion-zone"
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        assert list_keys(s3_client, bucket, "ingested_data/none/") == []
+
+
+class TestReadLatestChangesFromManifest:
+    def test_file_list_read_from_manifest(self, s3_client):
+        timestamp = "2024-05-20 12:10:03.998128"
+        bucket = "blackwater-ingestion-zone"
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        state = {"folder": timestamp, "tables": {}}
+        s3_client.put_object(
+            Bucket=bucket, Key="run_state.json", Body=json.dumps(state)
+        )
+        manifest = {
+            "folder": timestamp,
+            "tables": {
+                "staff": {
+                    "rows": 2,
+                    "files": [{"key": f"ingested_data/{timestamp}/staff.csv"}],
+                },
+                "currency": {"rows": 0, "files": []},
+            },
+        }
+        s3_client.put_object(
+            Bucket=bucket,
+            Key=f"ingested_data/{timestamp}/manifest.json",
+            Body=json.dumps(manifest),
+        )
+        result = read_latest_changes(s3_client)
+        assert result["timestamp"] == timestamp
+        assert result["file_list"] == [f"ingested_data/{timestamp}/staff.csv"]
+
+
+class TestReadRunFolder:
+    def test_folder_read_from_run_state(self, s3_client):
+        bucket = "blackwater-ingestion-zone"
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        state = {
+            "last_ran_at": "2024-05-20 12:10:03.998128",
+            "folder": "2024-05-20 12:10:03.998128",
+            "tables": {},
+        }
+        s3_client.put_object(
+            Bucket=bucket, Key="run_state.json", Body=json.dumps(state)
+        )
+        s3_client.upload_file(
+            Filename="test/data/dummy_csv.csv",
+            Bucket=bucket,
+            Key="last_ran_at.csv",
+        )
+        assert read_run_folder(s3_client) == "2024-05-20 12:10:03.998128"
+
+    def test_legacy_runtime_used_if_no_run_state(self, s3_client):
+        bucket = "blackwater-ingestion-zone"
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        s3_client.upload_file(
+            Filename="test/data/last_ran_at.csv",
+            Bucket=bucket,
+            Key="last_ran_at.csv",
+        )
+        assert read_run_folder(s3_client) == "2024-05-20 12:10:03.998128"
+
+    def test_original_data_dump_read_from_run_state(self, s3_client):
+        bucket = "blackwater-ingestion-zone"
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        key = "ingested_data/original_data_dump/staff.csv"
+        s3_client.upload_file(
+            Filename="test/data/dummy_csv.csv", Bucket=bucket, Key=key
+        )
+        state = {"folder": "original_data_dump", "tables": {}}
+        s3_client.put_object(
+            Bucket=bucket, Key="run_state.json", Body=json.dumps(state)
+        )
+        result = read_latest_changes(s3_client)
+        assert result["timestamp"] == "original_data_dump"
+        assert result["file_list"] == [key]
+
+
+class TestGetRunContext:
+    def test_original_data_dump_run_type(self, s3_client):
+        bucket = "blackwater-ingestion-zone"
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        key = "ingested_data/original_data_dump/staff.csv"
+        s3_client.upload_file(
+            Filename="test/data/dummy_csv.csv", Bucket=bucket, Key=key
+        )
+        state = {"folder": "original_data_dump", "tables": {}}
+        s3_client.put_object(
+            Bucket=bucket, Key="run_state.json", Body=json.dumps(state)
+        )
+        result = get_run_context(s3_client)
+        cache = result.pop("cache")
+        assert isinstance(cache, InputCache)
+        assert cache.stats() == {"hits": 0, "misses": 0, "files": 0}
+        assert result == {
+            "status": "success",
+            "timestamp": "original_data_dump",
+            "file_list": [key],
+            "run_type": "original_data_dump",
+        }
+
+    def test_update_run_type(self, s3_client):
+        bucket = "blackwater-ingestion-zone"
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        s3_client.upload_file(
+            Filename="test/data/last_ran_at.csv",
+            Bucket=bucket,
+            Key="last_ran_at.csv",
+        )
+        result = get_run_context(s3_client)
+        assert result["timestamp"] == "2024-05-20 12:10:03.998128"
+        assert result["run_type"] == "update"
+
+    def test_failure_returned_without_run_type(self, s3_client):
+        result = get_run_context(s3_client)
+        assert result["status"] == "failure"
+        assert "run_type" not in result
+
+
 class TestGetFileContents:
     def test_function_returns_pandas_dataframe(self, s3_client):
         bucket = "blackwater-ingestion-zone"
@@ -181,6 +362,403 @@ class TestGetFileContents:
             == f"No files Found on: s3://{bucket}/{input_key}."
         )
 
+    def test_parquet_file_read_with_original_dtypes(self, s3_client):
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        bucket = "blackwater-ingestion-zone"
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        timestamp = "2024-05-20 12:10:03.998128"
+        dataframe = pd.read_csv(
+            "test/data/staff.csv", parse_dates=["created_at", "last_updated"]
+        )
+        wr.s3.to_parquet(
+            df=dataframe,
+            path=f"s3://{bucket}/ingested_data/{timestamp}/staff.parquet",
+            boto3_session=session,
+            index=False,
+        )
+        result = get_data_from_ingestion_bucket(
+            key=timestamp, filename="staff.csv", session=session
+        )
+        assert result["status"] == "success"
+        assert len(result["data"]) == len(dataframe)
+        assert pd.api.types.is_datetime64_any_dtype(
+            result["data"]["last_updated"]
+        )
+
+    @pytest.mark.parametrize(
+        "compression,extension", [("gzip", "csv.gz"), ("zstd", "csv.zst")]
+    )
+    def test_compressed_csv_is_decompressed(
+        self, s3_client, compression, extension
+    ):
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        bucket = "blackwater-ingestion-zone"
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        timestamp = "2024-05-20 12:10:03.998128"
+        with open("test/data/staff.csv", "rb") as f:
+            body = f.read()
+        if compression == "gzip":
+            body = gzip.compress(body)
+        else:
+            body = zstandard.ZstdCompressor().compress(body)
+        s3_client.put_object(
+            Bucket=bucket,
+            Key=f"ingested_data/{timestamp}/staff.{extension}",
+            Body=body,
+            ContentEncoding=compression,
+        )
+        result = get_data_from_ingestion_bucket(
+            key=timestamp, filename="staff.csv", session=session
+        )
+        expected = pd.read_csv("test/data/staff.csv")
+        assert result["status"] == "success"
+        assert result["data"].equals(expected)
+
+    def test_part_files_read_as_one_table(self, s3_client):
+        bucket = "blackwater-ingestion-zone"
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        timestamp = "2024-05-20 12:10:03.998128"
+        expected = pd.read_csv("test/data/staff.csv")
+        half = len(expected) // 2
+        for part, df in enumerate([expected[:half], expected[half:]]):
+            s3_client.put_object(
+                Bucket=bucket,
+                Key=f"ingested_data/{timestamp}/staff.part-000{part}.csv",
+                Body=df.to_csv(index=False).encode(),
+            )
+        result = get_data_from_ingestion_bucket(
+            key=timestamp, filename="staff.csv", session=session
+        )
+        assert result["status"] == "success"
+        assert result["data"].equals(expected)
+
+    def test_cdc_delete_markers_and_columns_dropped(self, s3_client):
+        bucket = "blackwater-ingestion-zone"
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        timestamp = "2024-05-20 12:10:03.998128"
+        s3_client.put_object(
+            Bucket=bucket,
+            Key=f"ingested_data/{timestamp}/staff.csv",
+            Body=(
+                "staff_id,first_name,cdc_operation,cdc_lsn\n"
+                "1,Jeremie,UPDATE,0/16B3748\n"
+                "2,,DELETE,0/16B37C0\n"
+                "3,Deron,INSERT,0/16B3838\n"
+            ).encode(),
+        )
+        result = get_data_from_ingestion_bucket(
+            key=timestamp, filename="staff.csv", session=session
+        )
+        assert result["status"] == "success"
+        assert list(result["data"].columns) == ["staff_id", "first_name"]
+        assert list(result["data"]["staff_id"]) == [1, 3]
+
+    def test_table_with_no_rows_in_manifest_is_not_read(self, s3_client):
+        bucket = "blackwater-ingestion-zone"
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        timestamp = "2024-05-20 12:10:03.998128"
+        manifest = {
+            "folder": timestamp,
+            "tables": {"staff": {"rows": 0, "files": []}},
+        }
+        s3_client.put_object(
+            Bucket=bucket,
+            Key=f"ingested_data/{timestamp}/manifest.json",
+            Body=json.dumps(manifest),
+        )
+        result = get_data_from_ingestion_bucket(
+            key=timestamp, filename="staff.csv", session=session
+        )
+        assert result == {"status": "failure", "message": "no new data"}
+
+    def test_files_listed_in_manifest_are_read(self, s3_client):
+        bucket = "blackwater-ingestion-zone"
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        timestamp = "2024-05-20 12:10:03.998128"
+        key = f"ingested_data/{timestamp}/staff.csv"
+        expected = pd.read_csv("test/data/staff.csv")
+        s3_client.put_object(
+            Bucket=bucket, Key=key, Body=expected.to_csv(index=False).encode()
+        )
+        manifest = {
+            "folder": timestamp,
+            "tables": {
+                "staff": {"rows": len(expected), "files": [{"key": key}]}
+            },
+        }
+        s3_client.put_object(
+            Bucket=bucket,
+            Key=f"ingested_data/{timestamp}/manifest.json",
+            Body=json.dumps(manifest),
+        )
+        result = get_data_from_ingestion_bucket(
+            key=timestamp, filename="staff.csv", session=session
+        )
+        assert result["status"] == "success"
+        assert result["data"].equals(expected)
+
+
+class TestInputCache:
+    def test_file_downloaded_once_then_read_from_cache(self, s3_client):
+        bucket = "blackwater-ingestion-zone"
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        key = "ingested_data/original_data_dump/address.csv"
+        s3_client.upload_file(
+            Filename="test/data/address.csv", Bucket=bucket, Key=key
+        )
+        etag = s3_client.head_object(Bucket=bucket, Key=key)["ETag"]
+        cache = InputCache()
+        first = read_ingestion_object(s3_client, bucket, key, cache)
+        s3_client.delete_object(Bucket=bucket, Key=key)
+        second = read_ingestion_object(s3_client, bucket, key, cache)
+        assert second is first
+        assert cache.files[key]["etag"] == etag
+        assert cache.stats() == {"hits": 1, "misses": 1, "files": 1}
+
+    def test_missing_file_not_cached(self, s3_client):
+        bucket = "blackwater-ingestion-zone"
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        key = "ingested_data/original_data_dump/address.csv"
+        cache = InputCache()
+        with pytest.raises(NoFilesFound):
+            read_ingestion_object(s3_client, bucket, key, cache)
+        assert cache.stats() == {"hits": 0, "misses": 1, "files": 0}
+
+    def test_changing_table_data_leaves_cache_unchanged(self, s3_client):
+        bucket = "blackwater-ingestion-zone"
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        timestamp = "2024-05-20 12:10:03.998128"
+        s3_client.upload_file(
+            Filename="test/data/staff.csv",
+            Bucket=bucket,
+            Key=f"ingested_data/{timestamp}/staff.csv",
+        )
+        cache = InputCache()
+        first = get_data_from_ingestion_bucket(
+            timestamp, "staff.csv", session, cache=cache
+        )
+        first["data"]["first_name"] = "changed"
+        second = get_data_from_ingestion_bucket(
+            timestamp, "staff.csv", session, cache=cache
+        )
+        assert second["data"].equals(pd.read_csv("test/data/staff.csv"))
+        assert cache.stats() == {"hits": 1, "misses": 1, "files": 1}
+
+
+class TestPrefetchInputs:
+    def test_inputs_fetched_before_converters_read_them(self, s3_client):
+        bucket = "blackwater-ingestion-zone"
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        timestamp = "2024-05-20 12:10:03.998128"
+        for folder, table in [
+            (timestamp, "staff"),
+            ("original_data_dump", "department"),
+        ]:
+            s3_client.upload_file(
+                Filename=f"test/data/{table}.csv",
+                Bucket=bucket,
+                Key=f"ingested_data/{folder}/{table}.csv",
+            )
+        context = {
+            "status": "success",
+            "timestamp": timestamp,
+            "cache": InputCache(),
+        }
+        result = prefetch_inputs(
+            session,
+            context,
+            [("staff.csv", True), ("department.csv", False)],
+        )
+        assert result == {"files": 2, "failed": []}
+        staff = get_data_from_ingestion_bucket(
+            timestamp, "staff.csv", session, cache=context["cache"]
+        )
+        department = get_data_from_ingestion_bucket(
+            timestamp,
+            "department.csv",
+            session,
+            update=False,
+            cache=context["cache"],
+        )
+        assert staff["data"].equals(pd.read_csv("test/data/staff.csv"))
+        assert department["status"] == "success"
+        assert context["cache"].stats() == {
+            "hits": 2,
+            "misses": 2,
+            "files": 2,
+        }
+
+    def test_files_fetched_concurrently(self, s3_client):
+        bucket = "blackwater-ingestion-zone"
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        timestamp = "2024-05-20 12:10:03.998128"
+        tables = ["design", "currency", "staff"]
+        for table in tables:
+            s3_client.upload_file(
+                Filename="test/data/dummy_csv.csv",
+                Bucket=bucket,
+                Key=f"ingested_data/{timestamp}/{table}.csv",
+            )
+        context = {
+            "status": "success",
+            "timestamp": timestamp,
+            "cache": InputCache(),
+        }
+        barrier = threading.Barrier(len(tables), timeout=5)
+        with patch(
+            "src.transform_lambda.utils.read_ingestion_object",
+            side_effect=lambda *args: barrier.wait(),
+        ):
+            result = prefetch_inputs(
+                session,
+                context,
+                [(f"{table}.csv", True) for table in tables],
+                max_workers=len(tables),
+            )
+        assert result == {"files": 3, "failed": []}
+
+    def test_missing_file_left_for_converter_to_report(self, s3_client):
+        bucket = "blackwater-ingestion-zone"
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        session = boto3.session.Session(
+            aws_access_key_id="test", aws_secret_access_key="test"
+        )
+        timestamp = "2024-05-20 12:10:03.998128"
+        context = {
+            "status": "success",
+            "timestamp": timestamp,
+            "cache": InputCache(),
+        }
+        result = prefetch_inputs(session, context, [("staff.csv", True)])
+        key = f"ingested_data/{timestamp}/staff.csv"
+        assert result == {"files": 0, "failed": [key]}
+        response = get_data_from_ingestion_bucket(
+            timestamp, "staff.csv", session, cache=context["cache"]
+        )
+        assert str(response["message"]) == (
+            f"No files Found on: s3://{bucket}/{key}."
+        )
+
+
+class TestJoinDimension:
+    def test_rows_matched_by_key_not_position(self):
+        df = pd.DataFrame(
+            {"counterparty_id": [1, 2, 3], "legal_address_id": [30, 5, 30]},
+            index=[7, 8, 9],
+        )
+        lookup = pd.DataFrame(
+            {"address_id": [30, 12, 5], "city": ["Leeds", "York", "Bath"]}
+        )
+        result = join_dimension(
+            df, lookup, "legal_address_id", "address_id", {"city": "town"}
+        )
+        assert result["counterparty_id"].tolist() == [1, 2, 3]
+        assert result["town"].tolist() == ["Leeds", "Bath", "Leeds"]
+        assert list(result.index) == [0, 1, 2]
+
+    def test_missing_key_gives_null(self):
+        df = pd.DataFrame({"department_id": [1, 4]})
+        lookup = pd.DataFrame({"department_id": [1], "location": ["Leeds"]})
+        result = join_dimension(
+            df, lookup, "department_id", "department_id", {"location": "loc"}
+        )
+        assert result["loc"][0] == "Leeds"
+        assert pd.isna(result["loc"][1])
+
+    def test_last_duplicate_key_used(self):
+        df = pd.DataFrame({"department_id": [1]})
+        lookup = pd.DataFrame(
+            {"department_id": [1, 1], "location": ["Leeds", "York"]}
+        )
+        result = join_dimension(
+            df, lookup, "department_id", "department_id", {"location": "loc"}
+        )
+        assert result["loc"].tolist() == ["York"]
+
+
+class TestFindIngestionParts:
+    def test_parts_returned_in_order(self):
+        prefix = "ingested_data/original_data_dump/staff."
+        keys = [f"{prefix}part-0001.csv.gz", f"{prefix}part-0000.csv.gz"]
+        assert find_ingestion_parts(keys, prefix) == sorted(keys)
+
+    def test_no_parts_for_single_file(self):
+        prefix = "ingested_data/original_data_dump/staff."
+        assert find_ingestion_parts([f"{prefix}csv"], prefix) == []
+
+
+class TestFindIngestionFile:
+    def test_prefers_parquet_then_compressed_csv(self):
+        prefix = "ingested_data/original_data_dump/staff."
+        keys = [f"{prefix}csv", f"{prefix}csv.gz", f"{prefix}parquet"]
+        assert find_ingestion_file(keys, prefix) == f"{prefix}parquet"
+        assert find_ingestion_file(keys[:2], prefix) == f"{prefix}csv.gz"
+
+    def test_defaults_to_plain_csv(self):
+        prefix = "ingested_data/original_data_dump/staff."
+        assert find_ingestion_file([], prefix) == f"{prefix}csv"
+
 
 class TestWriteParquet:
     def test_function_writes_to_s3_bucket(self, s3_client):
@@ -299,3 +877,31 @@ class TestWriteParquet:
             result["message"]
             == "Data is in wrong format <class 'str'> is not a pandas dataframe"
         )
+
+
+class TestWriteProcessedManifest:
+    def test_successful_tables_listed_in_manifest(self, s3_client):
+        bucket = "blackwater-processed-zone"
+        s3_client.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        timestamp = "2024-05-20 12:10:03.998128"
+        written = [
+            {
+                "status": "success",
+                "table": "dim_staff",
+                "key": f"{timestamp}/dim_staff.parquet",
+                "rows": 5,
+            },
+            {"status": "failure", "message": "error"},
+        ]
+        result = write_processed_manifest(s3_client, timestamp, written)
+        assert result["status"] == "success"
+        response = s3_client.get_object(
+            Bucket=bucket, Key=f"{timestamp}/manifest.json"
+        )
+        manifest = json.loads(response["Body"].read())
+        assert manifest["tables"] == {
+            "dim_staff": {"key": f"{timestamp}/dim_staff.parquet", "rows": 5}
+        }